@@ -6,4 +6,5 @@ class AcademicsConfig(AppConfig):
     name = 'apps.academics'
     label = 'academics'
 
-
+    def ready(self):
+        from . import signals  # noqa
@@ -0,0 +1,156 @@
+# apps/academics/attendance_writer.py
+import time
+import queue
+import threading
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.db import transaction, close_old_connections
+
+WRITER_FLUSH_S = 3.0     # flush pending marks at least this often
+
+
+class AttendanceWriter(threading.Thread):
+    """
+    Background writer for face-recognition attendance.
+
+    The recognition loop only calls submit(); this thread drains the queue,
+    keeps the best similarity per student in memory and every `flush_s`
+    seconds (and on stop) writes, in ONE transaction:
+      - bulk_create for students without an Attendance row yet,
+      - bulk_update(face_conf) for rows whose confidence improved.
+    Semantics match the old per-match get_or_create: an existing row keeps
+    its status, only face_conf is raised.
+    """
+
+    def __init__(self, session_id, flush_s=WRITER_FLUSH_S, display=None, log_prefix="[ATTENDANCE]"):
+        super().__init__(daemon=True, name=f"attendance-writer-{session_id}")
+        self.session_id = session_id
+        self.flush_s = flush_s
+        self.display = display or {}
+        self.log_prefix = log_prefix
+        self._q = queue.Queue()
+        self._stop_evt = threading.Event()
+        self._pending = {}      # student_id -> (sim, status)
+        self._persisted = {}    # student_id -> face_conf already in DB
+        self.flushes = 0
+        self.rows_created = 0
+        self.rows_updated = 0
+
+    # -------- producer side (recognition loop) --------
+    def submit(self, student_id, sim_score, status):
+        """Queue a sighting. `status` is Present/Late as of the sighting time."""
+        self._q.put((int(student_id), float(sim_score), status))
+
+    # -------- consumer side --------
+    def _drain(self):
+        while True:
+            try:
+                student_id, sim, status = self._q.get_nowait()
+            except queue.Empty:
+                return
+            if sim <= self._persisted.get(student_id, -1.0):
+                continue
+            prev = self._pending.get(student_id)
+            if prev is None:
+                self._pending[student_id] = (sim, status)
+            elif sim > prev[0]:
+                # keep the status of the first sighting (arrival time), best sim
+                self._pending[student_id] = (sim, prev[1])
+
+    def flush(self):
+        self._drain()
+        if not self._pending:
+            return
+        Attendance = django_apps.get_model("academics", "Attendance")
+        batch, self._pending = self._pending, {}
+        created, updated = [], []
+        try:
+            with transaction.atomic():
+                existing = {
+                    a.student_id: a for a in
+                    Attendance.objects.filter(session_id=self.session_id, student_id__in=list(batch))
+                    .only("id", "student_id", "face_conf")
+                }
+                to_create = []
+                for sid, (sim, status) in batch.items():
+                    row = existing.get(sid)
+                    if row is None:
+                        to_create.append(Attendance(
+                            session_id=self.session_id, student_id=sid, method="face",
+                            liveness_score=None, face_conf=sim, geo_ok=False, status=status,
+                        ))
+                        created.append((sid, sim, status))
+                    elif sim > (row.face_conf or 0.0):
+                        updated.append((sid, row.face_conf or 0.0, sim))
+                        row.face_conf = sim
+                if to_create:
+                    Attendance.objects.bulk_create(to_create, ignore_conflicts=True)
+                    created = self._inserted(Attendance, created, existing, updated)
+                if updated:
+                    Attendance.objects.bulk_update([existing[sid] for sid, _, _ in updated], ["face_conf"])
+        except Exception as e:
+            print(f"[ERROR] Attendance batch flush failed ({len(batch)} rows): {e}")
+            # put them back so the next flush retries
+            for sid, val in batch.items():
+                cur = self._pending.get(sid)
+                if cur is None or val[0] > cur[0]:
+                    self._pending[sid] = val
+            return
+
+        for sid, (sim, _status) in batch.items():
+            self._persisted[sid] = max(sim, self._persisted.get(sid, -1.0))
+        for sid, sim, status in created:
+            name = self.display.get(sid, str(sid))
+            print(f"{self.log_prefix} MARKED {status}: {name} (student_id={sid}) sim={sim:.3f} session={self.session_id}")
+        for sid, old, new in updated:
+            print(f"{self.log_prefix} Already marked — updated conf: student_id={sid} {old:.3f} -> {new:.3f}")
+        if created:
+            try:
+                cache.incr(f"sess:{self.session_id}:face_seen", len(created))
+            except ValueError:
+                cache.set(f"sess:{self.session_id}:face_seen", len(created), 3600)
+        self.flushes += 1
+        self.rows_created += len(created)
+        self.rows_updated += len(updated)
+
+    def _inserted(self, Attendance, created, existing, updated):
+        """
+        ignore_conflicts silently drops rows another writer inserted first (no
+        pks come back), so re-read the pairs: a row carrying exactly what we
+        wrote is ours; anyone else's row only gets its face_conf raised.
+        """
+        rows = {a.student_id: a for a in
+                Attendance.objects.filter(session_id=self.session_id, student_id__in=[c[0] for c in created])
+                .only("id", "student_id", "face_conf", "status", "method")}
+        mine = []
+        for sid, sim, status in created:
+            row = rows.get(sid)
+            if row is None:
+                continue
+            if row.method == "face" and row.status == status and row.face_conf == sim:
+                mine.append((sid, sim, status))
+            elif sim > (row.face_conf or 0.0):
+                updated.append((sid, row.face_conf or 0.0, sim))
+                row.face_conf = sim
+                existing[sid] = row
+        return mine
+
+    def run(self):
+        try:
+            while not self._stop_evt.wait(self.flush_s):
+                self.flush()
+            self.flush()  # final flush on stop
+        finally:
+            close_old_connections()
+
+    def stop(self, join_timeout=10.0):
+        """Stop and flush whatever is still pending (call on session stop)."""
+        self._stop_evt.set()
+        if self.is_alive():
+            self.join(join_timeout)
+        else:
+            self.flush()
+
+    def stats(self):
+        return {"queued": self._q.qsize(), "pending": len(self._pending), "flushes": self.flushes,
+                "created": self.rows_created, "updated": self.rows_updated}
@@ -1,41 +1,45 @@
 # apps/academics/cam_worker_insight.py
 import time, threading
-import numpy as np
 import cv2
 from django.utils import timezone
 from django.apps import apps as django_apps
 from django.core.cache import cache
-from insightface.app import FaceAnalysis
 from django.conf import settings
+from apps.biometrics.services.matching import stack_embeddings, top_k
+from apps.biometrics.services.face import detect_faces, embed_faces
+from apps.biometrics.services.tracking import FaceTracker
+from apps.biometrics.services.capture import LatestFrameGrabber
+from apps.biometrics.services.quality import QualityGate
+from apps.biometrics.services.frame_rate import FrameRateScheduler, unmarked_count
+from apps.biometrics.services.startup_metrics import StartupClock
+from apps.biometrics.services.inference_server import connect_or_none, InferenceTimeout
+from apps.biometrics.services.model_factory import load_face_app
+from .session_state import SessionState
+from .attendance_writer import AttendanceWriter
 
 # pick ONE loader:
-from .whitelist import load_session_whitelist  # DB centroids (UserEmbeddingTemplate)
+from .live_gallery import LiveGallery  # mmap'd per-section snapshot of DB centroids, hot-reloaded
 # from .whitelist import load_session_whitelist_from_gallery  # TEMP for gallery.json
 
 _SIM_THRESH   = 0.35   # start lower to validate; later 0.55–0.60
 _COOLDOWN_SEC = 20
+_REVERIFY_SEC = 60     # re-embed a recognized track this often
 _WORKERS = {}
 
 
 
-def _normalize_rows(M: np.ndarray) -> np.ndarray:
-    M = M.astype(np.float32, copy=False)
-    norms = np.linalg.norm(M, axis=1, keepdims=True) + 1e-8
-    return M / norms
-
 def _init_insightface():
-    app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    return app
-
-def _cosine(a, B):
-    # a and B rows must be L2-normalized
-    return np.dot(B, a)
+    # reuse the shared inference service when one is configured and reachable
+    client = connect_or_none(getattr(settings, "FACE_INFERENCE_ADDR", ""), fallback=load_face_app)
+    if client is not None:
+        return client
+    return load_face_app()
 
 class ProfCamWorker(threading.Thread):
     def __init__(self, session_id, cam_source = 0):
         super().__init__(daemon=True)
         self.session_id = session_id
+        self.clock = StartupClock(session_id, t0=time.time(), log_prefix=f"[CAM {session_id}]")  # started by session_start
         self.cam_source = 0
         self.cam_source = cam_source
         self._stop = threading.Event()
@@ -45,19 +49,20 @@ class ProfCamWorker(threading.Thread):
         self.Student     = django_apps.get_model("academics", "Student")
         self.session = self.Session.objects.select_related("course_assignment__professor", "room").get(id=session_id)
 
-        stu_ids, _user_ids, emb_mat, display = load_session_whitelist(self.session)
-        self.display     = display or {}
-        self.student_ids = list(stu_ids or [])
-        self.emb_matrix  = None if emb_mat is None else _normalize_rows(np.array(emb_mat, dtype=np.float32))
-
-        # DEBUG: shapes and sanity
-        print("[DEBUG] emb_matrix shape:", None if self.emb_matrix is None else self.emb_matrix.shape)
-        if self.emb_matrix is not None and len(self.student_ids) > 0:
-            v0 = self.emb_matrix[0]
-            print("[DEBUG] self dot v0·v0 =", float((v0 * v0).sum()))
+        # rows, roster (row -> user/student/name/enrollment) and matcher, swapped
+        # in place when enrollments or templates change; no per-match queries.
+        # Always read self.gallery.view: it may start empty and fill while running.
+        self.gallery     = LiveGallery(self.session.course_assignment_id, log_prefix=f"[CAM {session_id}]")
+        self.display     = self.gallery.view.display
 
         self.last_mark = {}
         self.face_app  = None
+        self.tracker   = FaceTracker(reverify_s=_REVERIFY_SEC)
+        self.gate      = QualityGate.from_settings()  # skip unusable faces before embedding
+        self.rate      = FrameRateScheduler.from_settings()  # full rate on motion, idle when static
+        self.state     = SessionState(session_id)
+        self.writer    = AttendanceWriter(session_id, display=self.display, log_prefix=f"[CAM {session_id}]")
+        self._last_stats = time.time()
 
     def _open_camera(self):
         # Prefer DirectShow on Windows
@@ -92,54 +97,86 @@ class ProfCamWorker(threading.Thread):
             print(f"[CAM {self.session_id}] TEST_MODE — skipping camera thread.")
             return
 
-        if self.emb_matrix is None or len(self.student_ids) == 0:
-            print(f"[CAM {self.session_id}] No enrolled embeddings; worker not started.")
-            return
-
         self.face_app = _init_insightface()
+        self.clock.mark("model_ready")
         cap = self._open_camera()
         if not cap:
             return
         self.cap = cap
-
-        print(f"[CAM {self.session_id}] Running with {len(self.student_ids)} enrolled vectors")
+        self.clock.mark("camera_open")
+        # capture on its own thread; inference always takes the newest frame
+        grabber = LatestFrameGrabber(cap, name=f"cam-{self.session_id}-grabber")
+        grabber.start()
+
+        self.writer.start()
+        self.gallery.start()
+        gallery_rev = self.gallery.view.rev
+        if self.gallery.view.matrix is None:
+            print(f"[CAM {self.session_id}] No enrolled embeddings yet; waiting for the gallery to fill")
+        else:
+            print(f"[CAM {self.session_id}] Running with {len(self.gallery.view.student_ids)} enrolled vectors")
         try:
             while not self._stop.is_set():
-                s = self.Session.objects.get(id=self.session_id)
-                now = timezone.now()
-                if s.status != "running" or (s.end_time and now >= s.end_time):
-                    print(f"[CAM {self.session_id}] Session not running/ended; stopping.")
+                running, why = self.state.check()
+                if not running:
+                    print(f"[CAM {self.session_id}] Session not running/ended ({why}); stopping.")
                     break
 
-                ok, frame = cap.read()
+                ok, frame, frame_ts, frame_age = grabber.read(timeout=1.0)
                 if not ok or frame is None:
-                    time.sleep(0.03)
+                    continue
+                self.clock.mark("first_frame")
+
+                view = self.gallery.view  # one consistent gallery for this frame
+                if view.rev != gallery_rev:
+                    gallery_rev = view.rev
+                    self.display = self.writer.display = view.display
+                if self.rate is not None and not self.rate.should_process(
+                        frame, unmarked_count(view.student_ids, self.last_mark)):
+                    self.rate.wait()
                     continue
 
-                faces = self.face_app.get(frame)
+                try:
+                    faces = detect_faces(self.face_app, frame)
+                except InferenceTimeout as e:
+                    print(f"[CAM {self.session_id}] {e}; frame skipped")
+                    continue
                 if faces:
+                    self.clock.mark("first_face")
                     print(f"[INFO] {len(faces)} face(s) detected")
                     cache.set(f"sess:{self.session_id}:last_seen", timezone.now().isoformat(), 3600)
 
-                for f in faces:
-                    emb = f.normed_embedding
-                    if emb is None:
-                        e = f.embedding
-                        emb = e / (np.linalg.norm(e) + 1e-8)
-                    emb = emb.astype(np.float32)
-                    emb = emb / (np.linalg.norm(emb) + 1e-8)
-                    print("[DEBUG] live emb dim:", emb.shape, "norm:", float(np.linalg.norm(emb)))
-
-                    sims = _cosine(emb, self.emb_matrix)
-                    top_idx = np.argsort(-sims)[:3]
-                    top_triplet = [(int(self.student_ids[i]), float(sims[i])) for i in top_idx]
-                    print(f"[DEBUG] Top-3 sims: {[(sid, round(sim,3)) for sid, sim in top_triplet]}")
+                # recognizer runs only for new / unresolved / due-for-reverify tracks
+                tracks = self.tracker.update(faces)
+                now_ts = time.time()
+                # empty gallery: nothing can match, so don't embed; tracks stay unresolved
+                pending = ([] if view.matrix is None or len(view.student_ids) == 0 else
+                           [i for i, t in enumerate(tracks) if self.tracker.needs_embedding(t, now_ts)])
+                if self.gate is not None and pending:
+                    _, pending = self.gate.filter(frame, [faces[i] for i in pending], pending)
+                if pending:
+                    try:
+                        todo = embed_faces(self.face_app, frame, [faces[i] for i in pending])
+                    except InferenceTimeout as e:
+                        print(f"[CAM {self.session_id}] {e}; frame skipped")
+                        continue
+                    # score every pending face in one (F, D) x (D, N) matmul
+                    top_idx_all, top_sims_all = top_k(stack_embeddings(todo), view.matcher, k=3)
+
+                for fi, i in enumerate(pending):
+                    top_idx, sims_k = top_idx_all[fi], top_sims_all[fi]
+                    top_triplet = [(int(view.student_ids[j]), float(sim)) for j, sim in zip(top_idx, sims_k)]
                     cache.set(f"sess:{self.session_id}:last_best", str(top_triplet[0]), 60)
+                    self.tracker.record(tracks[i], top_triplet[0][0], top_triplet[0][1], _SIM_THRESH, now_ts)
 
                     k = int(top_idx[0])
-                    best_sim = float(sims[k])
-                    if best_sim >= _SIM_THRESH:
-                        student_id = int(self.student_ids[k])
+                    best_sim = float(sims_k[0])
+                    entry = view.roster.for_row(k)
+                    if best_sim >= _SIM_THRESH and entry is None:
+                        print(f"[SKIP] student_id={view.student_ids[k]} no longer enrolled")
+                    elif best_sim >= _SIM_THRESH:
+                        self.clock.mark("first_recognition")
+                        student_id = entry.student_id
                         last = self.last_mark.get(student_id, 0.0)
                         if time.time() - last >= _COOLDOWN_SEC:
                             self._mark_present(student_id, best_sim)
@@ -149,36 +186,36 @@ class ProfCamWorker(threading.Thread):
                     else:
                         print(f"[LOW SIM] best={best_sim:.2f} < thresh={_SIM_THRESH:.2f}")
 
-                time.sleep(0.01)
+                if now_ts - self._last_stats >= 60:
+                    print(f"[CAM {self.session_id}] tracker {self.tracker.stats()} "
+                          f"capture={grabber.stats()} frame_age={frame_age:.3f}s writer={self.writer.stats()} "
+                          f"gallery={self.gallery.stats()} "
+                          f"quality={self.gate.stats() if self.gate else None} "
+                          f"rate={self.rate.stats() if self.rate else None}")
+                    self._last_stats = now_ts
+
+                if self.rate is not None:
+                    self.rate.done()
+                else:
+                    time.sleep(0.01)
         finally:
+            self.gallery.stop()
+            grabber.stop()
             cap.release()
+            self.writer.stop()  # flush pending marks
             print(f"[CAM {self.session_id}] Stopped.")
 
     def _mark_present(self, student_id: int, sim_score: float):
         try:
-            s = self.Session.objects.select_related("course_assignment").get(id=self.session_id)
-            now = timezone.now()
-            status = "Present" if now <= (s.start_time + timezone.timedelta(minutes=10)) else "Late"
-
-            obj, created = self.Attendance.objects.get_or_create(
-                session_id=self.session_id,
-                student_id=student_id,
-                defaults={
-                    "method": "face",
-                    "geo_ok": False,
-                    "status": status,
-                    "face_conf": sim_score,
-                },
-            )
+            running, why = self.state.check()
+            if not running:
+                print(f"[CAM {self.session_id}] skip mark: {why}")
+                return
+            status = self.state.attendance_status(grace_min=10)
+            # queued; AttendanceWriter flushes creates/conf updates in batches
+            self.writer.submit(student_id, sim_score, status)
             name = self.display.get(student_id, str(student_id))
-            if created:
-                print(f"[ATTENDANCE] {status}: {name} (id={student_id}) sim={sim_score:.3f}")
-                cache.set(f"sess:{self.session_id}:last_mark", f"{name} {sim_score:.2f}", 3600)
-            else:
-                if (obj.face_conf or 0.0) < sim_score:
-                    obj.face_conf = sim_score
-                    obj.save(update_fields=["face_conf"])
-                    print(f"[ATTENDANCE] Updated conf → {sim_score:.3f}")
+            cache.set(f"sess:{self.session_id}:last_mark", f"{name} {sim_score:.2f}", 3600)
         except Exception as e:
             print(f"[ERROR] mark_present failed: {e}")
 
@@ -197,3 +234,4 @@ def stop_cam_for_session(session_id):
     w = _WORKERS.pop(session_id, None)
     if w:
         w.stop()
+        w.state.invalidate()
@@ -0,0 +1,167 @@
+# apps/academics/gallery_snapshot.py
+"""
+Compiled gallery snapshots, one per CourseAssignment.
+
+    <FACE_GALLERY_DIR>/ca_<id>.r<rev>.npy    (N, D) float32, rows L2-normalized
+    <FACE_GALLERY_DIR>/ca_<id>.r<rev>.json   aligned roster: student_ids, user_ids, display
+
+<rev> is GalleryVersion.rev, bumped by signals whenever an enrollment of the
+section or a member's template changes, so a stale file is never reused.
+Workers open the matrix with np.load(mmap_mode="r"): milliseconds instead
+of the Enrollment/Student/User/template join, and every process serving
+the same section shares the same page-cache pages.
+"""
+import os
+import json
+import time
+from typing import NamedTuple, Optional
+import numpy as np
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.db.models import F
+
+_KEEP_REVISIONS = 2   # older files are pruned after a new snapshot is written
+
+
+class GallerySnapshot(NamedTuple):
+    course_assignment_id: int
+    rev: int
+    student_ids: list
+    user_ids: list
+    matrix: Optional[np.ndarray]     # read-only memmap (N, D), or None when empty
+    display: dict                    # student_id -> display string
+
+
+# ---------------- version counter ----------------
+def gallery_version(course_assignment_id) -> int:
+    GalleryVersion = django_apps.get_model("academics", "GalleryVersion")
+    rev = (GalleryVersion.objects.filter(course_assignment_id=course_assignment_id)
+           .values_list("rev", flat=True).first())
+    return int(rev or 0)
+
+
+def bump_gallery_version(course_assignment_ids):
+    GalleryVersion = django_apps.get_model("academics", "GalleryVersion")
+    for ca_id in set(course_assignment_ids):
+        if not GalleryVersion.objects.filter(course_assignment_id=ca_id).update(rev=F("rev") + 1):
+            _, created = GalleryVersion.objects.get_or_create(course_assignment_id=ca_id, defaults={"rev": 1})
+            if not created:
+                GalleryVersion.objects.filter(course_assignment_id=ca_id).update(rev=F("rev") + 1)
+
+
+def bump_for_user(user_id):
+    """A user's template changed: bump every section they are enrolled in."""
+    Enrollment = django_apps.get_model("academics", "Enrollment")
+    bump_gallery_version(Enrollment.objects.filter(student__user_id=user_id)
+                         .values_list("course_assignment_id", flat=True))
+
+
+# ---------------- files ----------------
+def _gallery_dir():
+    return str(getattr(settings, "FACE_GALLERY_DIR", os.path.join("var", "galleries")))
+
+
+def snapshot_paths(course_assignment_id, rev):
+    base = os.path.join(_gallery_dir(), f"ca_{int(course_assignment_id)}.r{int(rev)}")
+    return base + ".npy", base + ".json"
+
+
+def _write_atomic(path, write):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def _prune(course_assignment_id, keep_rev):
+    prefix = f"ca_{int(course_assignment_id)}.r"
+    revs = set()
+    for name in os.listdir(_gallery_dir()):
+        if name.startswith(prefix) and name.endswith(".json"):
+            try:
+                revs.add(int(name[len(prefix):-len(".json")]))
+            except ValueError:
+                pass
+    for rev in sorted(revs)[:-_KEEP_REVISIONS]:
+        if rev == keep_rev:
+            continue
+        for p in snapshot_paths(course_assignment_id, rev):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+
+def build_snapshot(course_assignment_id, rev=None) -> GallerySnapshot:
+    """Compile the section's gallery from the database and write it to disk."""
+    from .whitelist import load_assignment_whitelist
+    rev = gallery_version(course_assignment_id) if rev is None else rev  # read before the data
+    t0 = time.time()
+    stu_ids, user_ids, emb_mat, display = load_assignment_whitelist(course_assignment_id)
+    os.makedirs(_gallery_dir(), exist_ok=True)
+    npy, meta = snapshot_paths(course_assignment_id, rev)
+    if emb_mat is None:
+        emb_mat = np.zeros((0, 0), dtype=np.float32)
+    mat = np.ascontiguousarray(emb_mat, dtype=np.float32)
+    mat /= (np.linalg.norm(mat, axis=1, keepdims=True) + 1e-8) if mat.size else 1.0
+    _write_atomic(npy, lambda f: np.save(f, mat))
+    roster = {"course_assignment_id": int(course_assignment_id), "rev": int(rev),
+              "student_ids": [int(s) for s in stu_ids], "user_ids": [int(u) for u in user_ids],
+              "display": {str(k): v for k, v in display.items()}}
+    # roster goes last: a snapshot exists once its .json does
+    _write_atomic(meta, lambda f: f.write(json.dumps(roster).encode("utf-8")))
+    _prune(course_assignment_id, rev)
+    print(f"[GALLERY] compiled ca={course_assignment_id} r{rev}: {len(stu_ids)} rows in {time.time() - t0:.2f}s")
+    return _open(course_assignment_id, rev)
+
+
+def _open(course_assignment_id, rev) -> Optional[GallerySnapshot]:
+    npy, meta = snapshot_paths(course_assignment_id, rev)
+    try:
+        with open(meta, "rb") as f:
+            roster = json.loads(f.read().decode("utf-8"))
+        matrix = np.load(npy, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    return GallerySnapshot(
+        course_assignment_id=int(course_assignment_id), rev=int(rev),
+        student_ids=roster["student_ids"], user_ids=roster["user_ids"],
+        matrix=matrix if matrix.size else None,
+        display={int(k): v for k, v in roster["display"].items()},
+    )
+
+
+def open_snapshot(course_assignment_id, build_if_stale=True) -> Optional[GallerySnapshot]:
+    """Memory-map the current snapshot; compile it first when missing or stale."""
+    rev = gallery_version(course_assignment_id)
+    snap = _open(course_assignment_id, rev)
+    if snap is None and build_if_stale:
+        snap = build_snapshot(course_assignment_id, rev)
+    return snap
+
+
+def load_session_gallery(session):
+    """Drop-in for whitelist.load_session_whitelist() served from the snapshot."""
+    snap = open_snapshot(session.course_assignment_id)
+    return snap.student_ids, snap.user_ids, snap.matrix, snap.display
+
+
+def refresh_snapshots(lookahead_min=30) -> int:
+    """
+    Background job: compile stale snapshots for sections with a session
+    running or starting within `lookahead_min`, so workers start warm.
+    """
+    from django.utils import timezone
+    Session = django_apps.get_model("academics", "Session")
+    now = timezone.now()
+    ca_ids = set(Session.objects.filter(end_time__gt=now,
+                                        start_time__lte=now + timezone.timedelta(minutes=lookahead_min))
+                 .exclude(status=Session.STATUS_STOPPED)
+                 .values_list("course_assignment_id", flat=True))
+    built = 0
+    for ca_id in ca_ids:
+        rev = gallery_version(ca_id)
+        if not os.path.exists(snapshot_paths(ca_id, rev)[1]):
+            build_snapshot(ca_id, rev)
+            built += 1
+    return built
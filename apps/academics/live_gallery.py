@@ -0,0 +1,146 @@
+# apps/academics/live_gallery.py
+import time
+import threading
+from typing import NamedTuple, Optional
+import numpy as np
+from .gallery_snapshot import gallery_version, open_snapshot
+from .whitelist import SessionRoster
+
+GALLERY_POLL_S = 10.0   # how often a worker checks its section's GalleryVersion
+_TOMBSTONE = -1         # row of a dropped student; zero vector, never matches
+
+
+class GalleryView(NamedTuple):
+    """Everything the recognition loop needs for one frame, swapped as a unit."""
+    rev: int
+    user_ids: tuple           # row -> auth User id (_TOMBSTONE for freed rows)
+    student_ids: tuple        # row -> Student id   (_TOMBSTONE for freed rows)
+    matrix: Optional[np.ndarray]
+    matcher: object           # matrix or TemplateGallery, for top_k()/best_matches()
+    roster: SessionRoster
+    display: dict             # student_id -> display string
+
+
+class LiveGallery(threading.Thread):
+    """
+    Keeps a worker's gallery in step with its section while recognition runs.
+
+    Polls GalleryVersion.rev (one primary-key lookup) every `poll_s`. On a
+    change it opens the current snapshot and applies only the delta to a
+    copy of the live matrix: updated templates overwrite their row, dropped
+    students become zeroed tombstone rows, new students reuse tombstones or
+    are appended. Existing rows keep their index, so the roster re-reads and
+    the matcher re-clusters only the rows that changed. The new GalleryView is
+    published with one reference swap, so the recognition thread never waits
+    and never sees a half-applied update: read `.view` once per frame.
+    """
+
+    def __init__(self, course_assignment_id, poll_s=GALLERY_POLL_S, log_prefix="[GALLERY]"):
+        super().__init__(daemon=True, name=f"gallery-{course_assignment_id}")
+        self.course_assignment_id = course_assignment_id
+        self.poll_s = poll_s
+        self.log_prefix = log_prefix
+        self._stop_evt = threading.Event()
+        self.reloads = 0
+        self.added = self.updated = self.removed = 0
+        snap = open_snapshot(course_assignment_id)
+        self.view = self._make_view(snap.rev, snap.user_ids, snap.student_ids, snap.matrix, snap.display)
+
+    def _make_view(self, rev, user_ids, student_ids, matrix, display):
+        from apps.biometrics.services.templates import gallery_for_rows  # models not ready at import
+        user_ids, student_ids = tuple(int(u) for u in user_ids), tuple(int(s) for s in student_ids)
+        matcher = gallery_for_rows(list(user_ids), matrix)
+        roster = SessionRoster.load(self.course_assignment_id, user_ids)
+        return GalleryView(rev, user_ids, student_ids, matrix, matcher, roster, dict(display))
+
+    def check(self) -> Optional[dict]:
+        """Apply pending changes now. Returns the delta counts, or None when up to date."""
+        rev = gallery_version(self.course_assignment_id)
+        if rev == self.view.rev:
+            return None
+        t0 = time.time()
+        snap = open_snapshot(self.course_assignment_id)
+        delta = self._apply(snap)
+        self.reloads += 1
+        print(f"{self.log_prefix} r{snap.rev}: +{delta['added']} ~{delta['updated']} -{delta['removed']} "
+              f"({len(self)} rows, {(time.time() - t0) * 1000:.0f} ms)")
+        return delta
+
+    def _apply(self, snap) -> dict:
+        cur = self.view
+        user_ids, student_ids = list(cur.user_ids), list(cur.student_ids)
+        row_of = {u: i for i, u in enumerate(user_ids) if u != _TOMBSTONE}
+        new_row = {int(u): i for i, u in enumerate(snap.user_ids)}
+        new_mat = snap.matrix
+        dim = new_mat.shape[1] if new_mat is not None else (cur.matrix.shape[1] if cur.matrix is not None else 0)
+        mat = (np.array(cur.matrix, dtype=np.float32) if cur.matrix is not None
+               else np.zeros((0, dim), dtype=np.float32))
+
+        # templates retrained in place
+        common = [u for u in row_of if u in new_row]
+        touched = []    # row indexes whose template or user changed
+        if common and new_mat is not None:
+            ci = np.array([row_of[u] for u in common])
+            ni = np.array([new_row[u] for u in common])
+            changed = np.any(mat[ci] != new_mat[ni], axis=1)
+            mat[ci[changed]] = new_mat[ni[changed]]
+            touched += ci[changed].tolist()
+        updated = len(touched)
+
+        # dropped students / lost templates -> tombstones
+        removed = [u for u in row_of if u not in new_row]
+        for u in removed:
+            i = row_of[u]
+            mat[i] = 0.0
+            user_ids[i] = student_ids[i] = _TOMBSTONE
+            touched.append(i)
+
+        # new rows fill tombstones first, then append
+        added = [u for u in new_row if u not in row_of]
+        free = [i for i, u in enumerate(user_ids) if u == _TOMBSTONE]
+        extra = []
+        for u in added:
+            vec, sid = new_mat[new_row[u]], int(snap.student_ids[new_row[u]])
+            if free:
+                i = free.pop(0)
+                mat[i], user_ids[i], student_ids[i] = vec, u, sid
+                touched.append(i)
+            else:
+                extra.append(vec)
+                user_ids.append(u)
+                student_ids.append(sid)
+        if extra:
+            mat = np.vstack([mat, np.asarray(extra, dtype=np.float32)])
+
+        from apps.biometrics.services.templates import update_gallery_rows  # models not ready at import
+        matrix = mat if mat.size else None
+        if touched or extra:
+            # appended rows are new to both; the roster re-reads renamed students too
+            matcher = update_gallery_rows(cur.matcher, user_ids, matrix, touched)
+            roster = cur.roster.with_rows(user_ids, touched + cur.roster.renamed_rows(snap.display))
+        else:
+            # no row changed (an enrollment status or a name did): same matcher, re-read roster
+            matcher, roster = cur.matcher, cur.roster.reload()
+        self.view = GalleryView(snap.rev, tuple(int(u) for u in user_ids), tuple(int(s) for s in student_ids),
+                                matrix, matcher, roster, dict(snap.display))
+        self.added += len(added)
+        self.updated += updated
+        self.removed += len(removed)
+        return {"added": len(added), "updated": updated, "removed": len(removed)}
+
+    def __len__(self):
+        return sum(1 for u in self.view.user_ids if u != _TOMBSTONE)
+
+    def run(self):
+        while not self._stop_evt.wait(self.poll_s):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"{self.log_prefix} reload failed: {e}")
+
+    def stop(self):
+        self._stop_evt.set()
+
+    def stats(self):
+        return {"rev": self.view.rev, "rows": len(self), "reloads": self.reloads,
+                "added": self.added, "updated": self.updated, "removed": self.removed}
@@ -252,3 +252,18 @@ class Attendance(models.Model):
     def __str__(self):
         return f"{self.student} - {self.session} - {self.status}"
 
+
+
+class GalleryVersion(models.Model):
+    """
+    Per-section gallery revision: bumped (apps.academics.signals) whenever an
+    Enrollment of the section or a member's face template changes. Compiled
+    gallery snapshots are keyed by it and live workers poll it.
+    """
+    course_assignment = models.OneToOneField(CourseAssignment, on_delete=models.CASCADE, primary_key=True,
+                                             related_name="gallery_version")
+    rev = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.course_assignment_id} r{self.rev}"
@@ -0,0 +1,147 @@
+# apps/academics/room_sessions.py
+import time
+from django.apps import apps as django_apps
+from django.utils import timezone
+from apps.biometrics.services.matching import best_matches
+from .session_state import SessionState
+from .attendance_writer import AttendanceWriter
+from .live_gallery import LiveGallery
+
+ROOM_POLL_S = 5.0    # how often a room worker looks for sessions to attach / detach
+
+
+class AttachedSession:
+    """Per-session state inside a room worker."""
+
+    def __init__(self, session_id, gallery, log_prefix="[ROOM]"):
+        self.session_id = session_id
+        self.state = SessionState(session_id)
+        self.gallery = gallery
+        self.writer = AttendanceWriter(session_id, log_prefix=f"{log_prefix}[ATTENDANCE {session_id}]")
+        self.writer.start()
+        self.last_mark_by_user = {}     # cooldown: user_id -> last_ts
+        self.attached_at = time.time()
+
+    @property
+    def course_assignment_id(self):
+        return self.state.course_assignment_id
+
+
+class RoomSessions:
+    """
+    The sessions a room-scoped camera worker currently serves.
+
+    sync() attaches every running session of the room (own SessionState and
+    AttendanceWriter; LiveGallery shared per course_assignment) and detaches
+    the ones that ended, flushing their marks, without touching the camera.
+    match() scores faces against the union of the attached galleries; a
+    match is then routed to each attached session whose roster enrolls
+    that user (a student in two overlapping sections is marked in both).
+    """
+
+    def __init__(self, room_id, poll_s=ROOM_POLL_S, log_prefix=None):
+        self.room_id = room_id
+        self.poll_s = poll_s
+        self.log_prefix = log_prefix or f"[ROOM {room_id}]"
+        self.sessions = {}          # session_id -> AttachedSession
+        self._galleries = {}        # course_assignment_id -> [LiveGallery, attached sessions]
+        self._synced_ts = 0.0
+        self.attached_total = self.detached_total = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def running_session_ids(self):
+        # same rule as the supervisor and SessionState: a professor may start a
+        # session before its scheduled start_time, so only status and end_time count
+        Session = django_apps.get_model("academics", "Session")
+        return set(Session.objects.filter(room_id=self.room_id, status=Session.STATUS_RUNNING,
+                                          end_time__gt=timezone.now())
+                   .values_list("id", flat=True))
+
+    def sync(self, force=False):
+        """Attach new running sessions, detach ended ones. Returns (attached, detached) ids."""
+        now_ts = time.time()
+        if not force and now_ts - self._synced_ts < self.poll_s:
+            return [], []
+        self._synced_ts = now_ts
+        running = self.running_session_ids()
+        detached = [s for s, ctx in self.sessions.items() if s not in running or not ctx.state.check()[0]]
+        for s in detached:
+            self.detach(s)
+        attached = []
+        for s in sorted(running - set(self.sessions)):
+            self.attach(s)
+            attached.append(s)
+        return attached, detached
+
+    def _gallery_for(self, ca_id):
+        entry = self._galleries.get(ca_id)
+        if entry is None:
+            gallery = LiveGallery(ca_id, log_prefix=f"{self.log_prefix}[GALLERY ca={ca_id}]")
+            gallery.start()
+            entry = self._galleries[ca_id] = [gallery, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def attach(self, session_id):
+        Session = django_apps.get_model("academics", "Session")
+        ca_id = Session.objects.filter(id=session_id).values_list("course_assignment_id", flat=True).get()
+        ctx = AttachedSession(session_id, self._gallery_for(ca_id), log_prefix=self.log_prefix)
+        self.sessions[session_id] = ctx
+        self.attached_total += 1
+        print(f"{self.log_prefix} attached session {session_id} (ca={ca_id}, {len(ctx.gallery)} students; "
+              f"{len(self.sessions)} session(s) in room)")
+        return ctx
+
+    def detach(self, session_id):
+        ctx = self.sessions.pop(session_id, None)
+        if ctx is None:
+            return
+        ctx.writer.stop()   # flush pending marks
+        entry = self._galleries.get(ctx.course_assignment_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                entry[0].stop()
+                del self._galleries[ctx.course_assignment_id]
+        self.detached_total += 1
+        print(f"{self.log_prefix} detached session {session_id} "
+              f"(writer={ctx.writer.stats()}; {len(self.sessions)} session(s) left)")
+
+    def views(self):
+        """One consistent gallery view per attached course_assignment, for this frame."""
+        return {ca_id: entry[0].view for ca_id, entry in self._galleries.items()}
+
+    def match(self, embs, views=None):
+        """[(user_id or None, sim)] per embedding, best over the union of attached galleries."""
+        views = self.views() if views is None else views
+        F = embs.shape[0]
+        best = [(None, -1.0)] * F
+        for view in views.values():
+            if view.matrix is None:
+                continue
+            for i, (uid, sim) in enumerate(best_matches(embs, view.user_ids, view.matcher)):
+                if sim > best[i][1]:
+                    best[i] = (uid, sim)
+        return best
+
+    def route(self, user_id, views=None):
+        """[(AttachedSession, roster entry)] for every attached session enrolling user_id."""
+        views = self.views() if views is None else views
+        out = []
+        for ctx in self.sessions.values():
+            view = views.get(ctx.course_assignment_id)
+            entry = view.roster.for_user(user_id) if view is not None else None
+            if entry is not None:
+                out.append((ctx, entry))
+        return out
+
+    def close(self):
+        for s in list(self.sessions):
+            self.detach(s)
+
+    def stats(self):
+        return {"sessions": sorted(self.sessions), "galleries": len(self._galleries),
+                "rows": sum(len(e[0]) for e in self._galleries.values()),
+                "attached": self.attached_total, "detached": self.detached_total}
@@ -5,6 +5,8 @@ from django.apps import apps as django_apps
 import atexit
 from .cam_worker_insight import stop_cam_for_session
 from apps.biometrics.session_worker import launch_face_worker
+from .session_state import invalidate_session_state
+from .gallery_snapshot import refresh_snapshots
 
 _scheduler = None
 
@@ -23,7 +25,7 @@ def start_due_sessions():
         s.save(update_fields=["status"])
         updated += 1
 
-        launch_face_worker(s.id)
+        launch_face_worker(s.id, wait_s=0)   # face_supervisor.py picks the request up
         print(f"[AUTO START] Session {s.id} started at {now}")
     return updated
 
@@ -52,9 +54,12 @@ def start_scheduler():
     # Run both jobs every 15–30s (tune as you like)
     _scheduler.add_job(start_due_sessions, "interval", seconds=15, id="auto_start_sessions", replace_existing=True)
     _scheduler.add_job(stop_expired_sessions,  "interval", seconds=15, id="auto_stop_sessions",  replace_existing=True)
+    # compile gallery snapshots ahead of upcoming sessions so workers start warm
+    _scheduler.add_job(refresh_snapshots, "interval", seconds=60, id="gallery_snapshots", replace_existing=True)
+    # session workers and the warm pool are owned by the face_supervisor.py process
     _scheduler.start()
     atexit.register(lambda: _scheduler.shutdown(wait=False))
-    print("Scheduler started with jobs: auto_start_sessions, auto_stop_sessions")
+    print("Scheduler started with jobs: auto_start_sessions, auto_stop_sessions, gallery_snapshots")
 
 
 def stop_expired_sessions():
@@ -64,5 +69,6 @@ def stop_expired_sessions():
     for s in qs:
         s.status = Session.STATUS_STOPPED
         s.save(update_fields=["status"])
+        invalidate_session_state(s.id)
         stop_cam_for_session(s.id)
         print(f"[AUTO STOP] Session {s.id} stopped")
@@ -0,0 +1,127 @@
+# apps/academics/session_state.py
+import os
+import time
+import threading
+import weakref
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.utils import timezone
+
+STATE_REFRESH_S = 10.0   # re-read the Session row at most this often
+STATE_POLL_S    = 1.0    # check the invalidation file at most this often
+
+_LIVE = {}               # session_id -> WeakSet[SessionState] in this process
+_LIVE_LOCK = threading.Lock()
+
+
+def _rev_path(session_id):
+    # a file, not the cache: the default cache is per-process (LocMemCache) and
+    # the recognition workers are separate processes on the same host
+    state_dir = str(getattr(settings, "FACE_STATE_DIR", os.path.join("var", "session_state")))
+    return os.path.join(state_dir, f"session_{int(session_id)}.rev")
+
+
+def _read_rev(session_id):
+    try:
+        with open(_rev_path(session_id)) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+class SessionState:
+    """
+    Cached run-state of one Session for the recognition loops.
+
+    check() answers "keep running?" from local fields (status, end_time)
+    without touching the database; the row is re-read every `refresh_s`
+    seconds, or right away after invalidate_session_state() (e.g. the
+    professor pressed Stop).
+    """
+
+    def __init__(self, session_id, refresh_s=STATE_REFRESH_S, poll_s=STATE_POLL_S):
+        self.session_id = session_id
+        self.refresh_s = refresh_s
+        self.poll_s = poll_s
+        self.status = None
+        self.start_time = None
+        self.end_time = None
+        self.course_assignment_id = None
+        self.room_id = None
+        self._stale = True
+        self._loaded_ts = 0.0
+        self._polled_ts = 0.0
+        self._rev = _read_rev(session_id)
+        with _LIVE_LOCK:
+            _LIVE.setdefault(session_id, weakref.WeakSet()).add(self)
+        self.refresh()
+
+    def refresh(self):
+        Session = django_apps.get_model("academics", "Session")
+        row = (Session.objects.filter(id=self.session_id)
+               .values("status", "start_time", "end_time", "course_assignment_id", "room_id")
+               .first())
+        if row is None:
+            self.status = None
+        else:
+            self.status = row["status"]
+            self.start_time = row["start_time"]
+            self.end_time = row["end_time"]
+            self.course_assignment_id = row["course_assignment_id"]
+            self.room_id = row["room_id"]
+        self._stale = False
+        self._loaded_ts = time.time()
+
+    def invalidate(self):
+        self._stale = True
+
+    def _poll_invalidation(self, now_ts):
+        if now_ts - self._polled_ts < self.poll_s:
+            return
+        self._polled_ts = now_ts
+        rev = _read_rev(self.session_id)
+        if rev != self._rev:
+            self._rev = rev
+            self._stale = True
+
+    def check(self, now=None):
+        """Return (running: bool, reason: str). No DB access unless a refresh is due."""
+        now_ts = time.time()
+        self._poll_invalidation(now_ts)
+        if self._stale or now_ts - self._loaded_ts >= self.refresh_s:
+            self.refresh()
+
+        now = now or timezone.now()
+        if self.status is None:
+            return False, "session deleted"
+        if self.status != "running":
+            return False, f"status is {self.status}"
+        if self.end_time and now >= self.end_time:
+            return False, f"reached end_time={self.end_time}"
+        return True, ""
+
+    def attendance_status(self, now=None, grace_min=10):
+        """Present within `grace_min` minutes of start_time, Late afterwards."""
+        now = now or timezone.now()
+        return "Present" if now <= (self.start_time + timezone.timedelta(minutes=grace_min)) else "Late"
+
+
+def invalidate_session_state(session_id):
+    """
+    Force every SessionState for this session to re-read the row: holders in
+    this process immediately, worker processes within `poll_s` (they poll a
+    small per-session file under FACE_STATE_DIR). Call it after saving the row.
+    """
+    path = _rev_path(session_id)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w") as f:
+            f.write(f"{time.time_ns()}:{os.getpid()}")   # unique per call, never reused
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[STATE] could not signal session {session_id}: {e}")
+    with _LIVE_LOCK:
+        holders = list(_LIVE.get(session_id, ()))
+    for st in holders:
+        st.invalidate()
@@ -0,0 +1,15 @@
+# apps/academics/signals.py
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Enrollment
+from .gallery_snapshot import bump_gallery_version, bump_for_user
+
+
+@receiver([post_save, post_delete], sender=Enrollment)
+def _enrollment_changed(sender, instance, **kwargs):
+    bump_gallery_version([instance.course_assignment_id])
+
+
+@receiver([post_save, post_delete], sender="biometrics.UserEmbeddingTemplate")
+def _template_changed(sender, instance, **kwargs):
+    bump_for_user(instance.user_id)
@@ -1,3 +1,412 @@
-from django.test import TestCase
+import os
+import time
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from apps.accounts.models import User
+from .models import (
+    Department, Professor, Course, CourseAssignment, Room, Session, Student, Enrollment, Attendance,
+)
+from .attendance_writer import AttendanceWriter
+from .live_gallery import LiveGallery, _TOMBSTONE
+from . import gallery_snapshot
+from .gallery_snapshot import gallery_version, open_snapshot, build_snapshot, snapshot_paths
+from .whitelist import SessionRoster, load_assignment_whitelist
+from . import session_state
+from .session_state import SessionState, invalidate_session_state
+from apps.biometrics.models import UserEmbeddingTemplate
+from apps.biometrics.services.vectors import pack_vector
+from apps.biometrics.services import templates
 
-# Create your tests here.
+
+def make_session(n_students=2):
+    dept = Department.objects.create(name="D", code="D")
+    prof = Professor.objects.create(user=User.objects.create(username="prof"), department=dept)
+    course = Course.objects.create(code="C1", title="t", department=dept)
+    ca = CourseAssignment.objects.create(course=course, professor=prof, term="F")
+    room = Room.objects.create(name="R", latitude=0, longitude=0)
+    now = timezone.now()
+    session = Session.objects.create(course_assignment=ca, room=room, start_time=now,
+                                     end_time=now + timezone.timedelta(hours=1), status=Session.STATUS_RUNNING)
+    students = []
+    for i in range(n_students):
+        st, _ = Student.objects.get_or_create(user=User.objects.create(username=f"s{i}"))
+        Enrollment.objects.create(student=st, course_assignment=ca, status="approved")
+        students.append(st)
+    return session, students
+
+
+class AttendanceWriterTests(TestCase):
+    def setUp(self):
+        self.session, self.students = make_session(2)
+        self.s1, self.s2 = (st.id for st in self.students)
+
+    def rows(self):
+        return {a.student_id: (a.face_conf, a.status, a.method)
+                for a in Attendance.objects.filter(session=self.session)}
+
+    def test_batches_sightings_into_one_flush(self):
+        w = AttendanceWriter(self.session.id)
+        w.submit(self.s1, 0.60, "Present")
+        w.submit(self.s1, 0.75, "Late")        # better sim, later sighting
+        w.submit(self.s2, 0.55, "Present")
+        self.assertEqual(Attendance.objects.count(), 0)   # nothing written on submit
+        w.flush()
+        self.assertEqual(self.rows(), {self.s1: (0.75, "Present", "face"), self.s2: (0.55, "Present", "face")})
+        self.assertEqual(w.stats()["flushes"], 1)
+        self.assertEqual(w.stats()["created"], 2)
+
+    def test_existing_row_only_raises_face_conf(self):
+        w = AttendanceWriter(self.session.id)
+        w.submit(self.s1, 0.60, "Present")
+        w.flush()
+        w.submit(self.s1, 0.50, "Late")        # lower than persisted: dropped
+        w.flush()
+        self.assertEqual(w.stats()["flushes"], 1)
+        w.submit(self.s1, 0.90, "Late")
+        w.flush()
+        self.assertEqual(self.rows(), {self.s1: (0.90, "Present", "face")})
+        self.assertEqual(w.stats()["updated"], 1)
+
+    def test_two_writers_same_student_yield_one_row(self):
+        a, b = AttendanceWriter(self.session.id), AttendanceWriter(self.session.id)
+        a.submit(self.s1, 0.70, "Present")
+        b.submit(self.s1, 0.80, "Present")
+        a.flush()
+        b.flush()
+        self.assertEqual(self.rows(), {self.s1: (0.80, "Present", "face")})
+
+    def test_concurrent_create_is_ignored_not_duplicated(self):
+        a, b = AttendanceWriter(self.session.id), AttendanceWriter(self.session.id)
+        a.submit(self.s1, 0.70, "Present")
+        b.submit(self.s1, 0.65, "Present")
+        real_bulk_create = Attendance.objects.bulk_create
+        raced = []
+
+        def racing_bulk_create(objs, **kwargs):
+            if not raced:   # the other worker commits the same student between b's read and insert
+                raced.append(True)
+                a.flush()
+            return real_bulk_create(objs, **kwargs)
+
+        with mock.patch.object(Attendance.objects, "bulk_create", side_effect=racing_bulk_create):
+            b.flush()
+        self.assertEqual(Attendance.objects.filter(session=self.session, student_id=self.s1).count(), 1)
+        self.assertEqual(self.rows()[self.s1][0], 0.70)
+        self.assertEqual((a.stats()["created"], b.stats()["created"], b.stats()["updated"]), (1, 0, 0))
+
+    def test_lost_create_race_still_raises_face_conf(self):
+        a, b = AttendanceWriter(self.session.id), AttendanceWriter(self.session.id)
+        a.submit(self.s1, 0.60, "Present")
+        b.submit(self.s1, 0.90, "Late")
+        b.submit(self.s2, 0.50, "Late")
+        real_bulk_create = Attendance.objects.bulk_create
+        raced = []
+
+        def racing_bulk_create(objs, **kwargs):
+            if not raced:
+                raced.append(True)
+                a.flush()
+            return real_bulk_create(objs, **kwargs)
+
+        with mock.patch.object(Attendance.objects, "bulk_create", side_effect=racing_bulk_create):
+            b.flush()
+        # a's row (and status) wins the insert; b only raises its face_conf
+        self.assertEqual(self.rows(), {self.s1: (0.90, "Present", "face"), self.s2: (0.50, "Late", "face")})
+        self.assertEqual((b.stats()["created"], b.stats()["updated"]), (1, 1))
+
+
+class AttendanceWriterThreadTests(TransactionTestCase):
+    def test_stop_flushes_pending_marks(self):
+        session, students = make_session(1)
+        w = AttendanceWriter(session.id, flush_s=3600)
+        w.start()
+        w.submit(students[0].id, 0.8, "Present")
+        w.stop()
+        self.assertFalse(w.is_alive())
+        self.assertEqual(Attendance.objects.filter(session=session).count(), 1)
+
+
+def _vec(seed, d=16):
+    v = np.random.default_rng(seed).standard_normal(d).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+class GalleryTestCase(TestCase):
+    """Section with three templated students; snapshots go to a temp FACE_GALLERY_DIR."""
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        settings_override = override_settings(FACE_GALLERY_DIR=tmp, FACE_GALLERY_TEMPLATES=1)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.session, self.students = make_session(3)
+        self.ca_id = self.session.course_assignment_id
+        for i, st in enumerate(self.students):
+            self.set_template(st, _vec(i))
+
+    def set_template(self, student, vec):
+        UserEmbeddingTemplate.objects.update_or_create(user_id=student.user_id,
+                                                       defaults={"centroid": pack_vector(vec)})
+
+
+class GallerySnapshotTests(GalleryTestCase):
+    def test_template_save_bumps_every_section_of_the_user(self):
+        st = self.students[0]
+        other_ca = CourseAssignment.objects.create(course=self.session.course_assignment.course,
+                                                   professor=self.session.course_assignment.professor, term="S")
+        Enrollment.objects.create(student=st, course_assignment=other_ca, status="approved")
+        revs = gallery_version(self.ca_id), gallery_version(other_ca.id)
+        self.set_template(st, _vec(10))
+        self.assertEqual((gallery_version(self.ca_id), gallery_version(other_ca.id)), (revs[0] + 1, revs[1] + 1))
+        UserEmbeddingTemplate.objects.filter(user_id=st.user_id).delete()
+        self.assertEqual(gallery_version(self.ca_id), revs[0] + 2)
+
+    def test_enrollment_changes_bump_the_section(self):
+        rev = gallery_version(self.ca_id)
+        e = Enrollment.objects.get(student=self.students[0])
+        e.status = "dropped"
+        e.save()
+        self.assertEqual(gallery_version(self.ca_id), rev + 1)
+        e.delete()
+        self.assertEqual(gallery_version(self.ca_id), rev + 2)
+
+    def test_open_snapshot_follows_the_version(self):
+        snap = open_snapshot(self.ca_id)
+        self.assertEqual(sorted(snap.user_ids), sorted(s.user_id for s in self.students))
+        with mock.patch.object(gallery_snapshot, "build_snapshot") as build:
+            self.assertEqual(open_snapshot(self.ca_id).rev, snap.rev)     # current file: no rebuild
+        build.assert_not_called()
+
+        st = self.students[1]
+        self.set_template(st, _vec(10))
+        Enrollment.objects.filter(student=self.students[2]).delete()
+        new = open_snapshot(self.ca_id)
+        self.assertEqual(new.rev, gallery_version(self.ca_id))
+        self.assertGreater(new.rev, snap.rev)
+        self.assertNotIn(self.students[2].user_id, new.user_ids)
+        np.testing.assert_allclose(new.matrix[new.user_ids.index(st.user_id)], _vec(10), atol=1e-6)
+        self.assertEqual(new.display[st.id], st.user.username)
+        self.assertIsNone(open_snapshot(self.ca_id + 1000, build_if_stale=False))
+
+    def test_prune_keeps_the_current_revision(self):
+        def on_disk(rev):
+            return all(os.path.exists(p) for p in snapshot_paths(self.ca_id, rev))
+
+        for rev in (1, 2, 3, 4):
+            build_snapshot(self.ca_id, rev)
+        self.assertEqual([on_disk(r) for r in (1, 2, 3, 4)], [False, False, True, True])
+        build_snapshot(self.ca_id, 1)          # a slow builder finishing an old revision
+        self.assertEqual([on_disk(r) for r in (1, 3, 4)], [True, True, True])
+        build_snapshot(self.ca_id, 5)
+        self.assertEqual([on_disk(r) for r in (1, 3, 4, 5)], [False, False, True, True])
+
+
+class LiveGalleryTests(GalleryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.gallery = LiveGallery(self.ca_id)
+        self.rows = {u: i for i, u in enumerate(self.gallery.view.user_ids)}
+
+    def test_updated_template_rewrites_only_its_row(self):
+        st = self.students[1]
+        before = self.gallery.view
+        self.set_template(st, _vec(10))
+        with mock.patch.object(SessionRoster, "load", wraps=SessionRoster.load) as load:
+            self.assertEqual(self.gallery.check(), {"added": 0, "updated": 1, "removed": 0})
+        load.assert_called_once_with(self.ca_id, [st.user_id])
+        view, i = self.gallery.view, self.rows[st.user_id]
+        self.assertEqual(view.user_ids, before.user_ids)
+        np.testing.assert_allclose(view.matrix[i], _vec(10), atol=1e-6)
+        np.testing.assert_array_equal(np.delete(view.matrix, i, 0), np.delete(before.matrix, i, 0))
+        self.assertIs(view.matcher, view.matrix)
+        self.assertEqual(view.roster.for_row(i), before.roster.for_row(i))
+        self.assertIsNone(self.gallery.check())
+
+    def test_dropped_student_becomes_a_tombstone(self):
+        st = self.students[0]
+        Enrollment.objects.filter(student=st).delete()
+        self.assertEqual(self.gallery.check(), {"added": 0, "updated": 0, "removed": 1})
+        view, i = self.gallery.view, self.rows[st.user_id]
+        self.assertEqual((view.user_ids[i], view.student_ids[i]), (_TOMBSTONE, _TOMBSTONE))
+        self.assertFalse(view.matrix[i].any())
+        self.assertIsNone(view.roster.for_row(i))
+        self.assertIsNone(view.roster.for_user(st.user_id))
+        self.assertEqual(len(self.gallery), 2)
+        self.assertEqual(view.roster.for_user(self.students[1].user_id).student_id, self.students[1].id)
+
+    def test_reenrolled_student_reuses_the_tombstone(self):
+        st = self.students[0]
+        Enrollment.objects.filter(student=st).delete()
+        self.gallery.check()
+        Enrollment.objects.create(student=st, course_assignment_id=self.ca_id, status="approved")
+        self.assertEqual(self.gallery.check(), {"added": 1, "updated": 0, "removed": 0})
+        view, i = self.gallery.view, self.rows[st.user_id]
+        self.assertEqual(len(view.user_ids), 3)
+        self.assertEqual((view.user_ids[i], view.student_ids[i]), (st.user_id, st.id))
+        self.assertEqual(view.roster.for_row(i).student_id, st.id)
+        np.testing.assert_allclose(view.matrix[i], _vec(0), atol=1e-6)
+
+    def test_new_student_is_appended(self):
+        user = User.objects.create(username="late")
+        st, _ = Student.objects.get_or_create(user=user)
+        Enrollment.objects.create(student=st, course_assignment_id=self.ca_id, status="approved")
+        self.set_template(st, _vec(20))
+        self.assertEqual(self.gallery.check()["added"], 1)
+        view = self.gallery.view
+        self.assertEqual(view.user_ids[3], user.id)
+        self.assertEqual(view.roster.for_row(3).student_id, st.id)
+        self.assertEqual(view.roster.for_user(self.students[0].user_id).student_id, self.students[0].id)
+
+    def test_status_only_change_keeps_the_matcher(self):
+        before = self.gallery.view
+        Enrollment.objects.filter(student=self.students[2]).update(status="pending")
+        Enrollment.objects.get(student=self.students[2]).save()       # bumps the version
+        self.assertEqual(self.gallery.check(), {"added": 0, "updated": 0, "removed": 0})
+        self.assertIs(self.gallery.view.matcher, before.matcher)
+        self.assertEqual(self.gallery.view.roster.for_user(self.students[2].user_id).enrollment_status, "pending")
+
+    @override_settings(FACE_GALLERY_TEMPLATES=2)
+    def test_template_gallery_reclusters_only_changed_rows(self):
+        fake = {s.user_id: np.stack([_vec(100 + s.id), _vec(200 + s.id)]) for s in self.students}
+        with mock.patch.object(templates, "load_user_templates",
+                               side_effect=lambda ids, k: {int(u): fake[int(u)] for u in ids if int(u) in fake}) as load:
+            gallery = LiveGallery(self.ca_id)
+            st = self.students[1]
+            self.set_template(st, _vec(10))
+            fake[st.user_id] = np.stack([_vec(10), _vec(11)])
+            gallery.check()
+        self.assertEqual(load.call_args_list[-1].args[0], [st.user_id])
+        matcher, i = gallery.view.matcher, self.rows[st.user_id]
+        np.testing.assert_allclose(matcher.templates(i), fake[st.user_id], atol=1e-6)
+        for other in (0, 2):
+            u = self.students[other].user_id
+            np.testing.assert_allclose(matcher.templates(self.rows[u]), fake[u], atol=1e-6)
+
+
+class SessionStateTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        settings_override = override_settings(FACE_STATE_DIR=tmp)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.session, _ = make_session(0)
+        self.now = 1000.0
+        clock = SimpleNamespace(time=lambda: self.now, time_ns=time.time_ns)
+        patcher = mock.patch.object(session_state, "time", clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state = SessionState(self.session.id)     # refresh_s=10, poll_s=1
+
+    def stop_row(self):
+        Session.objects.filter(id=self.session.id).update(status=Session.STATUS_STOPPED)   # no signals
+
+    def check_at(self, t, queries):
+        self.now = 1000.0 + t
+        with self.assertNumQueries(queries):
+            return self.state.check()
+
+    def test_stop_in_another_process_is_seen_within_the_poll(self):
+        self.assertEqual(self.check_at(0, 0), (True, ""))
+        self.stop_row()
+        with mock.patch.dict(session_state._LIVE, clear=True):   # the web process holds no SessionState
+            invalidate_session_state(self.session.id)
+        self.assertEqual(self.check_at(0.5, 0), (True, ""))    # poll not due yet
+        self.assertEqual(self.check_at(1.0, 1), (False, "status is stopped"))
+
+    def test_without_invalidation_the_row_is_reread_every_refresh_s(self):
+        self.stop_row()
+        self.assertEqual(self.check_at(1.0, 0), (True, ""))
+        self.assertEqual(self.check_at(9.9, 0), (True, ""))
+        self.assertEqual(self.check_at(10.0, 1), (False, "status is stopped"))
+
+    def test_holders_in_this_process_are_invalidated_at_once(self):
+        self.stop_row()
+        invalidate_session_state(self.session.id)
+        self.assertEqual(self.check_at(0, 1), (False, "status is stopped"))
+
+    def test_end_time_and_lateness_need_no_query(self):
+        end, start = self.session.end_time, self.session.start_time
+        with self.assertNumQueries(0):
+            self.assertEqual(self.state.check(now=end)[0], False)
+            self.assertEqual(self.state.attendance_status(now=start + timezone.timedelta(minutes=10)), "Present")
+            self.assertEqual(self.state.attendance_status(now=start + timezone.timedelta(minutes=11)), "Late")
+
+    def test_deleted_session(self):
+        Session.objects.filter(id=self.session.id).delete()
+        invalidate_session_state(self.session.id)
+        self.assertEqual(self.check_at(0, 1), (False, "session deleted"))
+
+
+class AssignmentWhitelistTests(GalleryTestCase):
+    def test_one_query_with_aligned_rows(self):
+        user = User.objects.create(username="notpl", first_name="No", last_name="Template")
+        no_tpl, _ = Student.objects.get_or_create(user=user)
+        Enrollment.objects.create(student=no_tpl, course_assignment_id=self.ca_id, status="approved")
+        with self.assertNumQueries(1):
+            student_ids, user_ids, matrix, display = load_assignment_whitelist(self.ca_id)
+        self.assertEqual(student_ids, [st.id for st in self.students])     # enrollment order
+        self.assertEqual(user_ids, [st.user_id for st in self.students])
+        for i in range(3):
+            np.testing.assert_allclose(matrix[i], _vec(i), atol=1e-6)
+        self.assertEqual(display, {**{st.id: st.user.username for st in self.students},
+                                   no_tpl.id: "No Template"})
+
+    def test_section_without_templates(self):
+        UserEmbeddingTemplate.objects.all().delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(load_assignment_whitelist(self.ca_id), ([], [], None, {}))
+        with self.assertNumQueries(1):
+            self.assertEqual(load_assignment_whitelist(self.ca_id + 1000), ([], [], None, {}))
+
+
+class SessionRosterTests(GalleryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.rows = [st.user_id for st in self.students] + [_TOMBSTONE]
+        with self.assertNumQueries(1):
+            self.roster = SessionRoster.load(self.ca_id, self.rows)
+
+    def test_lookups_need_no_queries(self):
+        names = {st.id: st.user.username for st in self.students}
+        with self.assertNumQueries(0):
+            for i, st in enumerate(self.students):
+                e = self.roster.for_row(i)
+                self.assertEqual((e.user_id, e.student_id, e.display, e.enrollment_status),
+                                 (st.user_id, st.id, names[st.id], "approved"))
+                self.assertEqual(self.roster.for_user(str(st.user_id)), e)
+            self.assertIsNone(self.roster.for_row(3))
+            self.assertIsNone(self.roster.for_user(424242))
+            self.assertEqual(len(self.roster), 4)
+            self.assertEqual(self.roster.display_by_student(), names)
+
+    def test_reload_after_an_enrollment_is_dropped(self):
+        dropped, kept = self.students[0], self.students[1]
+        Enrollment.objects.filter(student=dropped).delete()
+        self.assertIsNotNone(self.roster.for_user(dropped.user_id))      # the old roster is immutable
+        fresh = self.roster.reload()
+        self.assertEqual(fresh.row_user_ids, self.roster.row_user_ids)    # same rows, same indexes
+        self.assertIsNone(fresh.for_row(0))
+        self.assertIsNone(fresh.for_user(dropped.user_id))
+        self.assertEqual(fresh.for_row(1).student_id, kept.id)
+
+    def test_status_change_is_visible_after_reload(self):
+        Enrollment.objects.filter(student=self.students[2]).update(status="pending")
+        self.assertEqual(self.roster.reload().for_row(2).enrollment_status, "pending")
+
+    def test_with_rows_rereads_only_the_given_rows(self):
+        Enrollment.objects.filter(student=self.students[0]).delete()
+        Enrollment.objects.filter(student=self.students[1]).update(status="pending")
+        with self.assertNumQueries(1):
+            fresh = self.roster.with_rows(self.rows, [0])
+        self.assertIsNone(fresh.for_row(0))
+        self.assertEqual(fresh.for_row(1).enrollment_status, "approved")   # not re-read
+        self.assertIs(fresh.for_row(2), self.roster.for_row(2))
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.roster.with_rows(self.rows, [])), 4)
@@ -19,6 +19,7 @@ from django.utils import timezone
 from django.apps import apps as django_apps
 from django.core.cache import cache
 from apps.biometrics.session_worker import launch_face_worker, stop_face_worker
+from .session_state import invalidate_session_state
 
 
 def _require_prof(request):
@@ -144,7 +145,16 @@ def session_start(request, session_id: int):
         s.save(update_fields=["status"])
         start_cam_for_session(s.id, cam_source=0)
         cam_source = 1
-        launch_face_worker(s.id, cam_source=cam_source)
+        result = launch_face_worker(s.id, cam_source=cam_source)
+        if result == "queued":
+            messages.warning(request, "All recognition workers are busy; face attendance for this "
+                                      "session starts as soon as one frees up.")
+        elif result == "refused":
+            messages.warning(request, "No recognition worker is available; face attendance is not "
+                                      "running for this session. Use QR attendance or try again later.")
+        elif result == "requested":
+            messages.warning(request, "The recognition supervisor has not answered yet; face attendance "
+                                      "starts once it picks this session up.")
 
    
     # Redirect to LIVE page
@@ -165,6 +175,7 @@ def session_stop(request, session_id: int):
 
     s.status = Session.STATUS_STOPPED
     s.save(update_fields=["status"])
+    invalidate_session_state(s.id)
     stop_cam_for_session(s.id)
     stop_face_worker(session_id)
     messages.success(request, "Session stopped.")
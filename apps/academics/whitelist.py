@@ -1,49 +1,124 @@
 # apps/academics/whitelist.py
+import time
+from typing import NamedTuple
 import numpy as np
 from django.apps import apps as django_apps
+from apps.biometrics.services.vectors import unpack_matrix
 
 def load_session_whitelist(session):
+    """Whitelist for the session's course assignment; see load_assignment_whitelist()."""
+    return load_assignment_whitelist(session.course_assignment_id)
+
+
+def load_assignment_whitelist(course_assignment_id):
     """
     Returns:
       student_ids: [int, ...]         # academic Student ids
       user_ids:    [int, ...]         # auth User ids (for embedding table)
       emb_matrix:  np.ndarray shape (N, D)
       display:     dict student_id -> display string
+    One joined query (Enrollment -> Student -> User -> template); rows stay
+    aligned by construction, so there is no owner lookup per template.
     """
     Enrollment = django_apps.get_model("academics", "Enrollment")
-    Student    = django_apps.get_model("academics", "Student")
-    UserEmb    = django_apps.get_model("biometrics", "UserEmbeddingTemplate")  # user_id -> centroid (list)
 
-    # enrolled students in this assignment
-    stu_ids = list(
-        Enrollment.objects.filter(course_assignment=session.course_assignment)
-        .values_list("student_id", flat=True)
+    rows = list(
+        Enrollment.objects.filter(course_assignment_id=course_assignment_id)
+        .order_by("id")
+        .values_list("student_id", "student__user_id",
+                     "student__user__first_name", "student__user__last_name", "student__user__username",
+                     "student__user__face_template__centroid")
     )
-    if not stu_ids:
+    if not rows:
         return [], [], None, {}
 
-    # map Student -> User ids
-    rows = Student.objects.select_related("user").filter(id__in=stu_ids)
-    user_by_student = {s.id: s.user_id for s in rows}
-    display = {s.id: (s.user.get_full_name() or s.user.username) for s in rows}
-
-    # fetch centroids for those users
-    emb_rows = UserEmb.objects.filter(user_id__in=list(user_by_student.values()))
-    # build aligned arrays: only keep students that actually have a centroid
-    v_student_ids, v_user_ids, vecs = [], [], []
-    for e in emb_rows:
-        # find the student id(s) for this user_id (there should be exactly one)
-        for sid, uid in user_by_student.items():
-            if uid == e.user_id:
-                v_student_ids.append(sid)
-                v_user_ids.append(uid)
-                v = np.array(e.centroid, dtype=np.float32)
-                v = v / (np.linalg.norm(v) + 1e-8)
-                vecs.append(v)
-                break
-
-    if not vecs:
+    display = {sid: (f"{first} {last}".strip() or username) for sid, _uid, first, last, username, _c in rows}
+
+    # only keep students that actually have a centroid
+    with_tpl = [r for r in rows if r[5] is not None]
+    if not with_tpl:
         return [], [], None, {}
+    n = len(with_tpl)
+    v_student_ids = np.empty(n, dtype=np.int64)
+    v_user_ids = np.empty(n, dtype=np.int64)
+    for i, r in enumerate(with_tpl):
+        v_student_ids[i], v_user_ids[i] = r[0], r[1]
+    emb_matrix = unpack_matrix([r[5] for r in with_tpl])  # (N, D), one allocation for same-format blobs
+    emb_matrix /= (np.linalg.norm(emb_matrix, axis=1, keepdims=True) + 1e-8)
+    return v_student_ids.tolist(), v_user_ids.tolist(), emb_matrix, display
+
+
+class RosterEntry(NamedTuple):
+    user_id: int
+    student_id: int
+    display: str
+    enrollment_status: str
+
+
+class SessionRoster:
+    """
+    Immutable per-session lookup built once at worker start:
+      gallery row index -> RosterEntry(user_id, student_id, display, enrollment_status)
+    so the match -> mark path needs no Student/Enrollment queries.
+    Rows whose user is not (or no longer) enrolled map to None.
+    reload() returns a fresh roster for the same rows when enrollments change;
+    with_rows() re-reads only the rows a gallery delta touched.
+    """
+
+    def __init__(self, course_assignment_id, row_user_ids, entries):
+        self.course_assignment_id = course_assignment_id
+        self.row_user_ids = tuple(row_user_ids)
+        self._entries = tuple(entries)
+        self._by_user = {e.user_id: e for e in self._entries if e is not None}
+        self.loaded_ts = time.time()
+
+    @classmethod
+    def load(cls, course_assignment_id, row_user_ids):
+        Enrollment = django_apps.get_model("academics", "Enrollment")
+        row_user_ids = [int(u) for u in row_user_ids]
+        rows = (
+            Enrollment.objects.filter(course_assignment_id=course_assignment_id,
+                                      student__user_id__in=row_user_ids)
+            .values_list("student__user_id", "student_id", "status",
+                         "student__user__first_name", "student__user__last_name",
+                         "student__user__username")
+        )
+        by_user = {}
+        for uid, sid, status, first, last, username in rows:
+            display = f"{first} {last}".strip() or username
+            by_user[uid] = RosterEntry(uid, sid, display, status)
+        return cls(course_assignment_id, row_user_ids, [by_user.get(u) for u in row_user_ids])
+
+    def reload(self):
+        return SessionRoster.load(self.course_assignment_id, self.row_user_ids)
+
+    def with_rows(self, row_user_ids, rows):
+        """
+        Roster for `row_user_ids` (same rows, possibly some changed or
+        appended) that re-reads only `rows`; the other entries are reused.
+        """
+        row_user_ids = [int(u) for u in row_user_ids]
+        entries = list(self._entries[:len(row_user_ids)]) + [None] * (len(row_user_ids) - len(self._entries))
+        rows = sorted(set(rows) | set(range(len(self._entries), len(row_user_ids))))
+        if rows:
+            fresh = SessionRoster.load(self.course_assignment_id, [row_user_ids[i] for i in rows])
+            for i, e in zip(rows, fresh._entries):
+                entries[i] = e
+        return SessionRoster(self.course_assignment_id, row_user_ids, entries)
+
+    def renamed_rows(self, display):
+        """Rows whose entry's display name differs from `display` (student_id -> name)."""
+        return [i for i, e in enumerate(self._entries)
+                if e is not None and display.get(e.student_id, e.display) != e.display]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def for_row(self, i):
+        return self._entries[i]
+
+    def for_user(self, user_id):
+        return self._by_user.get(int(user_id))
 
-    emb_matrix = np.vstack(vecs)  # (N, D)
-    return v_student_ids, v_user_ids, emb_matrix, display
+    def display_by_student(self):
+        return {e.student_id: e.display for e in self._by_user.values()}
@@ -16,6 +16,7 @@ admin.site.index_title = "Control Panel"
 from django.urls import path
 from django.contrib import admin
 from apps.biometrics.admin_views import train_all_view
+from apps.biometrics.services.embedding_queue import embedding_state, annotate_embedding_state
 
 
 _original_get_urls = admin.site.get_urls
@@ -76,7 +77,7 @@ class UserAdmin(PatchedImportExportAdmin, BaseUserAdmin):
 
     inlines = [UserFaceInline]  # <— add the inline here
     actions = ["admin_train_selected"]
-    list_display = ("id", "username", "email", "role", "is_active", "is_staff", "photo_thumb")
+    list_display = ("id", "username", "email", "role", "is_active", "is_staff", "photo_thumb", "face_embedding")
     list_filter  = ("role", "is_active", "is_staff", "is_superuser")
     search_fields = ("username", "email", "phone")
     ordering = ("id",)
@@ -107,6 +108,15 @@ class UserAdmin(PatchedImportExportAdmin, BaseUserAdmin):
         return "—"
     photo_thumb.short_description = "Photo"
 
+    def get_queryset(self, request):
+        # embedding state flags come with the changelist query, not 2 queries per row
+        return annotate_embedding_state(super().get_queryset(request))
+
+    def face_embedding(self, obj):
+        # pending / failed / ready / none (see biometrics embedding queue)
+        return embedding_state(obj)
+    face_embedding.short_description = "Embedding"
+
     # inside your UserAdmin class:
     @admin.action(description="Train model for selected users")
     def admin_train_selected(self, request, queryset):
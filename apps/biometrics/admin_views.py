@@ -2,14 +2,18 @@
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.shortcuts import redirect
+from django.conf import settings
 from apps.biometrics.services.training import train_users
 
 @staff_member_required
 def train_all_view(request):
-    summary = train_users(None)  # all users
+    full = request.GET.get("full") == "1"  # ?full=1 forces re-embedding every photo
+    workers = getattr(settings, "FACE_TRAIN_WORKERS", 1)  # >1 = process pool
+    summary = train_users(None, full=full, workers=workers)  # all users, incremental unless full
     messages.success(
         request,
-        f"Training complete: users={summary['users']}, embeddings={summary['embeddings']}, skipped(no-face)={summary['skipped']}"
+        f"Training complete: users={summary['users']}, embeddings={summary['embeddings']}, "
+        f"reused={summary['reused']}, skipped(no-face)={summary['skipped']}"
     )
     return redirect("admin:index")
 
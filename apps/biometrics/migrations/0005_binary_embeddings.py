@@ -0,0 +1,121 @@
+import struct
+import numpy as np
+from django.db import migrations, models
+
+# Frozen copy of the FEV1 layout as of this migration (services/vectors.py may
+# change later; what this migration writes must not): "<4sBBH" magic, dtype code
+# (1 = float32, 2 = float16), model tag length, dim; then the tag and the data.
+_HEAD = struct.Struct("<4sBBH")
+_DTYPES = {1: "<f4", 2: "<f2"}
+_MODEL = b"buffalo_l"
+
+
+def _pack(values):
+    """float32 FEV1 blob for a JSON list, or None when the list is missing/empty/invalid."""
+    if values is None:
+        return None
+    try:
+        arr = np.asarray(values, dtype=np.float32).reshape(-1)
+    except (TypeError, ValueError):
+        return None
+    if arr.size == 0:
+        return None
+    return _HEAD.pack(b"FEV1", 1, len(_MODEL), arr.shape[0]) + _MODEL + arr.astype("<f4").tobytes()
+
+
+def _unpack(blob):
+    blob = bytes(blob)
+    magic, code, mlen, dim = _HEAD.unpack_from(blob, 0)
+    if magic != b"FEV1":
+        raise ValueError("not an FEV1 embedding")
+    return np.frombuffer(blob, dtype=_DTYPES[code], count=dim, offset=_HEAD.size + mlen).astype(np.float32)
+
+
+def json_to_binary(apps, schema_editor):
+    # rows without a usable vector are deleted: the binary column becomes NOT NULL,
+    # and training recomputes a photo's embedding / a user's template when missing
+    UserFaceEmbedding = apps.get_model("biometrics", "UserFaceEmbedding")
+    UserEmbeddingTemplate = apps.get_model("biometrics", "UserEmbeddingTemplate")
+    for Model, src, dst in ((UserFaceEmbedding, "vector", "vector_bin"),
+                            (UserEmbeddingTemplate, "centroid", "centroid_bin")):
+        empty = []
+        for row in Model.objects.all().iterator():
+            blob = _pack(getattr(row, src))
+            if blob is None:
+                empty.append(row.pk)
+                continue
+            setattr(row, dst, blob)
+            row.save(update_fields=[dst])
+        if empty:
+            Model.objects.filter(pk__in=empty).delete()
+            print(f"  {Model.__name__}: deleted {len(empty)} row(s) without a vector")
+
+
+def binary_to_json(apps, schema_editor):
+    UserFaceEmbedding = apps.get_model("biometrics", "UserFaceEmbedding")
+    UserEmbeddingTemplate = apps.get_model("biometrics", "UserEmbeddingTemplate")
+    for row in UserFaceEmbedding.objects.all().iterator():
+        row.vector = _unpack(row.vector_bin).tolist()
+        row.save(update_fields=["vector"])
+    for row in UserEmbeddingTemplate.objects.all().iterator():
+        row.centroid = _unpack(row.centroid_bin).tolist()
+        row.save(update_fields=["centroid"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biometrics', '0004_remove_userfaceembedding_student'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfaceembedding',
+            name='vector_bin',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='userembeddingtemplate',
+            name='centroid_bin',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='userfaceembedding',
+            name='vector',
+            field=models.JSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='userembeddingtemplate',
+            name='centroid',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(json_to_binary, binary_to_json),
+        migrations.RemoveField(
+            model_name='userfaceembedding',
+            name='vector',
+        ),
+        migrations.RemoveField(
+            model_name='userembeddingtemplate',
+            name='centroid',
+        ),
+        migrations.RenameField(
+            model_name='userfaceembedding',
+            old_name='vector_bin',
+            new_name='vector',
+        ),
+        migrations.RenameField(
+            model_name='userembeddingtemplate',
+            old_name='centroid_bin',
+            new_name='centroid',
+        ),
+        migrations.AlterField(
+            model_name='userfaceembedding',
+            name='vector',
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name='userembeddingtemplate',
+            name='centroid',
+            field=models.BinaryField(),
+        ),
+    ]
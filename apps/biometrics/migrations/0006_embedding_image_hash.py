@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biometrics', '0005_binary_embeddings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userfaceembedding',
+            name='image_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='userfaceembedding',
+            name='model_version',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
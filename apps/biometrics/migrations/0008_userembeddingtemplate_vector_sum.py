@@ -0,0 +1,59 @@
+# Generated by Django 5.1.7 on 2026-10-18 03:02
+
+import struct
+import numpy as np
+from django.db import migrations, models
+
+# Frozen FEV1 layout (see 0005_binary_embeddings): "<4sBBH" magic, dtype code
+# (1 = float32, 2 = float16), model tag length, dim; then the tag and the data.
+_HEAD = struct.Struct("<4sBBH")
+_DTYPES = {1: "<f4", 2: "<f2"}
+_MODEL = b"buffalo_l"
+
+
+def _unpack(blob):
+    blob = bytes(blob)
+    magic, code, mlen, dim = _HEAD.unpack_from(blob, 0)
+    if magic != b"FEV1":
+        raise ValueError("not an FEV1 embedding")
+    return np.frombuffer(blob, dtype=_DTYPES[code], count=dim, offset=_HEAD.size + mlen).astype(np.float32)
+
+
+def _pack_f32(arr):
+    return _HEAD.pack(b"FEV1", 1, len(_MODEL), arr.shape[0]) + _MODEL + arr.astype("<f4").tobytes()
+
+
+def backfill_vector_sum(apps, schema_editor):
+    # without a running sum, services.templates can't take a deleted vector out
+    # of an existing template; compute sum/count from the stored embeddings
+    UserFaceEmbedding = apps.get_model("biometrics", "UserFaceEmbedding")
+    UserEmbeddingTemplate = apps.get_model("biometrics", "UserEmbeddingTemplate")
+    sums, counts = {}, {}
+    for user_id, blob in UserFaceEmbedding.objects.values_list("face__user_id", "vector").iterator():
+        v = _unpack(blob)
+        sums[user_id] = sums[user_id] + v if user_id in sums else v
+        counts[user_id] = counts.get(user_id, 0) + 1
+    filled = 0
+    for tpl in UserEmbeddingTemplate.objects.filter(user_id__in=list(sums)).iterator():
+        tpl.vector_sum = _pack_f32(sums[tpl.user_id])
+        tpl.count = counts[tpl.user_id]
+        tpl.save(update_fields=["vector_sum", "count"])
+        filled += 1
+    if filled:
+        print(f"  UserEmbeddingTemplate: backfilled vector_sum for {filled} template(s)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biometrics', '0007_embeddingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userembeddingtemplate',
+            name='vector_sum',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_vector_sum, migrations.RunPython.noop),
+    ]
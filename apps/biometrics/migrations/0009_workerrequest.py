@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biometrics', '0008_userembeddingtemplate_vector_sum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkerRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('start', 'Start'), ('stop', 'Stop')], max_length=8)),
+                ('session_id', models.PositiveIntegerField()),
+                ('cam_source', models.CharField(blank=True, default='', max_length=64)),
+                ('result', models.CharField(blank=True, default='', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('handled_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['handled_at', 'id'], name='biometrics__handled_d61c0f_idx')],
+            },
+        ),
+    ]
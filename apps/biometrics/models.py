@@ -24,11 +24,62 @@ class UserFaceEmbedding(models.Model):
     # student = models.OneToOneField("academics.Student", on_delete=models.CASCADE, related_name="embedding")
     # student = models.OneToOneField("academics.Student", on_delete=models.CASCADE, related_name="embedding", null=True, blank=True)
     face = models.OneToOneField(UserFace, on_delete=models.CASCADE, related_name="embedding")
-    vector = models.JSONField()
+    vector = models.BinaryField()  # services.vectors.pack_vector(): header + float32/float16 bytes
+    # what produced this vector: lets training skip unchanged photos
+    image_hash = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    model_version = models.CharField(max_length=32, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
 
 class UserEmbeddingTemplate(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="face_template")
-    centroid = models.JSONField()
+    centroid = models.BinaryField()  # services.vectors.pack_vector()
+    # unnormalized float32 sum of the user's embeddings; with `count` this lets
+    # services.templates update the centroid in O(1) per added/removed vector
+    vector_sum = models.BinaryField(null=True, blank=True)
     count = models.PositiveIntegerField(default=0)
     updated_at = models.DateTimeField(auto_now=True)
+
+
+class EmbeddingJob(models.Model):
+    """Durable queue entry: compute the embedding for one UserFace (drained by embedding_worker.py)."""
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE    = "done"
+    FAILED  = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    face = models.OneToOneField(UserFace, on_delete=models.CASCADE, related_name="embedding_job")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="embedding_jobs")
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_by = models.CharField(max_length=64, blank=True, default="")
+    error = models.CharField(max_length=200, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "id"]), models.Index(fields=["user", "status"])]
+
+    def __str__(self):
+        return f"job {self.id} face={self.face_id} {self.status}"
+
+
+class WorkerRequest(models.Model):
+    """Start/stop of a session worker, asked by the web process and carried out by face_supervisor.py."""
+    START = "start"
+    STOP  = "stop"
+    ACTION_CHOICES = [(START, "Start"), (STOP, "Stop")]
+
+    action = models.CharField(max_length=8, choices=ACTION_CHOICES)
+    session_id = models.PositiveIntegerField()
+    cam_source = models.CharField(max_length=64, blank=True, default="")
+    # Supervisor.start() outcome ("started", "queued", ...) or "stopped" / "none"; "" until handled
+    result = models.CharField(max_length=16, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    handled_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["handled_at", "id"])]
+
+    def __str__(self):
+        return f"{self.action} session {self.session_id} {self.result or 'pending'}"
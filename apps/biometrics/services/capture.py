@@ -0,0 +1,120 @@
+# apps/biometrics/services/capture.py
+import time
+import threading
+from collections import deque
+
+
+class LatestFrameGrabber(threading.Thread):
+    """
+    Dedicated capture thread: keeps calling cap.read() so the driver buffer
+    never backs up, and holds only the most recent frames in a small ring
+    buffer. The inference loop pulls the newest frame when it is ready, so
+    recognition latency is bounded by one inference time.
+
+    Each buffered entry is (seq, capture_ts, frame). `dropped` counts frames
+    that were captured but replaced before anyone consumed them.
+    """
+
+    def __init__(self, cap, size=2, name="frame-grabber"):
+        super().__init__(daemon=True, name=name)
+        self.cap = cap
+        self._buf = deque(maxlen=max(1, int(size)))
+        self._cond = threading.Condition()
+        self._stop_evt = threading.Event()
+        self._seq = 0
+        self._last_read_seq = 0
+        self.captured = 0
+        self.dropped = 0
+        self.read_failures = 0
+
+    def run(self):
+        while not self._stop_evt.is_set():
+            ok, frame = self.cap.read()
+            ts = time.time()
+            if not ok or frame is None:
+                self.read_failures += 1
+                time.sleep(0.05)
+                continue
+            with self._cond:
+                self._seq += 1
+                self.captured += 1
+                # the frame falling off the ring (or the newest one being
+                # superseded) was never consumed -> count it as dropped
+                if self._seq - self._last_read_seq > 1:
+                    self.dropped += 1
+                self._buf.append((self._seq, ts, frame))
+                self._cond.notify_all()
+
+    def read(self, timeout=1.0):
+        """
+        Block until a frame newer than the last one returned is available.
+        Returns (ok, frame, capture_ts, age_s); ok is False on timeout/stop.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while not self._buf or self._buf[-1][0] <= self._last_read_seq:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stop_evt.is_set():
+                    return False, None, None, None
+                self._cond.wait(remaining)
+            seq, ts, frame = self._buf[-1]
+            self._last_read_seq = seq
+        return True, frame, ts, time.time() - ts
+
+    def stats(self):
+        return {"captured": self.captured, "dropped": self.dropped,
+                "read_failures": self.read_failures}
+
+    def stop(self, join_timeout=2.0):
+        self._stop_evt.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(join_timeout)
+
+
+class CameraStream:
+    """
+    One camera of a multi-camera worker: its grabber plus per-camera
+    counters. done() is called once the frame's results are in, so
+    `latency` is capture -> recognized (queueing + batched inference).
+    """
+
+    def __init__(self, name, cap, window_s=10.0):
+        self.name = name
+        self.cap = cap
+        self.grabber = LatestFrameGrabber(cap, name=f"frame-grabber-{name}")
+        self.window_s = window_s
+        self.processed = 0
+        self._win_start = time.time()
+        self._win_frames = 0
+        self._win_latency = 0.0
+        self.fps = 0.0
+        self.latency = 0.0
+        self.last_frame_ts = None
+
+    def start(self):
+        self.grabber.start()
+
+    def read(self, timeout):
+        return self.grabber.read(timeout=timeout)
+
+    def done(self, capture_ts, now=None):
+        now = now or time.time()
+        self.processed += 1
+        self.last_frame_ts = capture_ts
+        self._win_frames += 1
+        self._win_latency += now - capture_ts
+        elapsed = now - self._win_start
+        if elapsed >= self.window_s:
+            self.fps = self._win_frames / elapsed
+            self.latency = self._win_latency / self._win_frames
+            self._win_start, self._win_frames, self._win_latency = now, 0, 0.0
+
+    def stats(self):
+        return {"fps": round(self.fps, 1), "latency_ms": round(self.latency * 1000), "processed": self.processed,
+                **self.grabber.stats()}
+
+    def stop(self):
+        self.grabber.stop()
+        self.cap.release()
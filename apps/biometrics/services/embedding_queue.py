@@ -0,0 +1,191 @@
+# apps/biometrics/services/embedding_queue.py
+import os
+import time
+import uuid
+import socket
+import threading
+from django.db import transaction, close_old_connections
+from django.db.models import F, Exists, OuterRef
+from django.utils import timezone
+from apps.biometrics.models import UserFace, UserFaceEmbedding, UserEmbeddingTemplate, EmbeddingJob
+from apps.biometrics.services.face import embed_from_image_bytes
+from apps.biometrics.services.vectors import pack_vector, unpack_vector, MODEL_VERSION
+from apps.biometrics.services.training import image_hash
+from apps.biometrics.services.templates import add_embedding, replace_embedding
+
+MAX_ATTEMPTS  = 3
+STALE_AFTER_S = 300     # a RUNNING job claimed longer ago than this is assumed orphaned (worker died)
+CLAIM_BATCH   = 8
+
+
+def enqueue(face: UserFace) -> EmbeddingJob:
+    """Queue (or re-queue) the embedding job for a saved UserFace."""
+    job, created = EmbeddingJob.objects.get_or_create(face=face, defaults={"user_id": face.user_id})
+    if not created and job.status != EmbeddingJob.PENDING:
+        EmbeddingJob.objects.filter(id=job.id).update(status=EmbeddingJob.PENDING, attempts=0, error="",
+                                                      claimed_by="", updated_at=timezone.now())
+    return job
+
+
+def worker_token() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def requeue_stale(stale_after_s=STALE_AFTER_S) -> int:
+    # updated_at is auto_now, which QuerySet.update() does not touch: every
+    # update() in this module sets it, so for a RUNNING job it is the claim time
+    cutoff = timezone.now() - timezone.timedelta(seconds=stale_after_s)
+    return (EmbeddingJob.objects
+            .filter(status=EmbeddingJob.RUNNING, updated_at__lt=cutoff)
+            .update(status=EmbeddingJob.PENDING, claimed_by="", updated_at=timezone.now()))
+
+
+def claim(token: str, batch=CLAIM_BATCH):
+    """
+    Atomically move up to `batch` pending jobs to RUNNING for this worker.
+    The conditional UPDATE makes concurrent workers safe: a job only goes to
+    whoever flipped it first.
+    """
+    ids = list(EmbeddingJob.objects.filter(status=EmbeddingJob.PENDING)
+               .order_by("id").values_list("id", flat=True)[:batch])
+    if not ids:
+        return []
+    with transaction.atomic():
+        (EmbeddingJob.objects.filter(id__in=ids, status=EmbeddingJob.PENDING)
+         .update(status=EmbeddingJob.RUNNING, claimed_by=token, attempts=F("attempts") + 1,
+                 updated_at=timezone.now()))
+    return list(EmbeddingJob.objects.select_related("face")
+                .filter(id__in=ids, status=EmbeddingJob.RUNNING, claimed_by=token))
+
+
+def _finish(job, **fields):
+    """Close a job only while this worker still holds its claim; False if it was requeued meanwhile."""
+    return bool(EmbeddingJob.objects.filter(id=job.id, status=EmbeddingJob.RUNNING, claimed_by=job.claimed_by)
+                .update(updated_at=timezone.now(), **fields))
+
+
+def process(jobs) -> dict:
+    """
+    Embed the claimed jobs; each result updates its user's template in O(1).
+    A job requeued by requeue_stale() while we worked on it is left to its new
+    owner, so its embedding is never added to the template twice.
+    """
+    done = failed = no_face = 0
+    touched = set()
+    for job in jobs:
+        face = job.face
+        try:
+            with face.image.open("rb") as f:
+                data = f.read()
+            emb = embed_from_image_bytes(data)
+        except Exception as e:
+            status = EmbeddingJob.FAILED if job.attempts >= MAX_ATTEMPTS else EmbeddingJob.PENDING
+            _finish(job, status=status, error=str(e)[:200], claimed_by="")
+            failed += 1
+            continue
+        if emb is None:
+            _finish(job, status=EmbeddingJob.DONE, error="no face found")
+            no_face += 1
+            continue
+        blob = pack_vector(emb)
+        with transaction.atomic():
+            if not _finish(job, status=EmbeddingJob.DONE, error=""):
+                print(f"[EMBED] job {job.id} was requeued while running; skipped")
+                continue
+            old = UserFaceEmbedding.objects.filter(face=face).values_list("vector", flat=True).first()
+            UserFaceEmbedding.objects.update_or_create(
+                face=face,
+                defaults={"vector": blob, "image_hash": image_hash(data), "model_version": MODEL_VERSION},
+            )
+            if old is None:
+                add_embedding(face.user_id, unpack_vector(blob))
+            else:
+                replace_embedding(face.user_id, unpack_vector(old), unpack_vector(blob))
+        touched.add(face.user_id)
+        done += 1
+    return {"done": done, "no_face": no_face, "failed": failed, "users": len(touched)}
+
+
+def run_worker(batch=CLAIM_BATCH, poll_s=2.0, once=False, quiet=False):
+    """Drain the queue forever (or until empty with once=True)."""
+    token = worker_token()
+    if not quiet:
+        print(f"[EMBED] worker {token} started")
+    while True:
+        requeue_stale()
+        jobs = claim(token, batch)
+        if jobs:
+            summary = process(jobs)
+            print(f"[EMBED] {summary}")
+            continue
+        if once:
+            return
+        time.sleep(poll_s)
+
+
+# ---------------- in-process drain ----------------
+_DRAIN_LOCK = threading.Lock()
+_DRAIN_THREAD = None
+_DRAIN_AGAIN = False     # a job was queued while the drain thread was running
+
+
+def _drain_loop():
+    global _DRAIN_THREAD, _DRAIN_AGAIN
+    try:
+        while True:
+            try:
+                run_worker(once=True, quiet=True)
+            except Exception as e:
+                print(f"[EMBED] background drain failed: {e}")
+            with _DRAIN_LOCK:
+                if not _DRAIN_AGAIN:
+                    _DRAIN_THREAD = None
+                    return
+                _DRAIN_AGAIN = False
+    finally:
+        close_old_connections()
+
+
+def drain_in_background():
+    """
+    Drain the queue on a daemon thread of this process (one at a time), so
+    FACE_EMBED_ASYNC works without a separate embedding_worker.py. Claims are
+    atomic, so dedicated workers can run alongside it.
+    """
+    global _DRAIN_THREAD, _DRAIN_AGAIN
+    with _DRAIN_LOCK:
+        if _DRAIN_THREAD is not None:
+            _DRAIN_AGAIN = True
+            return _DRAIN_THREAD
+        _DRAIN_THREAD = threading.Thread(target=_drain_loop, daemon=True, name="embedding-drain")
+        _DRAIN_THREAD.start()
+        return _DRAIN_THREAD
+
+
+# ---------------- admin ----------------
+def _state(active, failed, ready) -> str:
+    if active:
+        return "pending"
+    if failed:
+        return "failed"
+    return "ready" if ready else "none"
+
+
+def annotate_embedding_state(users):
+    """Annotate a User queryset with the flags embedding_state() needs (no per-row queries)."""
+    jobs = EmbeddingJob.objects.filter(user_id=OuterRef("pk"))
+    return users.annotate(
+        emb_active=Exists(jobs.filter(status__in=[EmbeddingJob.PENDING, EmbeddingJob.RUNNING])),
+        emb_failed=Exists(jobs.filter(status=EmbeddingJob.FAILED)),
+        emb_ready=Exists(UserEmbeddingTemplate.objects.filter(user_id=OuterRef("pk"))),
+    )
+
+
+def embedding_state(user) -> str:
+    """Per-user state for the admin: pending / failed / ready / none. Takes an annotated user or an id."""
+    if hasattr(user, "emb_active"):
+        return _state(user.emb_active, user.emb_failed, user.emb_ready)
+    user_id = getattr(user, "pk", user)
+    statuses = set(EmbeddingJob.objects.filter(user_id=user_id).values_list("status", flat=True))
+    return _state(statuses & {EmbeddingJob.PENDING, EmbeddingJob.RUNNING}, EmbeddingJob.FAILED in statuses,
+                  UserEmbeddingTemplate.objects.filter(user_id=user_id).exists())
@@ -1,16 +1,25 @@
 # apps/biometrics/services/face.py
 import numpy as np
-from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.utils import face_align
 import cv2
 import io
+from apps.biometrics.services.model_factory import load_face_app
 
 # Initialize once (module-level)
 _app = None
+_app_threads = None  # ONNX Runtime intra-op threads for _app (None = ORT default: all cores)
+
+def set_app_threads(n):
+    """Pin ORT threads before the first _get_app() (e.g. one per training pool process)."""
+    global _app_threads
+    _app_threads = n
+
 def _get_app():
     global _app
     if _app is None:
-        _app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-        _app.prepare(ctx_id=0, det_size=(640, 640))
+        # detector + recognizer only; pack/det_size/threads from settings.FACE_MODEL
+        _app = load_face_app(intra_threads=_app_threads)
     return _app
 
 def embed_from_image_bytes(img_bytes: bytes):
@@ -34,3 +43,146 @@ def embed_from_image_bytes(img_bytes: bytes):
     # force L2 normalize
     emb = emb / (np.linalg.norm(emb) + 1e-8)
     return emb
+
+
+def detect_faces(app, frame, max_num=0):
+    """
+    Detector-only pass: return [Face(bbox, kps, det_score), ...] without
+    running the recognizer (FaceAnalysis.get() embeds every face).
+    """
+    bboxes, kpss = app.det_model.detect(frame, max_num=max_num, metric="default")
+    faces = []
+    for i in range(bboxes.shape[0]):
+        kps = kpss[i] if kpss is not None else None
+        faces.append(Face(bbox=bboxes[i, 0:4], kps=kps, det_score=bboxes[i, 4]))
+    return faces
+
+
+def _letterbox(img, input_size):
+    """SCRFD.detect()'s resize: keep aspect, pad bottom/right. Returns (det_img, scale)."""
+    im_ratio = float(img.shape[0]) / img.shape[1]
+    model_ratio = float(input_size[1]) / input_size[0]
+    if im_ratio > model_ratio:
+        new_height = input_size[1]
+        new_width = int(new_height / im_ratio)
+    else:
+        new_width = input_size[0]
+        new_height = int(new_width * im_ratio)
+    det_img = np.zeros((input_size[1], input_size[0], 3), dtype=np.uint8)
+    det_img[:new_height, :new_width, :] = cv2.resize(img, (new_width, new_height))
+    return det_img, float(new_height) / img.shape[0]
+
+
+def _decode(det, net_outs, n, batch, input_size, scale, max_num, img_shape):
+    """SCRFD.forward() + detect() post-processing for image `n` of a batched run."""
+    from insightface.model_zoo.scrfd import distance2bbox, distance2kps
+    scores_list, bboxes_list, kpss_list = [], [], []
+    fmc = det.fmc
+    for idx, stride in enumerate(det._feat_stride_fpn):
+        def part(o):
+            # batched models: (N, A, C); flat models stack the images along axis 0
+            return o[n] if det.batched else o.reshape(batch, -1, o.shape[-1])[n]
+        scores = part(net_outs[idx])
+        bbox_preds = part(net_outs[idx + fmc]) * stride
+        height, width = input_size[1] // stride, input_size[0] // stride
+        key = (height, width, stride)
+        centers = det.center_cache.get(key)
+        if centers is None:
+            centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+            centers = (centers * stride).reshape((-1, 2))
+            if det._num_anchors > 1:
+                centers = np.stack([centers] * det._num_anchors, axis=1).reshape((-1, 2))
+            if len(det.center_cache) < 100:
+                det.center_cache[key] = centers
+        pos = np.where(scores >= det.det_thresh)[0]
+        scores_list.append(scores[pos])
+        bboxes_list.append(distance2bbox(centers, bbox_preds)[pos])
+        if det.use_kps:
+            kps = distance2kps(centers, part(net_outs[idx + fmc * 2]) * stride)
+            kpss_list.append(kps.reshape((kps.shape[0], -1, 2))[pos])
+
+    scores = np.vstack(scores_list)
+    order = np.argsort(-scores.ravel(), kind="stable")
+    pre_det = np.hstack((np.vstack(bboxes_list) / scale, scores)).astype(np.float32, copy=False)[order, :]
+    keep = det.nms(pre_det)
+    bboxes = pre_det[keep, :]
+    kpss = (np.vstack(kpss_list) / scale)[order, :, :][keep, :, :] if det.use_kps else None
+    if max_num > 0 and bboxes.shape[0] > max_num:
+        area = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        cy, cx = img_shape[0] // 2, img_shape[1] // 2
+        off = ((bboxes[:, 0] + bboxes[:, 2]) / 2 - cx) ** 2 + ((bboxes[:, 1] + bboxes[:, 3]) / 2 - cy) ** 2
+        best = np.argsort(area - off * 2.0)[::-1][:max_num]
+        bboxes = bboxes[best]
+        kpss = kpss[best] if kpss is not None else None
+    return bboxes, kpss
+
+
+def _batch_capable(det):
+    """SCRFD exported with a dynamic batch dimension (buffalo_l/_s det models are)."""
+    if getattr(det, "_batch_ok", None) is None:
+        try:
+            dim = det.session.get_inputs()[0].shape[0]
+            det._batch_ok = not isinstance(dim, int) or dim > 1
+        except AttributeError:   # InferenceClient or another non-SCRFD detector
+            det._batch_ok = False
+    return det._batch_ok
+
+
+def detect_faces_batch(app, frames, max_num=0):
+    """
+    detect_faces() for several frames (e.g. one per camera) in ONE detector
+    call: the frames are letterboxed to det_size and stacked into an (N, 3,
+    H, W) blob. Falls back to one call per frame when the detector cannot
+    batch. Returns a list of face lists aligned with `frames`.
+    """
+    det = app.det_model
+    if len(frames) < 2 or not _batch_capable(det):
+        return [detect_faces(app, f, max_num=max_num) for f in frames]
+    input_size = tuple(det.input_size)
+    boxed = [_letterbox(f, input_size) for f in frames]
+    blob = cv2.dnn.blobFromImages([b[0] for b in boxed], 1.0 / det.input_std, input_size,
+                                  (det.input_mean, det.input_mean, det.input_mean), swapRB=True)
+    try:
+        net_outs = det.session.run(det.output_names, {det.input_name: blob})
+    except Exception as e:
+        print(f"[DETECT] batched detection unavailable ({e}); detecting frame by frame")
+        det._batch_ok = False
+        return [detect_faces(app, f, max_num=max_num) for f in frames]
+    out = []
+    for n, (frame, (_, scale)) in enumerate(zip(frames, boxed)):
+        bboxes, kpss = _decode(det, net_outs, n, len(frames), input_size, scale, max_num, frame.shape)
+        out.append([Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+                    for i in range(bboxes.shape[0])])
+    return out
+
+
+def embed_faces(app, frame, faces):
+    """
+    Run the recognizer on the given faces only, as one batched call.
+    Sets face.embedding in place and returns the list.
+    """
+    if not faces:
+        return faces
+    rec = app.models["recognition"]
+    crops = [face_align.norm_crop(frame, landmark=f.kps, image_size=rec.input_size[0]) for f in faces]
+    feats = rec.get_feat(crops)
+    for f, feat in zip(faces, feats):
+        f.embedding = feat.flatten()
+    return faces
+
+
+def embed_faces_batch(app, items):
+    """
+    embed_faces() over several frames in ONE recognizer call.
+    `items` is [(frame, faces), ...]; embeddings are set in place.
+    """
+    rec = app.models["recognition"]
+    crops, owners = [], []
+    for frame, faces in items:
+        for f in faces:
+            crops.append(face_align.norm_crop(frame, landmark=f.kps, image_size=rec.input_size[0]))
+            owners.append(f)
+    if crops:
+        for f, feat in zip(owners, rec.get_feat(crops)):
+            f.embedding = feat.flatten()
+    return [faces for _, faces in items]
@@ -0,0 +1,151 @@
+# apps/biometrics/services/frame_rate.py
+"""
+Adaptive inference rate for the live loops.
+
+Every camera frame is probed cheaply (downscaled grayscale difference
+against the previous probe); the detector/recognizer only run when the
+scheduler says a frame is due:
+
+  active  full `active_fps` for `warmup_s` after start (or kick(), e.g. a
+          session attaching to a room worker) and for `hold_s` after motion
+  idle    `idle_fps` when the scene is static, or when every enrolled
+          student with a template is already marked
+
+Between due frames the loop sleeps until the next probe (`probe_fps`), so
+an idle classroom costs a few tiny resizes per second instead of full
+inference on every frame. stats() reports the mode, target and achieved
+rates, and the inference time saved relative to running at `active_fps`.
+All timing goes through `clock` (default time.time), so tests can drive it.
+"""
+import time
+import numpy as np
+import cv2
+
+DEFAULTS = {"active_fps": 10.0, "idle_fps": 1.0, "probe_fps": 5.0, "warmup_s": 300.0,
+            "hold_s": 10.0, "motion_thresh": 0.01}
+_PROBE_W, _PROBE_H = 64, 36
+_PIXEL_DELTA = 15        # grey-level change that counts as a changed probe pixel
+
+
+def motion_probe(frame):
+    small = cv2.resize(frame, (_PROBE_W, _PROBE_H), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(small, (3, 3), 0)
+
+
+def motion_score(prev, cur):
+    """Fraction of probe pixels that changed by more than _PIXEL_DELTA."""
+    if prev is None:
+        return 1.0
+    return float(np.count_nonzero(cv2.absdiff(prev, cur) > _PIXEL_DELTA)) / cur.size
+
+
+def unmarked_count(ids, marked):
+    """Distinct enrolled ids (gallery rows; -1 tombstones skipped) not yet in `marked`."""
+    return len({i for i in ids if i >= 0}.difference(marked))
+
+
+class FrameRateScheduler:
+    def __init__(self, active_fps=DEFAULTS["active_fps"], idle_fps=DEFAULTS["idle_fps"],
+                 probe_fps=DEFAULTS["probe_fps"], warmup_s=DEFAULTS["warmup_s"],
+                 hold_s=DEFAULTS["hold_s"], motion_thresh=DEFAULTS["motion_thresh"], clock=time.time):
+        self.clock = clock
+        self.active_fps = float(active_fps)
+        self.idle_fps = float(idle_fps)
+        self.probe_fps = float(probe_fps)
+        self.warmup_s = float(warmup_s)
+        self.hold_s = float(hold_s)
+        self.motion_thresh = float(motion_thresh)
+        now = clock()
+        self.started_at = self.kicked_at = now
+        self.last_motion_ts = 0.0
+        self.mode = "active"
+        self.motion = 0.0
+        self._prev = None
+        self._last_due = 0.0
+        self._last_probe = 0.0
+        self._infer_started = None
+        self.probed = self.processed = self.skipped = 0
+        self.infer_s = 0.0
+        self.mode_s = {"active": 0.0, "idle": 0.0}
+        self._mode_ts = now
+
+    @classmethod
+    def from_settings(cls):
+        """settings.FACE_FRAME_RATE overrides DEFAULTS; None = process every frame."""
+        from django.conf import settings
+        conf = getattr(settings, "FACE_FRAME_RATE", {})
+        if conf is None:
+            return None
+        return cls(**{**DEFAULTS, **conf})
+
+    def kick(self):
+        """Back to full rate for `warmup_s` (a session started or attached)."""
+        self.kicked_at = self.clock()
+
+    def _set_mode(self, mode, now):
+        self.mode_s[self.mode] += now - self._mode_ts
+        self._mode_ts = now
+        self.mode = mode
+
+    def target_fps(self):
+        return self.active_fps if self.mode == "active" else self.idle_fps
+
+    def should_process(self, frame, unmarked=None, now=None):
+        """Probe `frame`, update the mode; True when inference should run on it."""
+        now = self.clock() if now is None else now
+        self._last_probe = now
+        self.probed += 1
+        cur = motion_probe(frame)
+        self.motion = motion_score(self._prev, cur)
+        self._prev = cur
+        if self.motion >= self.motion_thresh:
+            self.last_motion_ts = now
+        if unmarked is not None and unmarked <= 0:
+            mode = "idle"      # nobody left to recognize
+        elif now - self.kicked_at < self.warmup_s or now - self.last_motion_ts < self.hold_s:
+            mode = "active"
+        else:
+            mode = "idle"
+        self._set_mode(mode, now)
+        if now - self._last_due >= 1.0 / self.target_fps():
+            self._last_due = now
+            self._infer_started = now
+            self.processed += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def done(self, now=None):
+        """Inference for the last due frame finished (for the time-saved estimate)."""
+        if self._infer_started is not None:
+            self.infer_s += (self.clock() if now is None else now) - self._infer_started
+            self._infer_started = None
+
+    def next_in(self, now=None):
+        """Seconds until the next probe or due frame, whichever is first."""
+        now = self.clock() if now is None else now
+        next_probe = self._last_probe + 1.0 / self.probe_fps
+        next_due = self._last_due + 1.0 / self.target_fps()
+        return max(0.0, min(next_probe, next_due) - now)
+
+    def wait(self):
+        """Call after a skipped frame instead of spinning on the camera."""
+        delay = self.next_in()
+        if delay > 0:
+            time.sleep(delay)
+
+    def stats(self):
+        now = self.clock()
+        elapsed = max(now - self.started_at, 1e-6)
+        mode_s = dict(self.mode_s)
+        mode_s[self.mode] += now - self._mode_ts
+        per_frame = self.infer_s / self.processed if self.processed else 0.0
+        full = elapsed * self.active_fps          # frames a fixed full-rate loop would have run
+        saved = max(0.0, full - self.processed)
+        return {"mode": self.mode, "target_fps": self.target_fps(), "fps": round(self.processed / elapsed, 2),
+                "motion": round(self.motion, 4), "processed": self.processed, "skipped": self.skipped,
+                "idle_pct": round(100.0 * mode_s["idle"] / elapsed, 1),
+                "saved_pct": round(100.0 * saved / full, 1) if full else 0.0,
+                "saved_infer_s": round(saved * per_frame, 1)}
@@ -0,0 +1,387 @@
+# apps/biometrics/services/gallery_index.py
+"""
+Campus-wide 1:N gallery index over UserEmbeddingTemplate centroids.
+
+Two interchangeable backends (same add/remove/search/save/load API):
+  ExactIndex  brute-force matmul, exact; the faster one below ~10k ids.
+  IVFIndex    inverted file: k-means coarse cells, a query scans only the
+              `nprobe` closest cells. ~nprobe/nlist of the exact work, so
+              50k identities stay in the low-millisecond range per face.
+"auto" (the default) picks ivf once the gallery has AUTO_IVF_MIN_IDS ids.
+
+Ids are auth User ids. Both indexes persist to a single .npz and are
+updated in place (upsert/remove) as templates change; sync_index() pulls
+the rows modified since the last sync. Pick parameters with
+benchmarks/gallery_index.py (recall@k vs. latency).
+"""
+import os
+import time
+import numpy as np
+from apps.biometrics.services.matching import normalize_rows, cluster_templates
+
+DEFAULT_NLIST  = 256
+DEFAULT_NPROBE = 8
+TRAIN_PER_LIST = 39          # min rows per k-means cell; fewer gives unstable cells
+AUTO_IVF_MIN_IDS = 10000     # benchmark crossover: exact wins at 5k, ivf from ~10-20k
+
+
+def _empty(F, k):
+    return np.full((F, k), -1, dtype=np.int64), np.full((F, k), -1.0, dtype=np.float32)
+
+
+def _merge_top_k(ids, sims, k):
+    """Top-k of one query's candidate (ids, sims), padded with -1."""
+    out_ids, out_sims = np.full(k, -1, np.int64), np.full(k, -1.0, np.float32)
+    n = sims.shape[0]
+    if n == 0:
+        return out_ids, out_sims
+    kk = min(k, n)
+    part = np.argpartition(-sims, kk - 1)[:kk] if n > kk else np.arange(n)
+    part = part[np.argsort(-sims[part], kind="stable")]
+    out_ids[:kk], out_sims[:kk] = ids[part], sims[part]
+    return out_ids, out_sims
+
+
+class ExactIndex:
+    kind = "exact"
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self._n = 0
+        # rows [0, _n) are live; capacity doubles, so an upsert is O(D), not O(N)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._mat = np.zeros((0, dim), dtype=np.float32)
+        self._pos = {}
+        self.synced_at = 0.0
+
+    @property
+    def ids(self):
+        return self._ids[:self._n]
+
+    @property
+    def matrix(self):
+        return self._mat[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def _reserve(self, n):
+        cap = self._ids.shape[0]
+        if n <= cap:
+            return False
+        cap = max(n, 2 * cap, 64)
+        ids, mat = np.zeros(cap, dtype=np.int64), np.zeros((cap, self.dim), dtype=np.float32)
+        ids[:self._n], mat[:self._n] = self.ids, self.matrix
+        self._ids, self._mat = ids, mat
+        return True
+
+    def _reindex(self):
+        self._pos = {int(u): i for i, u in enumerate(self.ids)}
+
+    def _move_row(self, src, dst):
+        self._ids[dst], self._mat[dst] = self._ids[src], self._mat[src]
+        self._pos[int(self._ids[dst])] = dst
+
+    def add(self, ids, vecs):
+        """Insert or replace rows (upsert by id). Returns the row positions written."""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if ids.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        vecs = normalize_rows(vecs)
+        self._reserve(self._n + sum(1 for u in set(ids.tolist()) if u not in self._pos))
+        rows = np.empty(ids.size, dtype=np.int64)
+        for j, u in enumerate(ids.tolist()):
+            i = self._pos.get(u)
+            if i is None:
+                i = self._pos[u] = self._n
+                self._ids[i] = u
+                self._n += 1
+            rows[j] = i
+        self._mat[rows] = vecs          # duplicate ids in one call: the last vector wins
+        return np.unique(rows)
+
+    def remove(self, ids):
+        """Drop rows by id; the last row moves into each hole (O(D) per id)."""
+        for u in ids:
+            i = self._pos.pop(int(u), None)
+            if i is None:
+                continue
+            last = self._n - 1
+            if i != last:
+                self._move_row(last, i)
+            self._n = last
+
+    def search(self, embs, k=1):
+        """Batched top-k: (ids (F, k), sims (F, k)); missing slots are -1."""
+        embs = normalize_rows(embs)
+        F = embs.shape[0]
+        if len(self) == 0:
+            return _empty(F, k)
+        sims = embs @ self.matrix.T
+        out_ids, out_sims = _empty(F, k)
+        for q in range(F):
+            out_ids[q], out_sims[q] = _merge_top_k(self.ids, sims[q], k)
+        return out_ids, out_sims
+
+    def _state(self):
+        return {"ids": self.ids, "matrix": self.matrix}
+
+    def _restore(self, data):
+        self._ids, self._mat = data["ids"].astype(np.int64), data["matrix"].astype(np.float32)
+        self._n = int(self._ids.shape[0])
+        self._reindex()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, kind=np.array(self.kind), dim=np.array(self.dim),
+                 synced_at=np.array(self.synced_at), **self._state())
+        os.replace(tmp, path)  # readers never see a half-written index
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted-file index. train() picks up to `nlist` coarse centroids by
+    spherical k-means, never more than one per TRAIN_PER_LIST rows; each row
+    lives in its nearest cell. search() scores queries against the
+    centroids, then exactly against the rows of the `nprobe` best cells.
+
+    Until it is trained the index searches exactly. add() trains it by
+    itself once it holds nlist * TRAIN_PER_LIST rows, so the cells are never
+    fitted to the first few vectors that happen to arrive. Adds/removes only
+    reassign the touched rows; retrain after the distribution drifts a lot
+    (e.g. a new model version).
+    """
+    kind = "ivf"
+
+    def __init__(self, dim=512, nlist=DEFAULT_NLIST, nprobe=DEFAULT_NPROBE):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self._cell = np.zeros(0, dtype=np.int64)   # row -> cell
+        self._lists = None                         # cell -> row indices; rebuilt lazily
+
+    @property
+    def cell(self):
+        return self._cell[:self._n]
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    @property
+    def ncells(self):
+        return 0 if self.centroids is None else int(self.centroids.shape[0])
+
+    def _reserve(self, n):
+        if super()._reserve(n):
+            cell = np.zeros(self._ids.shape[0], dtype=np.int64)
+            cell[:self._n] = self._cell[:self._n]
+            self._cell = cell
+            return True
+        return False
+
+    def _move_row(self, src, dst):
+        super()._move_row(src, dst)
+        self._cell[dst] = self._cell[src]
+
+    def train(self, vecs=None, sample=20000, iters=10, seed=0):
+        """
+        Fit the coarse cells on `vecs` (default: the rows already in the index).
+        Returns False, leaving the index exact, when there are too few rows
+        for even two cells.
+        """
+        X = self.matrix if vecs is None else normalize_rows(vecs)
+        cells = min(self.nlist, X.shape[0] // TRAIN_PER_LIST)
+        if cells < 2:
+            print(f"[INDEX] {X.shape[0]} rows are too few to train IVF cells; searching exactly")
+            return False
+        if cells < self.nlist:
+            print(f"[INDEX] {X.shape[0]} training rows: {cells} cells instead of nlist={self.nlist}")
+        if X.shape[0] > sample:
+            X = X[np.random.default_rng(seed).choice(X.shape[0], sample, replace=False)]
+        self.centroids = cluster_templates(X, cells, iters=iters, seed=seed)
+        if len(self):
+            self._cell[:self._n] = np.argmax(self.matrix @ self.centroids.T, axis=1)
+        self._lists = None
+        return True
+
+    def _build_lists(self):
+        order = np.argsort(self.cell, kind="stable")
+        bounds = np.searchsorted(self.cell[order], np.arange(self.ncells + 1))
+        self._lists = [order[bounds[c]:bounds[c + 1]] for c in range(self.ncells)]
+
+    def add(self, ids, vecs):
+        rows = super().add(ids, vecs)
+        if rows.size == 0:
+            return rows
+        if self.trained:
+            self._cell[rows] = np.argmax(self._mat[rows] @ self.centroids.T, axis=1)
+            self._lists = None
+        elif len(self) >= self.nlist * TRAIN_PER_LIST:
+            self.train()
+        return rows
+
+    def remove(self, ids):
+        super().remove(ids)
+        self._lists = None
+
+    def search(self, embs, k=1, nprobe=None):
+        if not self.trained:
+            return super().search(embs, k)
+        embs = normalize_rows(embs)
+        F = embs.shape[0]
+        if len(self) == 0:
+            return _empty(F, k)
+        if self._lists is None:
+            self._build_lists()
+        ncells = self.ncells
+        nprobe = max(1, min(int(nprobe or self.nprobe), ncells))
+        coarse = embs @ self.centroids.T
+        probe = (np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+                 if nprobe < ncells else np.tile(np.arange(ncells), (F, 1)))
+        # group queries by cell so each probed cell is one matmul for all its queries
+        cand_ids = [[] for _ in range(F)]
+        cand_sims = [[] for _ in range(F)]
+        for c in np.unique(probe):
+            rows = self._lists[c]
+            if rows.size == 0:
+                continue
+            qs = np.nonzero((probe == c).any(axis=1))[0]
+            sims = embs[qs] @ self._mat[rows].T
+            for j, q in enumerate(qs):
+                cand_ids[q].append(self._ids[rows])
+                cand_sims[q].append(sims[j])
+        out_ids, out_sims = _empty(F, k)
+        for q in range(F):
+            if cand_ids[q]:
+                out_ids[q], out_sims[q] = _merge_top_k(np.concatenate(cand_ids[q]),
+                                                       np.concatenate(cand_sims[q]), k)
+        return out_ids, out_sims
+
+    def _state(self):
+        state = super()._state()
+        state.update(cell=self.cell, nlist=np.array(self.nlist), nprobe=np.array(self.nprobe),
+                     centroids=self.centroids if self.centroids is not None
+                     else np.zeros((0, self.dim), np.float32))
+        return state
+
+    def _restore(self, data):
+        self.nlist, self.nprobe = int(data["nlist"]), int(data["nprobe"])
+        self.centroids = data["centroids"].astype(np.float32) if data["centroids"].size else None
+        self._cell = data["cell"].astype(np.int64)
+        self._lists = None
+        super()._restore(data)
+
+
+BACKENDS = {"exact": ExactIndex, "ivf": IVFIndex}
+
+
+def new_index(kind="exact", dim=512, **kw):
+    return BACKENDS[kind](dim, **kw)
+
+
+def load_index(path):
+    with np.load(path, allow_pickle=False) as data:
+        kind = str(data["kind"])
+        idx = BACKENDS[kind](int(data["dim"]))
+        idx._restore(data)
+        idx.synced_at = float(data["synced_at"])
+    return idx
+
+
+# ---------------- Django side ----------------
+def resolve_kind(kind, n):
+    """"auto" -> "ivf" for galleries of at least FACE_INDEX_IVF_MIN_IDS ids, else "exact"."""
+    from django.conf import settings
+    if kind != "auto":
+        return kind
+    return "ivf" if n >= getattr(settings, "FACE_INDEX_IVF_MIN_IDS", AUTO_IVF_MIN_IDS) else "exact"
+
+
+def index_path():
+    from django.conf import settings
+    return os.path.join(str(getattr(settings, "FACE_INDEX_DIR", "var/face_index")), "campus.npz")
+
+
+def build_index(kind=None, **kw):
+    """Full build from every UserEmbeddingTemplate (one query)."""
+    from django.conf import settings
+    from apps.biometrics.models import UserEmbeddingTemplate
+    from apps.biometrics.services.vectors import unpack_matrix
+    kind = kind or getattr(settings, "FACE_INDEX_BACKEND", "auto")
+    started = time.time()
+    rows = list(UserEmbeddingTemplate.objects.values_list("user_id", "centroid"))
+    mat = unpack_matrix([c for _, c in rows])
+    kind = resolve_kind(kind, len(rows))
+    idx = new_index(kind, dim=mat.shape[1] if mat.size else 512, **kw)
+    if rows:
+        if kind == "ivf":
+            idx.train(mat)      # too few rows: stays exact until add() can train it
+        idx.add([u for u, _ in rows], mat)
+    idx.synced_at = started
+    return idx
+
+
+def sync_index(idx):
+    """
+    Incremental update: upsert templates modified since idx.synced_at and
+    drop ids whose template is gone. Returns (upserted, removed).
+    """
+    from django.utils import timezone
+    from apps.biometrics.models import UserEmbeddingTemplate
+    from apps.biometrics.services.vectors import unpack_matrix
+    started = time.time()
+    since = timezone.datetime.fromtimestamp(idx.synced_at, tz=timezone.get_current_timezone())
+    changed = list(UserEmbeddingTemplate.objects.filter(updated_at__gte=since)
+                   .values_list("user_id", "centroid"))
+    if changed:
+        idx.add([u for u, _ in changed], unpack_matrix([c for _, c in changed]))
+    live = set(UserEmbeddingTemplate.objects.values_list("user_id", flat=True))
+    gone = [int(u) for u in idx.ids if int(u) not in live]
+    idx.remove(gone)
+    idx.synced_at = started
+    return len(changed), len(gone)
+
+
+def load_or_build_index(path=None, kind=None):
+    """Open the persisted index (synced and re-saved if anything changed), or build it."""
+    from django.conf import settings
+    path = path or index_path()
+    if os.path.exists(path):
+        idx = load_index(path)
+        kind = kind or getattr(settings, "FACE_INDEX_BACKEND", "auto")
+        if kind == "auto":
+            from apps.biometrics.models import UserEmbeddingTemplate
+            kind = resolve_kind(kind, UserEmbeddingTemplate.objects.count())
+        if idx.kind != kind:
+            idx = build_index(kind)
+        elif not any(sync_index(idx)):
+            return idx
+    else:
+        idx = build_index(kind)
+    idx.save(path)
+    return idx
+
+
+def main(argv=None):
+    import argparse
+    import django
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+    django.setup()
+    ap = argparse.ArgumentParser(description="Build or sync the campus-wide face index")
+    ap.add_argument("--kind", choices=sorted(BACKENDS) + ["auto"], default=None)
+    ap.add_argument("--rebuild", action="store_true", help="full rebuild instead of incremental sync")
+    args = ap.parse_args(argv)
+    t0 = time.time()
+    if args.rebuild:
+        idx = build_index(args.kind)
+        idx.save(index_path())
+    else:
+        idx = load_or_build_index(kind=args.kind)
+    print(f"[INDEX] {idx.kind} index with {len(idx)} ids at {index_path()} ({time.time() - t0:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
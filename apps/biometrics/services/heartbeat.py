@@ -0,0 +1,100 @@
+# apps/biometrics/services/heartbeat.py
+"""
+Worker heartbeats, one small JSON file per worker:
+
+    <FACE_HEARTBEAT_DIR>/session_<id>.json   (room workers: room_<id>.json)
+    {"key", "pid", "ts", "fps", "frames", "last_frame_ts", "rss_mb", ...}
+
+Session workers write it every few seconds from their loop; the supervisor
+(apps/biometrics/supervisor.py) reads it to spot stalled workers and to
+learn the real memory cost of a worker for admission control.
+"""
+import os
+import json
+import time
+
+HEARTBEAT_S = 5.0
+
+
+def heartbeat_dir():
+    try:
+        from django.conf import settings
+        return str(getattr(settings, "FACE_HEARTBEAT_DIR", os.path.join("var", "heartbeats")))
+    except Exception:
+        return os.path.join("var", "heartbeats")
+
+
+def heartbeat_path(key):
+    """`key` is a session id, or "room:<id>" for a room-scoped worker."""
+    name = str(key).replace(":", "_") if str(key).startswith("room:") else f"session_{int(key)}"
+    return os.path.join(heartbeat_dir(), f"{name}.json")
+
+
+def rss_mb(pid=None):
+    """Resident memory of a process in MB (psutil when installed, else /proc), or None."""
+    pid = pid or os.getpid()
+    try:
+        import psutil  # optional
+        return psutil.Process(pid).memory_info().rss / 2**20
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError, IndexError):
+        return None
+
+
+class HeartbeatWriter:
+    """Call tick() once per processed frame; the file is rewritten every `every_s`."""
+
+    def __init__(self, key, every_s=HEARTBEAT_S):
+        self.key = key
+        self.every_s = every_s
+        self.path = heartbeat_path(key)
+        self.frames = 0
+        self.last_frame_ts = None
+        self._window_start = time.time()
+        self._window_frames = 0
+        self._last_beat = 0.0
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def tick(self, frame_ts=None, **extra):
+        self.frames += 1
+        self._window_frames += 1
+        self.last_frame_ts = frame_ts or time.time()
+        self.beat(**extra)
+
+    def beat(self, force=False, **extra):
+        now = time.time()
+        if not force and now - self._last_beat < self.every_s:
+            return
+        elapsed = max(now - self._window_start, 1e-6)
+        data = {"key": self.key, "pid": os.getpid(), "ts": now,
+                "fps": round(self._window_frames / elapsed, 2), "frames": self.frames,
+                "last_frame_ts": self.last_frame_ts, "rss_mb": rss_mb(), **extra}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[HEARTBEAT] could not write {self.path}: {e}")
+        self._last_beat = now
+        self._window_start, self._window_frames = now, 0
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def read_heartbeat(key):
+    try:
+        with open(heartbeat_path(key)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,387 @@
+# apps/biometrics/services/inference_server.py
+"""
+Shared face inference service.
+
+One long-lived process loads buffalo_l once and serves every session worker
+over localhost TCP, instead of each worker (and the web process) loading its
+own copy. Requests from all connected rooms go through one batcher, so the
+recognizer runs on the crops of several rooms in a single call.
+
+Run:
+    python -m apps.biometrics.services.inference_server --port 8765
+Workers use it when FACE_INFERENCE_ADDR (settings or env) is "host:port".
+The service reads FACE_MODEL (pack, det_size, threads) from the Django
+settings like any worker. A worker whose connection is refused or dropped
+switches to a local model for FALLBACK_RETRY_S, then tries the service
+again. A reply slower than FACE_INFERENCE_TIMEOUT_S only costs that frame:
+the call raises InferenceTimeout, which the camera loops skip, and the
+next call reconnects (a busy service is not a reason to load a second
+model next to it).
+
+Wire format (both directions):
+    !II header_len, blob_len | JSON header | raw blob
+  detect: header {"op": "detect", "shape": [h, w, 3], "max_num": 0}, blob = uint8 BGR frame
+          reply  {"n": N, "has_kps": bool}, blob = float32 bboxes (N, 5) [+ kps (N, 5, 2)]
+  embed:  header {"op": "embed", "shape": [n, 112, 112, 3]}, blob = uint8 aligned crops
+          reply  {"n": n, "dim": D}, blob = float32 (n, D)
+"""
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import numpy as np
+
+DEFAULT_PORT      = 8765
+BATCH_MAX         = 64      # max requests per batch
+BATCH_WAIT_MS     = 5       # how long to wait for more requests to join a batch
+CALL_TIMEOUT_S    = 2.0     # default FACE_INFERENCE_TIMEOUT_S: a later reply skips the frame
+FALLBACK_RETRY_S  = 30.0    # how long a worker stays on its local model before retrying
+_HDR = struct.Struct("!II")
+
+
+class InferenceTimeout(RuntimeError):
+    """The shared service did not answer within the client's timeout; skip this frame."""
+
+
+# ---------------- framing ----------------
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:], n - got)
+        if k == 0:
+            raise ConnectionError("inference socket closed")
+        got += k
+    return bytes(buf)
+
+
+def send_msg(sock, header: dict, blob: bytes = b""):
+    h = json.dumps(header).encode("utf-8")
+    sock.sendall(_HDR.pack(len(h), len(blob)) + h + blob)
+
+
+def recv_msg(sock):
+    hlen, blen = _HDR.unpack(_recv_exact(sock, _HDR.size))
+    header = json.loads(_recv_exact(sock, hlen).decode("utf-8"))
+    blob = _recv_exact(sock, blen) if blen else b""
+    return header, blob
+
+
+# ---------------- batcher ----------------
+class _Job:
+    __slots__ = ("op", "array", "max_num", "done", "result", "error")
+
+    def __init__(self, op, array, max_num=0):
+        self.op = op
+        self.array = array
+        self.max_num = max_num
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class InferenceBatcher(threading.Thread):
+    """
+    Collects jobs from all client connections and runs them in batches:
+      - embed jobs: all crops concatenated into ONE recognizer call,
+      - detect jobs: the frames of every room in ONE detector call
+        (detect_faces_batch; frame by frame when the detector cannot batch).
+    """
+
+    def __init__(self, app, batch_max=BATCH_MAX, batch_wait_ms=BATCH_WAIT_MS):
+        super().__init__(daemon=True, name="inference-batcher")
+        self.app = app
+        self.batch_max = batch_max
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.q = queue.Queue()
+        self.batches = 0
+        self.jobs = 0
+        self.crops = 0
+        self.frames = 0
+
+    def submit(self, job):
+        self.q.put(job)
+        job.done.wait()
+        if job.error:
+            raise RuntimeError(job.error)
+        return job.result
+
+    def _collect(self):
+        jobs = [self.q.get()]
+        deadline = time.time() + self.batch_wait
+        while len(jobs) < self.batch_max:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(self.q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _detect(self, detects):
+        from apps.biometrics.services.face import detect_faces_batch
+        by_max_num = {}
+        for j in detects:
+            by_max_num.setdefault(j.max_num, []).append(j)
+        for max_num, group in by_max_num.items():
+            try:
+                per_frame = detect_faces_batch(self.app, [j.array for j in group], max_num=max_num)
+                for j, faces in zip(group, per_frame):
+                    j.result = _face_arrays(faces)
+                self.frames += len(group)
+            except Exception as e:
+                for j in group:
+                    j.error = str(e)
+            for j in group:
+                j.done.set()
+
+    def run(self):
+        rec = self.app.models["recognition"]
+        while True:
+            jobs = self._collect()
+            embeds = [j for j in jobs if j.op == "embed"]
+            detects = [j for j in jobs if j.op == "detect"]
+            if detects:
+                self._detect(detects)
+            if embeds:
+                try:
+                    crops = [c for j in embeds for c in j.array]
+                    feats = np.asarray(rec.get_feat(crops), dtype=np.float32) if crops else None
+                    pos = 0
+                    for j in embeds:
+                        n = len(j.array)
+                        j.result = feats[pos:pos + n] if n else np.zeros((0, 0), np.float32)
+                        pos += n
+                    self.crops += len(crops)
+                except Exception as e:
+                    for j in embeds:
+                        j.error = str(e)
+                for j in embeds:
+                    j.done.set()
+            self.batches += 1
+            self.jobs += len(jobs)
+
+
+def _face_arrays(faces):
+    """Face list -> det_model.detect()'s (bboxes (N, 5), kpss (N, 5, 2) or None) for the wire."""
+    if not faces:
+        return np.zeros((0, 5), np.float32), None
+    bboxes = np.array([[*f.bbox[:4], f.det_score] for f in faces], dtype=np.float32)
+    if any(f.kps is None for f in faces):
+        return bboxes, None
+    return bboxes, np.stack([np.asarray(f.kps, dtype=np.float32) for f in faces])
+
+
+# ---------------- server ----------------
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        batcher = self.server.batcher
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                header, blob = recv_msg(sock)
+            except (ConnectionError, OSError):
+                return
+            op = header.get("op")
+            try:
+                if op == "detect":
+                    frame = np.frombuffer(blob, dtype=np.uint8).reshape(header["shape"])
+                    bboxes, kpss = batcher.submit(_Job("detect", frame, int(header.get("max_num", 0))))
+                    bboxes = np.ascontiguousarray(bboxes, dtype=np.float32)
+                    out = bboxes.tobytes()
+                    if kpss is not None:
+                        out += np.ascontiguousarray(kpss, dtype=np.float32).tobytes()
+                    send_msg(sock, {"n": int(bboxes.shape[0]), "has_kps": kpss is not None}, out)
+                elif op == "embed":
+                    crops = np.frombuffer(blob, dtype=np.uint8).reshape(header["shape"])
+                    feats = batcher.submit(_Job("embed", list(crops)))
+                    dim = int(feats.shape[1]) if feats.ndim == 2 and feats.shape[0] else 0
+                    send_msg(sock, {"n": int(crops.shape[0]), "dim": dim}, feats.tobytes())
+                elif op == "info":
+                    rec = batcher.app.models["recognition"]
+                    send_msg(sock, {"input_size": list(rec.input_size), "batches": batcher.batches,
+                                    "jobs": batcher.jobs, "crops": batcher.crops, "frames": batcher.frames})
+                else:
+                    send_msg(sock, {"error": f"unknown op {op!r}"})
+            except Exception as e:
+                send_msg(sock, {"error": str(e)})
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, app, **batch_kw):
+        super().__init__(addr, _Handler)
+        self.batcher = InferenceBatcher(app, **batch_kw)
+        self.batcher.start()
+
+
+# ---------------- client ----------------
+class InferenceClient:
+    """
+    Worker-side handle that looks like a model to detect_faces()/embed_faces()
+    in services/face.py: detection and recognition run in the shared service.
+
+    Every call waits at most `timeout`, then raises InferenceTimeout. With a
+    `fallback` (a loader such as model_factory.load_face_app) a refused or
+    dropped connection does not stop the worker: calls go to a local model,
+    loaded on first use, for `retry_s` seconds before the service is tried
+    again. Without one, connection errors propagate.
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, timeout=CALL_TIMEOUT_S,
+                 fallback=None, retry_s=FALLBACK_RETRY_S):
+        self.addr = (host, int(port))
+        self.timeout = timeout
+        self.fallback = fallback
+        self.retry_s = retry_s
+        self._lock = threading.Lock()
+        self._sock = None
+        self._local = None
+        self._remote_down_until = 0.0
+        self.fallbacks = 0
+        self.input_size = (112, 112)
+        # quack like FaceAnalysis for detect_faces()/embed_faces()
+        self.det_model = self
+        self.models = {"recognition": self}
+        info = self._call({"op": "info"})[0]
+        self.input_size = tuple(info.get("input_size", self.input_size))
+
+    def _connect(self):
+        s = socket.create_connection(self.addr, timeout=self.timeout)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = s
+
+    def _call(self, header, blob=b""):
+        with self._lock:
+            for attempt in (0, 1):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    send_msg(self._sock, header, blob)
+                    reply, out = recv_msg(self._sock)
+                    break
+                except socket.timeout:
+                    self.close()   # a late reply would desync the stream; never wait twice
+                    raise InferenceTimeout(f"no reply from {self.addr[0]}:{self.addr[1]} "
+                                           f"within {self.timeout:.1f}s") from None
+                except (ConnectionError, OSError):
+                    self.close()   # server restarted: reconnect once
+                    if attempt:
+                        raise
+        if "error" in reply:
+            raise RuntimeError(f"inference service: {reply['error']}")
+        return reply, out
+
+    def _local_app(self):
+        if self._local is None:
+            print(f"[INFER] loading a local model (fallback for {self.addr[0]}:{self.addr[1]})")
+            self._local = self.fallback()
+        return self._local
+
+    def _use_local(self):
+        return self.fallback is not None and time.time() < self._remote_down_until
+
+    def _remote_failed(self, e):
+        """Switch to the local model for `retry_s`; re-raise when there is no fallback."""
+        if self.fallback is None:
+            raise e
+        self.fallbacks += 1
+        self._remote_down_until = time.time() + self.retry_s
+        print(f"[INFER] shared service {self.addr[0]}:{self.addr[1]} failed ({str(e) or type(e).__name__}); "
+              f"using the local model for {self.retry_s:.0f}s")
+
+    def detect(self, frame, max_num=0, metric="default"):
+        if self._use_local():
+            return self._local_app().det_model.detect(frame, max_num=max_num, metric=metric)
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        try:
+            reply, out = self._call({"op": "detect", "shape": list(frame.shape), "max_num": max_num},
+                                    frame.tobytes())
+        except ConnectionError as e:     # refused, reset, closed
+            self._remote_failed(e)
+            return self._local_app().det_model.detect(frame, max_num=max_num, metric=metric)
+        n = reply["n"]
+        arr = np.frombuffer(out, dtype=np.float32)
+        bboxes = arr[:n * 5].reshape(n, 5)
+        kpss = arr[n * 5:].reshape(n, 5, 2) if reply.get("has_kps") else None
+        return bboxes, kpss
+
+    def get_feat(self, crops):
+        if self._use_local():
+            return self._local_app().models["recognition"].get_feat(crops)
+        batch = np.ascontiguousarray(np.stack(crops), dtype=np.uint8)
+        try:
+            reply, out = self._call({"op": "embed", "shape": list(batch.shape)}, batch.tobytes())
+        except ConnectionError as e:
+            self._remote_failed(e)
+            return self._local_app().models["recognition"].get_feat(crops)
+        return np.frombuffer(out, dtype=np.float32).reshape(reply["n"], reply["dim"])
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+
+def connect_or_none(addr, fallback=None):
+    """
+    Return an InferenceClient for "host:port", or None if unset/unreachable.
+    `fallback` loads a local model if the service goes away later on; calls
+    wait FACE_INFERENCE_TIMEOUT_S for a reply.
+    """
+    if not addr:
+        return None
+    from django.conf import settings
+    timeout = float(getattr(settings, "FACE_INFERENCE_TIMEOUT_S", CALL_TIMEOUT_S))
+    host, _, port = str(addr).rpartition(":")
+    try:
+        client = InferenceClient(host or "127.0.0.1", int(port or DEFAULT_PORT), timeout=timeout,
+                                 fallback=fallback)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"[INFER] shared service {addr} unavailable ({e}); loading a local model.")
+        return None
+    print(f"[INFER] Using shared inference service at {addr}")
+    return client
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Shared face inference service")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=DEFAULT_PORT)
+    ap.add_argument("--batch-max", type=int, default=BATCH_MAX)
+    ap.add_argument("--batch-wait-ms", type=float, default=BATCH_WAIT_MS)
+    args = ap.parse_args(argv)
+
+    # FACE_MODEL (pack, det_size, threads) comes from the project settings
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+    import django
+    django.setup()
+    from apps.biometrics.services.face import _get_app
+    app = _get_app()
+    srv = InferenceServer((args.host, args.port), app,
+                          batch_max=args.batch_max, batch_wait_ms=args.batch_wait_ms)
+    print(f"[INFER] Serving on {args.host}:{args.port} (pid={os.getpid()})")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
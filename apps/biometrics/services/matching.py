@@ -0,0 +1,151 @@
+# apps/biometrics/services/matching.py
+import numpy as np
+
+
+def normalize_rows(M: np.ndarray) -> np.ndarray:
+    """L2-normalize each row of M (float32, contiguous)."""
+    M = np.ascontiguousarray(M, dtype=np.float32)
+    if M.ndim == 1:
+        M = M[None, :]
+    norms = np.linalg.norm(M, axis=1, keepdims=True) + 1e-8
+    return M / norms
+
+
+def build_gallery_matrix(gallery: dict):
+    """
+    Pack a {label -> vector} gallery into aligned arrays.
+    Returns (labels: list, matrix: np.ndarray (N, D) float32, rows L2-normalized).
+    An empty gallery gives ([], None).
+    """
+    if not gallery:
+        return [], None
+    labels = list(gallery.keys())
+    matrix = normalize_rows(np.vstack([gallery[k] for k in labels]))
+    return labels, matrix
+
+
+def stack_embeddings(faces) -> np.ndarray:
+    """
+    Stack InsightFace Face objects into an (F, D) float32 matrix of
+    L2-normalized embeddings (same normalization as the per-face code).
+    """
+    rows = []
+    for f in faces:
+        emb = f.normed_embedding
+        if emb is None:
+            emb = f.embedding
+        rows.append(emb)
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    return normalize_rows(np.vstack(rows))
+
+
+def top_k(embs: np.ndarray, matrix: np.ndarray, k: int = 1):
+    """
+    Score all faces of a frame against the whole gallery in one matmul.
+      embs:   (F, D) L2-normalized
+      matrix: (N, D) L2-normalized, or a TemplateGallery (max over templates)
+    Returns (idx (F, k) int, sims (F, k) float32), best first per row.
+    """
+    if isinstance(matrix, TemplateGallery):
+        return matrix.top_k(embs, k)
+    F = embs.shape[0]
+    if matrix is None or F == 0 or matrix.shape[0] == 0:
+        return np.zeros((F, 0), dtype=np.int64), np.zeros((F, 0), dtype=np.float32)
+    return _top_k_scores(embs @ matrix.T, k)  # (F, N) cosine, both sides normalized
+
+
+def _top_k_scores(sims: np.ndarray, k: int):
+    n = sims.shape[1]
+    k = max(1, min(int(k), n))
+    if k == 1:
+        idx = np.argmax(sims, axis=1)[:, None]
+    else:
+        # rows sorted first so equal scores come out lowest row first, like argmax
+        part = np.sort(np.argpartition(-sims, k - 1, axis=1)[:, :k], axis=1)
+        order = np.argsort(-np.take_along_axis(sims, part, axis=1), axis=1, kind="stable")
+        idx = np.take_along_axis(part, order, axis=1)
+    return idx, np.take_along_axis(sims, idx, axis=1)
+
+
+def best_matches(embs: np.ndarray, labels, matrix: np.ndarray):
+    """Return [(best_label or None, best_sim:float), ...] aligned with embs rows."""
+    idx, sims = top_k(embs, matrix, k=1)
+    if idx.shape[1] == 0:
+        return [(None, -1.0)] * embs.shape[0]
+    return [(labels[int(i)], float(s)) for i, s in zip(idx[:, 0], sims[:, 0])]
+
+
+def cluster_templates(vecs: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Pick up to k representative embeddings with spherical k-means (cosine).
+    vecs: (n, D). Returns (min(n, k), D) L2-normalized centers.
+    """
+    X = normalize_rows(vecs)
+    n = X.shape[0]
+    if k <= 1:
+        return normalize_rows(X.sum(axis=0))
+    if n <= k:
+        return X
+    # farthest-point init: deterministic and spreads centers across poses
+    centers = [X[np.random.default_rng(seed).integers(n)]]
+    closest = X @ centers[0]
+    for _ in range(1, k):
+        centers.append(X[int(np.argmin(closest))])
+        closest = np.maximum(closest, X @ centers[-1])
+    C = np.vstack(centers)
+    for _ in range(iters):
+        assign = np.argmax(X @ C.T, axis=1)
+        for j in range(k):
+            members = X[assign == j]
+            if len(members):
+                C[j] = members.sum(axis=0)
+        C = normalize_rows(C)
+    return C
+
+
+class TemplateGallery:
+    """
+    Multi-template gallery: each of N labels owns k_i >= 1 template rows,
+    stored contiguously in one (M, D) matrix. Scoring is one (F, D) x (D, M)
+    matmul followed by a per-label max (np.maximum.reduceat), so a face is
+    scored against every template of every student in a single pass.
+
+    Budget: M * D * 4 bytes -> ~2 KB per template at D=512; 300 students x
+    K=5 is 1,500 rows = 3 MB and ~30 MFLOP per 40-face frame (well under a
+    millisecond on one core). 10k students x K=5 = 100 MB; use the ANN index
+    for campus-wide search instead.
+    """
+
+    def __init__(self, per_label):
+        per_label = [np.atleast_2d(np.asarray(t, dtype=np.float32)) for t in per_label]
+        counts = np.array([t.shape[0] for t in per_label], dtype=np.int64)
+        if len(per_label) and counts.min() < 1:
+            raise ValueError("every label needs at least one template")
+        self.n_labels = len(per_label)
+        self.starts = np.concatenate([[0], np.cumsum(counts)[:-1]]) if len(counts) else counts
+        self.owner = np.repeat(np.arange(self.n_labels), counts)
+        self.matrix = normalize_rows(np.vstack(per_label)) if per_label else None
+        self.shape = (self.n_labels, 0 if self.matrix is None else self.matrix.shape[1])
+
+    @classmethod
+    def from_rows(cls, centroids: np.ndarray, extra_by_row: dict = None):
+        """One label per centroid row; rows with extra templates use those instead."""
+        extra_by_row = extra_by_row or {}
+        return cls([extra_by_row.get(i, centroids[i]) for i in range(centroids.shape[0])])
+
+    def templates(self, i) -> np.ndarray:
+        """Template rows of label i, (k_i, D)."""
+        end = self.starts[i + 1] if i + 1 < self.n_labels else self.matrix.shape[0]
+        return self.matrix[self.starts[i]:end]
+
+    def scores(self, embs: np.ndarray) -> np.ndarray:
+        """(F, N) best cosine per label."""
+        sims = embs @ self.matrix.T
+        return np.maximum.reduceat(sims, self.starts, axis=1)
+
+    def top_k(self, embs: np.ndarray, k: int = 1):
+        F = embs.shape[0]
+        if self.matrix is None or F == 0:
+            return np.zeros((F, 0), dtype=np.int64), np.zeros((F, 0), dtype=np.float32)
+        return _top_k_scores(self.scores(embs), k)
@@ -0,0 +1,172 @@
+# apps/biometrics/services/model_factory.py
+"""
+One place that builds the InsightFace model used by every entry point
+(session workers, the shared inference service, training, build_gallery.py,
+cam_test.py).
+
+Only the detector and the recognizer are loaded (allowed_modules): the
+pack's gender/age and 2D/3D landmark models are never used here, and
+FaceAnalysis.get() would otherwise run every one of them on every face.
+The recognizer always comes from `pack` (gallery embeddings must stay in
+the same space); the detector may come from a lighter pack, e.g.
+det_pack="buffalo_s" (det_500m) for small rooms, with a smaller det_size.
+
+Optimized-graph cache: the first load writes ORT's optimized graph of each
+loaded model to <cache_dir>/<pack>+<det_pack>/ort<version>-<provider>-<level>/
+(in a background thread, so that first worker is not delayed). Later
+loads build their sessions straight from those files with graph
+optimization disabled, which skips the optimizer pass at every startup.
+A manifest (written last) marks the cache complete and restores each
+model's input mean/std, which InsightFace would otherwise re-derive from
+node names of the rewritten graph.
+
+Settings (optional; scripts without Django get the defaults):
+    FACE_MODEL = {"pack": "buffalo_l", "det_pack": None, "det_size": 640,
+                  "intra_threads": 0, "inter_threads": 1,
+                  "graph_opt": "all", "cache_dir": "var/ort_cache"}
+"""
+import glob
+import json
+import os
+import threading
+
+DEFAULTS = {
+    "pack": "buffalo_l",
+    "det_pack": None,          # None = detector from `pack`
+    "det_size": 640,           # int or (w, h)
+    "intra_threads": 0,        # ORT intra-op threads per session (0 = ORT default: all cores)
+    "inter_threads": 1,
+    "providers": ["CPUExecutionProvider"],
+    "modules": ("detection", "recognition"),
+    "graph_opt": "all",        # ORT graph optimization level: disable | basic | extended | all
+    "cache_dir": None,         # optimized-graph cache root; None disables the cache
+}
+_MANIFEST = "manifest.json"
+
+
+def model_config(**overrides) -> dict:
+    """DEFAULTS <- settings.FACE_MODEL <- explicit overrides (None values ignored)."""
+    conf = dict(DEFAULTS)
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    try:
+        conf.update(getattr(settings, "FACE_MODEL", {}) or {})
+    except ImproperlyConfigured:
+        print("[MODEL] Django settings not configured; using the built-in FACE_MODEL defaults")
+    conf.update({k: v for k, v in overrides.items() if v is not None})
+    return conf
+
+
+def session_options(intra_threads=0, inter_threads=1, graph_opt="all", optimized_path=None):
+    """Explicit ORT SessionOptions (threads, optimization level, optional optimized-graph output)."""
+    import onnxruntime as ort
+    levels = {"disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+              "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+              "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+              "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+    so = ort.SessionOptions()
+    so.graph_optimization_level = levels[graph_opt]
+    if intra_threads:
+        so.intra_op_num_threads = int(intra_threads)
+    if inter_threads:
+        so.inter_op_num_threads = int(inter_threads)
+    if optimized_path:
+        so.optimized_model_filepath = str(optimized_path)
+    return so
+
+
+def _det_size(v):
+    return (int(v), int(v)) if isinstance(v, (int, float)) else tuple(int(x) for x in v)
+
+
+def _pack_dir(name, root="~/.insightface"):
+    from insightface.utils.storage import ensure_available
+    return ensure_available("models", name, root=root)
+
+
+def _load_detector(det_pack, **ort_kwargs):
+    from insightface.model_zoo import model_zoo
+    for path in sorted(glob.glob(os.path.join(_pack_dir(det_pack), "*.onnx"))):
+        model = model_zoo.get_model(path, **ort_kwargs)
+        if model is not None and model.taskname == "detection":
+            return model
+    raise RuntimeError(f"no detection model in pack {det_pack!r}")
+
+
+def graph_cache_dir(conf):
+    """Per pack / ORT version / provider / optimization level; None when caching is off."""
+    if not conf.get("cache_dir"):
+        return None
+    import onnxruntime as ort
+    provider = str(conf["providers"][0]).replace("ExecutionProvider", "").lower()
+    packs = conf["pack"] + (f"+{conf['det_pack']}" if conf["det_pack"] else "")
+    return os.path.abspath(os.path.join(str(conf["cache_dir"]), packs,
+                                        f"ort{ort.__version__}-{provider}-{conf['graph_opt']}"))
+
+
+def _write_graph_cache(app, cache_dir, conf):
+    """Save ORT's optimized graph of every loaded model, then the manifest."""
+    import onnxruntime as ort
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        models = {}
+        for task, model in app.models.items():
+            name = os.path.basename(model.model_file)
+            so = session_options(1, 1, conf["graph_opt"], optimized_path=os.path.join(cache_dir, name))
+            ort.InferenceSession(model.model_file, so, providers=list(conf["providers"]))
+            models[name] = {"task": task,
+                            "input_mean": float(getattr(model, "input_mean", 127.5)),
+                            "input_std": float(getattr(model, "input_std", 128.0))}
+        tmp = os.path.join(cache_dir, f"{_MANIFEST}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"ort": ort.__version__, "graph_opt": conf["graph_opt"], "models": models}, f)
+        os.replace(tmp, os.path.join(cache_dir, _MANIFEST))
+        print(f"[MODEL] optimized graphs cached in {cache_dir}")
+    except Exception as e:
+        print(f"[MODEL] could not cache optimized graphs: {e}")
+
+
+def _read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, _MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    files = manifest.get("models", {})
+    if not files or not all(os.path.exists(os.path.join(cache_dir, n)) for n in files):
+        return None
+    return manifest
+
+
+def load_face_app(pack=None, det_pack=None, det_size=None, intra_threads=None, inter_threads=None,
+                  modules=None, graph_opt=None, cache_dir=None, ctx_id=0):
+    """Build and prepare a FaceAnalysis with only the modules we use."""
+    from insightface.app import FaceAnalysis
+    conf = model_config(pack=pack, det_pack=det_pack, det_size=det_size, intra_threads=intra_threads,
+                        inter_threads=inter_threads, modules=modules, graph_opt=graph_opt, cache_dir=cache_dir)
+    cache = graph_cache_dir(conf)
+    manifest = _read_manifest(cache) if cache else None
+
+    if manifest is not None:
+        # pre-optimized graphs: the directory holds exactly our det + rec models
+        so = session_options(conf["intra_threads"], conf["inter_threads"], "disable")
+        app = FaceAnalysis(name=cache, providers=list(conf["providers"]), sess_options=so)
+        for model in app.models.values():
+            saved = manifest["models"].get(os.path.basename(model.model_file), {})
+            if "input_mean" in saved:
+                model.input_mean, model.input_std = saved["input_mean"], saved["input_std"]
+    else:
+        ort_kwargs = {"providers": list(conf["providers"]),
+                      "sess_options": session_options(conf["intra_threads"], conf["inter_threads"],
+                                                      conf["graph_opt"])}
+        app = FaceAnalysis(name=conf["pack"], allowed_modules=list(conf["modules"]), **ort_kwargs)
+        if conf["det_pack"] and conf["det_pack"] != conf["pack"]:
+            app.models["detection"] = app.det_model = _load_detector(conf["det_pack"], **ort_kwargs)
+        if cache:
+            threading.Thread(target=_write_graph_cache, args=(app, cache, conf),
+                             daemon=True, name="ort-graph-cache").start()
+    app.prepare(ctx_id=ctx_id, det_size=_det_size(conf["det_size"]))
+    print(f"[MODEL] {conf['pack']} det={conf['det_pack'] or conf['pack']}@{conf['det_size']} "
+          f"modules={sorted(app.models)} threads={conf['intra_threads'] or 'auto'}/{conf['inter_threads']} "
+          f"graph={'cached' if manifest else conf['graph_opt']}")
+    return app
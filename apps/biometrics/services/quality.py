@@ -0,0 +1,114 @@
+# apps/biometrics/services/quality.py
+"""
+Pre-recognition quality gate on detector output.
+
+Cheap checks, cheapest first, so a face that will never clear the
+similarity threshold does not cost a recognizer call:
+  small     bbox shorter side < min_box px
+  low_score detector score < min_score
+  yaw/pitch head pose from the 5 landmarks beyond max_yaw / max_pitch degrees
+  blur      variance of the Laplacian of the face crop (resized to 64 px) < min_blur
+"""
+import numpy as np
+import cv2
+
+REASONS = ("small", "low_score", "yaw", "pitch", "blur")
+DEFAULTS = {"min_box": 40, "min_score": 0.60, "max_yaw": 35.0, "max_pitch": 30.0, "min_blur": 40.0}
+_BLUR_SIDE = 64
+
+
+def head_pose(kps):
+    """
+    Rough (yaw, pitch) in degrees from InsightFace's 5 points
+    (left eye, right eye, nose, left mouth, right mouth). Landmarks are
+    de-rolled first so only out-of-plane rotation is measured.
+    """
+    kps = np.asarray(kps, dtype=np.float32)
+    le, re, nose, lm, rm = kps
+    d = re - le
+    eye_dist = float(np.hypot(d[0], d[1])) + 1e-6
+    c, s = d[0] / eye_dist, d[1] / eye_dist
+    rot = np.array([[c, s], [-s, c]], dtype=np.float32)     # undo roll
+    eyes_mid = (le + re) / 2
+    p = (kps - eyes_mid) @ rot.T
+    nose_p, mouth_mid = p[2], (p[3] + p[4]) / 2
+    # frontal: nose sits on the eye midline; at 90 deg yaw it reaches an eye
+    yaw = np.degrees(np.arcsin(np.clip(nose_p[0] / (eye_dist / 2), -1.0, 1.0)))
+    # frontal: nose ~55% of the way from the eye line to the mouth line
+    span = float(mouth_mid[1]) + 1e-6
+    pitch = np.degrees(np.arcsin(np.clip((nose_p[1] / span - 0.55) / 0.45, -1.0, 1.0)))
+    return float(yaw), float(pitch)
+
+
+def blur_score(frame, bbox):
+    """Variance of the Laplacian of the face crop at a fixed size (higher = sharper)."""
+    h, w = frame.shape[:2]
+    x1, y1, x2, y2 = [int(v) for v in bbox[:4]]
+    x1, y1, x2, y2 = max(0, x1), max(0, y1), min(w, x2), min(h, y2)
+    if x2 - x1 < 2 or y2 - y1 < 2:
+        return 0.0
+    crop = cv2.resize(frame[y1:y2, x1:x2], (_BLUR_SIDE, _BLUR_SIDE), interpolation=cv2.INTER_AREA)
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    return float(cv2.Laplacian(crop, cv2.CV_64F).var())
+
+
+class QualityGate:
+    """Filter faces before embed_faces(); counts every skip by reason."""
+
+    def __init__(self, min_box=DEFAULTS["min_box"], min_score=DEFAULTS["min_score"],
+                 max_yaw=DEFAULTS["max_yaw"], max_pitch=DEFAULTS["max_pitch"], min_blur=DEFAULTS["min_blur"]):
+        self.min_box = min_box
+        self.min_score = min_score
+        self.max_yaw = max_yaw
+        self.max_pitch = max_pitch
+        self.min_blur = min_blur
+        self.counts = {"checked": 0, "passed": 0, **{r: 0 for r in REASONS}}
+
+    @classmethod
+    def from_settings(cls):
+        """settings.FACE_QUALITY_GATE overrides DEFAULTS; None disables the gate."""
+        from django.conf import settings
+        conf = getattr(settings, "FACE_QUALITY_GATE", {})
+        if conf is None:
+            return None
+        return cls(**{**DEFAULTS, **conf})
+
+    def reason(self, frame, face):
+        """First failed check, or None when the face is worth embedding."""
+        x1, y1, x2, y2 = face.bbox[:4]
+        if min(x2 - x1, y2 - y1) < self.min_box:
+            return "small"
+        score = getattr(face, "det_score", None)
+        if score is not None and score < self.min_score:
+            return "low_score"
+        if face.kps is not None:
+            yaw, pitch = head_pose(face.kps)
+            if abs(yaw) > self.max_yaw:
+                return "yaw"
+            if abs(pitch) > self.max_pitch:
+                return "pitch"
+        if self.min_blur and blur_score(frame, face.bbox) < self.min_blur:
+            return "blur"
+        return None
+
+    def filter(self, frame, faces, idx=None):
+        """
+        Keep the faces that pass. `idx` (parallel to faces, e.g. track indices)
+        is filtered the same way. Returns (kept_faces, kept_idx).
+        """
+        idx = list(range(len(faces))) if idx is None else list(idx)
+        kept, kept_idx = [], []
+        for f, i in zip(faces, idx):
+            self.counts["checked"] += 1
+            why = self.reason(frame, f)
+            if why is None:
+                self.counts["passed"] += 1
+                kept.append(f)
+                kept_idx.append(i)
+            else:
+                self.counts[why] += 1
+        return kept, kept_idx
+
+    def stats(self):
+        return dict(self.counts)
@@ -0,0 +1,47 @@
+# apps/biometrics/services/startup_metrics.py
+import os
+import json
+import time
+
+START_ENV = "FACE_SESSION_START_TS"   # set by launch_face_worker() for the child process
+
+
+class StartupClock:
+    """
+    Time-to-first-recognition of a session worker. Seconds from session
+    start (START_ENV, else clock creation) to each milestone:
+      model_ready, camera_open, first_frame, first_face, first_recognition.
+    On first_recognition the marks are printed, kept in the cache under
+    sess:<id>:startup and appended to FACE_STARTUP_METRICS_FILE (JSON lines).
+    """
+
+    def __init__(self, session_id, t0=None, log_prefix="[METRIC]"):
+        self.session_id = session_id
+        self.t0 = float(t0 or os.environ.get(START_ENV) or time.time())
+        self.log_prefix = log_prefix
+        self.marks = {}
+        self.reported = False
+
+    def mark(self, name):
+        if name not in self.marks:
+            self.marks[name] = round(time.time() - self.t0, 3)
+            if name == "first_recognition":
+                self.report()
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+        print(f"{self.log_prefix} session={self.session_id} startup {self.marks}")
+        try:
+            from django.conf import settings
+            from django.core.cache import cache
+            cache.set(f"sess:{self.session_id}:startup", dict(self.marks), 6 * 3600)
+            path = getattr(settings, "FACE_STARTUP_METRICS_FILE", None)
+            if path:
+                os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"session_id": self.session_id, "pid": os.getpid(),
+                                        "ts": time.time(), **self.marks}) + "\n")
+        except Exception as e:
+            print(f"{self.log_prefix} could not record startup metrics: {e}")
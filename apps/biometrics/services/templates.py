@@ -0,0 +1,138 @@
+# apps/biometrics/services/templates.py
+"""
+Running-mean face templates.
+
+UserEmbeddingTemplate keeps the unnormalized float32 sum of a user's
+embeddings plus their count, so adding, removing or replacing one embedding
+is a constant-time update: centroid = normalize(sum). recompute_template()
+rebuilds from every stored vector and is the consistency check / fallback
+(legacy rows without a stored sum are rebuilt on first touch).
+"""
+import numpy as np
+from django.db import transaction
+from apps.biometrics.models import UserFaceEmbedding, UserEmbeddingTemplate
+from apps.biometrics.services.vectors import pack_vector, unpack_vector, unpack_matrix
+
+
+def _normalized(v):
+    return v / (np.linalg.norm(v) + 1e-8)
+
+
+def recompute_template(user_id):
+    """Full recompute from all stored vectors. Returns the template, or None if the user has none."""
+    vecs = list(UserFaceEmbedding.objects.filter(face__user_id=user_id).values_list("vector", flat=True))
+    if not vecs:
+        UserEmbeddingTemplate.objects.filter(user_id=user_id).delete()
+        return None
+    total = unpack_matrix(vecs).sum(axis=0)
+    tpl, _ = UserEmbeddingTemplate.objects.update_or_create(
+        user_id=user_id,
+        defaults={"centroid": pack_vector(_normalized(total)),
+                  "vector_sum": pack_vector(total, dtype="float32"),
+                  "count": len(vecs)},
+    )
+    return tpl
+
+
+def apply_delta(user_id, delta_sum, delta_count, recompute_missing=True):
+    """
+    O(1) update: sum += delta_sum, count += delta_count, centroid re-normalized.
+    Falls back to recompute_template() when there is no stored running sum
+    (unless recompute_missing=False, e.g. while the user is being deleted).
+    """
+    delta_sum = np.asarray(delta_sum, dtype=np.float32)
+    with transaction.atomic():
+        tpl = UserEmbeddingTemplate.objects.select_for_update().filter(user_id=user_id).first()
+        if tpl is None or not tpl.vector_sum:
+            return recompute_template(user_id) if recompute_missing else None
+        total = unpack_vector(tpl.vector_sum) + delta_sum
+        count = int(tpl.count) + int(delta_count)
+        if count <= 0:
+            tpl.delete()
+            return None
+        tpl.vector_sum = pack_vector(total, dtype="float32")
+        tpl.centroid = pack_vector(_normalized(total))
+        tpl.count = count
+        tpl.save(update_fields=["vector_sum", "centroid", "count", "updated_at"])
+        return tpl
+
+
+def add_embedding(user_id, vec):
+    return apply_delta(user_id, vec, +1)
+
+
+def remove_embedding(user_id, vec, recompute_missing=True):
+    return apply_delta(user_id, -np.asarray(vec, dtype=np.float32), -1, recompute_missing)
+
+
+def replace_embedding(user_id, old_vec, new_vec):
+    return apply_delta(user_id, np.asarray(new_vec, np.float32) - np.asarray(old_vec, np.float32), 0)
+
+
+def check_template(user_id, atol=1e-3) -> bool:
+    """Consistency check: does the running sum/count match a full recompute?"""
+    tpl = UserEmbeddingTemplate.objects.filter(user_id=user_id).first()
+    vecs = list(UserFaceEmbedding.objects.filter(face__user_id=user_id).values_list("vector", flat=True))
+    if tpl is None or not tpl.vector_sum:
+        return tpl is None and not vecs
+    if tpl.count != len(vecs):
+        return False
+    return bool(np.allclose(unpack_vector(tpl.vector_sum), unpack_matrix(vecs).sum(axis=0), atol=atol))
+
+
+def load_user_templates(user_ids, k) -> dict:
+    """
+    Multi-template gallery source: for each user, up to k L2-normalized
+    templates clustered from their stored embeddings (one query for all users).
+    Returns {user_id: (k_i, D) float32}; users without embeddings are absent.
+    """
+    from apps.biometrics.services.matching import cluster_templates
+    rows = list(UserFaceEmbedding.objects.filter(face__user_id__in=[int(u) for u in user_ids])
+                .order_by("face__user_id", "id").values_list("face__user_id", "vector"))
+    if not rows:
+        return {}
+    mat = unpack_matrix([v for _, v in rows])
+    owners = np.array([u for u, _ in rows])
+    out = {}
+    for uid in np.unique(owners):
+        out[int(uid)] = cluster_templates(mat[owners == uid], k)
+    return out
+
+
+def gallery_for_rows(row_user_ids, centroids, k=None):
+    """
+    Centroid matrix -> matcher for top_k()/best_matches(). With
+    settings.FACE_GALLERY_TEMPLATES = k > 1 each row is replaced by up to k
+    clustered templates (TemplateGallery, max over templates); k <= 1 returns
+    the centroid matrix unchanged.
+    """
+    from django.conf import settings
+    from apps.biometrics.services.matching import TemplateGallery
+    k = int(k if k is not None else getattr(settings, "FACE_GALLERY_TEMPLATES", 1))
+    if k <= 1 or centroids is None:
+        return centroids
+    per_user = load_user_templates(row_user_ids, k)
+    extra = {i: per_user[int(u)] for i, u in enumerate(row_user_ids) if int(u) in per_user}
+    gallery = TemplateGallery.from_rows(centroids, extra)
+    print(f"[GALLERY] {gallery.n_labels} labels, {gallery.matrix.shape[0]} templates (k<={k}), "
+          f"{gallery.matrix.nbytes / 1e6:.1f} MB")
+    return gallery
+
+
+def update_gallery_rows(matcher, row_user_ids, centroids, rows, k=None):
+    """
+    gallery_for_rows() after `rows` changed (updated, added or tombstoned):
+    only those users' templates are re-clustered; every other row keeps the
+    templates it already has in `matcher`. Rows past the old matcher's end
+    count as changed.
+    """
+    from django.conf import settings
+    from apps.biometrics.services.matching import TemplateGallery
+    k = int(k if k is not None else getattr(settings, "FACE_GALLERY_TEMPLATES", 1))
+    if k <= 1 or centroids is None or not isinstance(matcher, TemplateGallery):
+        return gallery_for_rows(row_user_ids, centroids, k)
+    rows = set(rows) | set(range(matcher.n_labels, centroids.shape[0]))
+    per_user = load_user_templates([row_user_ids[i] for i in rows if int(row_user_ids[i]) >= 0], k)
+    blocks = [per_user.get(int(row_user_ids[i]), centroids[i]) if i in rows else matcher.templates(i)
+              for i in range(centroids.shape[0])]
+    return TemplateGallery(blocks)
@@ -0,0 +1,131 @@
+# apps/biometrics/services/tracking.py
+import time
+import numpy as np
+
+# Defaults (override per worker)
+TRACK_IOU_MIN      = 0.30   # detector boxes must overlap this much to continue a track
+TRACK_MAX_MISSES   = 15     # frames a track may go unseen before it is dropped
+TRACK_REVERIFY_S   = 60.0   # re-embed resolved tracks this often to catch identity swaps
+TRACK_RETRY_FRAMES = 1      # unresolved tracks are re-embedded every N frames
+
+
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU between (T, 4) and (D, 4) xyxy boxes -> (T, D)."""
+    if a.size == 0 or b.size == 0:
+        return np.zeros((a.shape[0], b.shape[0]), dtype=np.float32)
+    ix1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    iy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    iy2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-8)
+
+
+class Track:
+    __slots__ = ("track_id", "bbox", "label", "sim", "hits", "misses",
+                 "last_embed_ts", "frames_since_embed")
+
+    def __init__(self, track_id, bbox):
+        self.track_id = track_id
+        self.bbox = bbox
+        self.label = None          # gallery label once resolved
+        self.sim = -1.0
+        self.hits = 0
+        self.misses = 0
+        self.last_embed_ts = 0.0
+        self.frames_since_embed = 0
+
+    @property
+    def resolved(self):
+        return self.label is not None
+
+
+class FaceTracker:
+    """
+    Gives each detected face a stable track id across frames by greedy IoU
+    association on the detector boxes, and decides which tracks actually need
+    the recognizer this frame:
+      - new tracks,
+      - unresolved tracks (every `retry_frames` frames),
+      - resolved tracks due for periodic re-verification.
+    A resolved track keeps its identity without re-embedding in between.
+    """
+
+    def __init__(self, iou_min=TRACK_IOU_MIN, max_misses=TRACK_MAX_MISSES,
+                 reverify_s=TRACK_REVERIFY_S, retry_frames=TRACK_RETRY_FRAMES):
+        self.iou_min = iou_min
+        self.max_misses = max_misses
+        self.reverify_s = reverify_s
+        self.retry_frames = max(1, int(retry_frames))
+        self.tracks = {}
+        self._next_id = 1
+        # counters: how many faces we saw vs how many we actually embedded
+        self.faces_seen = 0
+        self.embeds_run = 0
+
+    def update(self, faces):
+        """Associate this frame's detections with tracks. Returns [Track] aligned with faces."""
+        boxes = np.array([f.bbox[:4] for f in faces], dtype=np.float32).reshape(-1, 4)
+        ids = list(self.tracks.keys())
+        prev = np.array([self.tracks[t].bbox for t in ids], dtype=np.float32).reshape(-1, 4)
+
+        assigned = [None] * len(faces)
+        used = set()
+        ious = iou_matrix(prev, boxes)
+        if ious.size:
+            order = np.dstack(np.unravel_index(np.argsort(-ious, axis=None), ious.shape))[0]
+            for ti, di in order:
+                if ious[ti, di] < self.iou_min:
+                    break
+                if assigned[di] is not None or ti in used:
+                    continue
+                assigned[di] = self.tracks[ids[ti]]
+                used.add(ti)
+
+        for ti, tid in enumerate(ids):
+            if ti not in used:
+                t = self.tracks[tid]
+                t.misses += 1
+                if t.misses > self.max_misses:
+                    del self.tracks[tid]
+
+        for di, f in enumerate(faces):
+            t = assigned[di]
+            if t is None:
+                t = Track(self._next_id, boxes[di])
+                self.tracks[t.track_id] = t
+                self._next_id += 1
+                assigned[di] = t
+            t.bbox = boxes[di]
+            t.hits += 1
+            t.misses = 0
+            t.frames_since_embed += 1
+
+        self.faces_seen += len(faces)
+        return assigned
+
+    def needs_embedding(self, track, now=None):
+        now = time.time() if now is None else now
+        if track.last_embed_ts == 0.0:
+            return True
+        if not track.resolved:
+            return track.frames_since_embed >= self.retry_frames
+        return (now - track.last_embed_ts) >= self.reverify_s
+
+    def record(self, track, label, sim, threshold, now=None):
+        """Store a recognizer result on the track; resolves it when sim >= threshold."""
+        track.last_embed_ts = time.time() if now is None else now
+        track.frames_since_embed = 0
+        self.embeds_run += 1
+        if label is not None and sim >= threshold:
+            track.label, track.sim = label, sim
+        else:
+            # failed (re-)verification -> back to unresolved
+            track.label, track.sim = None, sim
+
+    def stats(self):
+        saved = 1.0 - (self.embeds_run / self.faces_seen) if self.faces_seen else 0.0
+        return {"tracks": len(self.tracks), "faces_seen": self.faces_seen,
+                "embeds_run": self.embeds_run, "saved_ratio": round(saved, 3)}
@@ -0,0 +1,39 @@
+# apps/biometrics/services/train_pool.py
+"""
+Process-pool side of parallel training. Workers never touch the ORM or
+django.setup(); they import services.face, whose model loader reads
+settings.FACE_MODEL, so the project settings module is imported in every
+worker. Each worker loads its own model once in the pool initializer.
+"""
+import os
+import hashlib
+from apps.biometrics.services import face as face_service
+
+
+def init_worker(threads_per_worker=1):
+    # RUN_MAIN (inherited from runserver's reloader) would make the settings
+    # import below start the scheduler in every pool process
+    os.environ.pop("RUN_MAIN", None)
+    face_service.set_app_threads(threads_per_worker)
+    face_service._get_app()
+
+
+def embed_job(job):
+    """
+    job = (face_id, image_path, known_hash or None)
+    Returns (face_id, digest, vector or None, status) with status in
+    {"embedded", "reused", "no_face", "error:<msg>"}.
+    """
+    face_id, path, known_hash = job
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return face_id, None, None, f"error:{e}"
+    digest = hashlib.sha256(data).hexdigest()
+    if known_hash is not None and digest == known_hash:
+        return face_id, digest, None, "reused"
+    emb = face_service.embed_from_image_bytes(data)
+    if emb is None:
+        return face_id, digest, None, "no_face"
+    return face_id, digest, emb, "embedded"
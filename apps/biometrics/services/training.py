@@ -1,49 +1,223 @@
 # apps/biometrics/services/training.py
-from typing import Iterable, Optional
+import os
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Optional
 import numpy as np
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
 from apps.biometrics.models import UserFace, UserFaceEmbedding, UserEmbeddingTemplate
 from apps.biometrics.services.face import embed_from_image_bytes
+from apps.biometrics.services.vectors import pack_vector, unpack_vector, MODEL_VERSION
+from apps.biometrics.services import train_pool
+from apps.biometrics.services.templates import recompute_template, add_embedding, replace_embedding, apply_delta
 
 User = get_user_model()
 
-def train_users(user_ids: Optional[Iterable[int]] = None) -> dict:
+PROGRESS_KEY = "biometrics:train:progress"
+WRITE_BATCH  = 200   # embeddings per bulk transaction in parallel mode
+
+
+def image_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def rebuild_centroids(user_ids) -> int:
+    """Full recompute of the L2-normalized mean template for each given user. Returns how many were written."""
+    return sum(1 for uid in user_ids if recompute_template(uid) is not None)
+
+
+def _stale_template_users(user_ids=None) -> set:
+    """
+    Users whose template does not reflect their embeddings (missing template or
+    count mismatch) - e.g. a previous run died between embedding and centroid.
+    """
+    qs = UserFaceEmbedding.objects.values("face__user_id").annotate(n=Count("id"))
+    if user_ids is not None:
+        qs = qs.filter(face__user_id__in=list(user_ids))
+    counts = {r["face__user_id"]: r["n"] for r in qs}
+    have = dict(UserEmbeddingTemplate.objects.filter(user_id__in=list(counts)).values_list("user_id", "count"))
+    return {uid for uid, n in counts.items() if have.get(uid) != n}
+
+
+def train_users(user_ids: Optional[Iterable[int]] = None, full: bool = False,
+                workers: Optional[int] = None, progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Incremental by default: a UserFace whose image content hash and model
+    version match its stored embedding is skipped, and only users whose
+    embedding set changed get their centroid rebuilt. Every embedding is
+    committed as soon as it is computed, so a crashed/timed-out run resumes
+    where it stopped. full=True re-embeds everything (old behaviour).
+    workers > 1 spreads the photos over a process pool (train_users_parallel).
+    """
+    if workers and workers > 1:
+        return train_users_parallel(user_ids, full=full, workers=workers, progress=progress)
+
     if user_ids is None:
-        qs_faces = UserFace.objects.select_related("user").all()
+        qs_faces = UserFace.objects.select_related("user", "embedding").all()
     else:
-        qs_faces = UserFace.objects.select_related("user").filter(user_id__in=list(user_ids))
-
-    # Wipe embeddings for selected users
-    target_user_ids = set(qs_faces.values_list("user_id", flat=True))
-    if target_user_ids:
-        UserFaceEmbedding.objects.filter(face__user_id__in=target_user_ids).delete()
+        user_ids = list(user_ids)
+        qs_faces = UserFace.objects.select_related("user", "embedding").filter(user_id__in=user_ids)
 
     created_emb = 0
+    reused_emb = 0
     skipped_no_face = 0
     users_touched = set()
 
-    for face in qs_faces:
+    for face in qs_faces.iterator():
         with face.image.open("rb") as f:
-            emb = embed_from_image_bytes(f.read())  # <-- buffalo_l normalized
+            data = f.read()
+        digest = image_hash(data)
+        existing = getattr(face, "embedding", None)
+        if (not full and existing is not None
+                and existing.image_hash == digest and existing.model_version == MODEL_VERSION):
+            reused_emb += 1
+            continue
+
+        emb = embed_from_image_bytes(data)  # <-- buffalo_l normalized
         if emb is None:
             skipped_no_face += 1
+            if existing is not None:
+                # photo was replaced by one without a usable face
+                existing.delete()
+                users_touched.add(face.user_id)
             continue
-        # store as list/JSON
-        UserFaceEmbedding.objects.create(face=face, vector=emb.tolist())
+        # store as compact binary (header + float32/float16 bytes)
+        blob = pack_vector(emb)
+        old = unpack_vector(existing.vector) if existing is not None else None
+        # embedding row and O(1) running-mean template update commit together
+        with transaction.atomic():
+            UserFaceEmbedding.objects.update_or_create(
+                face=face,
+                defaults={"vector": blob, "image_hash": digest, "model_version": MODEL_VERSION},
+            )
+            if old is None:
+                add_embedding(face.user_id, unpack_vector(blob))
+            else:
+                replace_embedding(face.user_id, old, unpack_vector(blob))
         created_emb += 1
         users_touched.add(face.user_id)
 
-    # rebuild centroids (L2-normalized mean)
-    for uid in users_touched:
-        vecs = list(UserFaceEmbedding.objects.filter(face__user_id=uid).values_list("vector", flat=True))
-        if not vecs:
-            continue
-        arr = np.array(vecs, dtype=np.float32)
-        cent = arr.mean(axis=0)
-        cent = cent / (np.linalg.norm(cent) + 1e-8)
-        UserEmbeddingTemplate.objects.update_or_create(
-            user_id=uid,
-            defaults={"centroid": cent.tolist(), "count": len(vecs)},
-        )
-
-    return {"users": len(users_touched), "embeddings": created_emb, "skipped": skipped_no_face}
+    # full recompute only for templates left stale (e.g. by an interrupted run)
+    rebuild_centroids(_stale_template_users(user_ids))
+
+    return {"users": len(users_touched), "embeddings": created_emb,
+            "reused": reused_emb, "skipped": skipped_no_face}
+
+
+def _flush_results(results, existing):
+    """
+    Write one batch of pool results, and the template deltas (sum, count) of
+    the users it touches, in a single transaction: a run that dies between
+    batches never leaves a template behind its committed embeddings.
+    Returns the touched user ids.
+    """
+    to_create, to_update, to_delete, touched, deltas = [], [], [], set(), {}
+    for face_id, user_id, digest, emb, status in results:
+        row = existing.get(face_id)
+        if status == "embedded":
+            blob = pack_vector(emb)
+            new = unpack_vector(blob)
+            d_sum, d_n = deltas.get(user_id, (0.0, 0))
+            if row is None:
+                to_create.append(UserFaceEmbedding(face_id=face_id, vector=blob,
+                                                   image_hash=digest, model_version=MODEL_VERSION))
+                deltas[user_id] = (d_sum + new, d_n + 1)
+            else:
+                deltas[user_id] = (d_sum + new - unpack_vector(row.vector), d_n)
+                row.vector, row.image_hash, row.model_version = blob, digest, MODEL_VERSION
+                to_update.append(row)
+            touched.add(user_id)
+        elif status == "no_face" and row is not None:
+            to_delete.append(row.id)
+            touched.add(user_id)
+    with transaction.atomic():
+        if to_create:
+            UserFaceEmbedding.objects.bulk_create(to_create)
+        if to_update:
+            UserFaceEmbedding.objects.bulk_update(to_update, ["vector", "image_hash", "model_version"])
+        if to_delete:
+            # post_delete signal takes each removed vector out of its template
+            UserFaceEmbedding.objects.filter(id__in=to_delete).delete()
+        # one O(1) template update per user in this batch
+        for uid, (d_sum, d_n) in deltas.items():
+            apply_delta(uid, d_sum, d_n)
+    return touched
+
+
+def train_users_parallel(user_ids: Optional[Iterable[int]] = None, full: bool = False,
+                         workers: Optional[int] = None, threads_per_worker: int = 1,
+                         progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """
+    Parallel training: photos are spread over `workers` processes, each with
+    its own model loaded once (train_pool.init_worker). Results stream back
+    to this process, which writes embeddings together with their template
+    updates in bulk transactions of WRITE_BATCH rows.
+    Same incremental rules as train_users(). Progress counters are passed to
+    `progress` and published in the cache under PROGRESS_KEY.
+    """
+    workers = workers or os.cpu_count() or 1
+    qs_faces = UserFace.objects.all()
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        qs_faces = qs_faces.filter(user_id__in=user_ids)
+    faces = list(qs_faces.values_list("id", "user_id", "image"))
+    existing = {e.face_id: e for e in
+                UserFaceEmbedding.objects.filter(face_id__in=[f[0] for f in faces])
+                .only("id", "face_id", "vector", "image_hash", "model_version")}
+
+    storage = UserFace._meta.get_field("image").storage
+    owner = {}
+    jobs = []
+    for face_id, uid, name in faces:
+        owner[face_id] = uid
+        row = existing.get(face_id)
+        known = row.image_hash if (not full and row is not None and row.model_version == MODEL_VERSION
+                                   and row.image_hash) else None
+        jobs.append((face_id, storage.path(name), known))
+
+    counters = {"total": len(jobs), "done": 0, "embedded": 0, "reused": 0, "skipped": 0,
+                "errors": 0, "workers": workers, "started": time.time()}
+
+    def _report():
+        counters["elapsed_s"] = round(time.time() - counters["started"], 1)
+        cache.set(PROGRESS_KEY, dict(counters), 3600)
+        if progress:
+            progress(dict(counters))
+
+    users_touched, batch = set(), []
+    _report()
+    # spawn, never fork: this runs inside the web process (admin "train all"),
+    # whose DB connections and scheduler threads must not be copied
+    with ProcessPoolExecutor(max_workers=workers, initializer=train_pool.init_worker,
+                             initargs=(threads_per_worker,),
+                             mp_context=multiprocessing.get_context("spawn")) as ex:
+        for face_id, digest, emb, status in ex.map(train_pool.embed_job, jobs, chunksize=4):
+            counters["done"] += 1
+            if status == "embedded":
+                counters["embedded"] += 1
+            elif status == "reused":
+                counters["reused"] += 1
+            elif status == "no_face":
+                counters["skipped"] += 1
+            else:
+                counters["errors"] += 1
+                print(f"[TRAIN] face {face_id}: {status}")
+            batch.append((face_id, owner[face_id], digest, emb, status))
+            if len(batch) >= WRITE_BATCH:
+                users_touched |= _flush_results(batch, existing)
+                batch = []
+                _report()
+    if batch:
+        users_touched |= _flush_results(batch, existing)
+
+    # full recompute only where a template is still stale (e.g. an older interrupted run)
+    rebuild_centroids(_stale_template_users(user_ids))
+    _report()
+
+    return {"users": len(users_touched), "embeddings": counters["embedded"],
+            "reused": counters["reused"], "skipped": counters["skipped"]}
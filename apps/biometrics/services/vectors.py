@@ -0,0 +1,82 @@
+# apps/biometrics/services/vectors.py
+"""
+Compact binary encoding for face embeddings (UserFaceEmbedding.vector,
+UserEmbeddingTemplate.centroid).
+
+Layout (little-endian):
+    magic  b"FEV1"       4 bytes
+    dtype  uint8         1 = float32, 2 = float16
+    mlen   uint8         length of the model tag
+    dim    uint16
+    model  mlen bytes    e.g. b"buffalo_l"
+    data   dim * itemsize
+Loading is a straight np.frombuffer on the payload.
+"""
+import struct
+import numpy as np
+
+MAGIC = b"FEV1"
+MODEL_VERSION = "buffalo_l"
+_HEAD = struct.Struct("<4sBBH")
+_DTYPES = {1: np.dtype("<f4"), 2: np.dtype("<f2")}
+_CODES = {"float32": 1, "float16": 2}
+
+
+def storage_dtype() -> str:
+    """settings.FACE_EMBEDDING_DTYPE ("float32" default, or "float16" to halve storage)."""
+    try:
+        from django.conf import settings
+        return getattr(settings, "FACE_EMBEDDING_DTYPE", "float32")
+    except Exception:
+        return "float32"
+
+
+def pack_vector(v, dtype=None, model=MODEL_VERSION) -> bytes:
+    code = _CODES[dtype or storage_dtype()]
+    arr = np.ascontiguousarray(np.asarray(v).reshape(-1), dtype=_DTYPES[code])
+    tag = model.encode("ascii")
+    return _HEAD.pack(MAGIC, code, len(tag), arr.shape[0]) + tag + arr.tobytes()
+
+
+def read_header(blob):
+    """Return (dtype, dim, model, payload_offset)."""
+    blob = bytes(blob)
+    if len(blob) < _HEAD.size:
+        raise ValueError("truncated embedding header")
+    magic, code, mlen, dim = _HEAD.unpack_from(blob, 0)
+    if magic != MAGIC:
+        raise ValueError("not an encoded embedding")
+    if code not in _DTYPES:
+        raise ValueError(f"unknown embedding dtype code {code}")
+    off = _HEAD.size + mlen
+    if len(blob) < off + dim * _DTYPES[code].itemsize:
+        raise ValueError("truncated embedding payload")
+    return _DTYPES[code], dim, blob[_HEAD.size:off].decode("ascii"), off
+
+
+def unpack_vector(blob) -> np.ndarray:
+    """Decode one blob into a float32 (D,) array. Legacy JSON lists are accepted too."""
+    if isinstance(blob, (list, tuple)):
+        return np.asarray(blob, dtype=np.float32)
+    dt, dim, _model, off = read_header(blob)
+    return np.frombuffer(bytes(blob), dtype=dt, count=dim, offset=off).astype(np.float32)
+
+
+def unpack_matrix(blobs) -> np.ndarray:
+    """
+    Decode many blobs into one float32 (N, D) matrix. When all rows share the
+    same header (the normal case) this is a single frombuffer over the joined bytes.
+    """
+    blobs = [bytes(b) for b in blobs]
+    if not blobs:
+        return np.zeros((0, 0), dtype=np.float32)
+    head = blobs[0][:_HEAD.size + blobs[0][5]] if len(blobs[0]) > _HEAD.size else b""
+    if head and all(b.startswith(head) and len(b) == len(blobs[0]) for b in blobs):
+        dt, dim, _model, off = read_header(blobs[0])
+        raw = np.frombuffer(b"".join(blobs), dtype=np.uint8).reshape(len(blobs), -1)
+        return np.ascontiguousarray(raw[:, off:]).view(dt).reshape(len(blobs), dim).astype(np.float32)
+    return np.vstack([unpack_vector(b) for b in blobs])
+
+
+def model_of(blob) -> str:
+    return read_header(blob)[2]
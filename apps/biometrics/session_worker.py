@@ -2,10 +2,7 @@
 import os
 import sys
 import time
-import json
 import subprocess
-from django.core.cache import cache
-from django.apps import apps as django_apps
 from django.conf import settings
 
 LOG_DIR = getattr(settings, "SESSION_WORKER_LOG_DIR", os.path.join(settings.MEDIA_ROOT, "logs"))
@@ -16,6 +13,28 @@ def _ensure_log_dir():
     except Exception as e:
         print(f"[WORKER] WARN: could not create log dir {LOG_DIR}: {e}")
 
+_LOCKS = {}      # lock file name -> open, locked file, held until this process exits
+
+def _claim_lock(name):
+    """True in the one process on this host holding LOG_DIR/<name> (released when it exits)."""
+    if name in _LOCKS:
+        return True
+    _ensure_log_dir()
+    fh = open(os.path.join(LOG_DIR, name), "a+")
+    try:
+        if sys.platform.startswith("win"):
+            import msvcrt
+            fh.seek(0)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return False
+    _LOCKS[name] = fh
+    return True
+
 def _script_path():
     # face_session_cam.py should live next to manage.py (project root)
     return os.path.join(settings.BASE_DIR, "face_session_cam.py")
@@ -24,65 +43,58 @@ def _default_env():
     env = os.environ.copy()
     # Ensure child process can load Django
     env.setdefault("DJANGO_SETTINGS_MODULE", settings.SETTINGS_MODULE if hasattr(settings, "SETTINGS_MODULE") else f"{settings.ROOT_URLCONF.split('.')[0]}.settings")
+    # RUN_MAIN (set by runserver's reloader) would start the scheduler, and with it
+    # another worker pool, inside every worker
+    env.pop("RUN_MAIN", None)
+    # fair share of ONNX threads under the supervisor's CPU budget
+    from apps.biometrics.supervisor import supervisor
+    env["FACE_ORT_THREADS"] = str(supervisor().threads_per_worker())
     return env
 
-def _log_file(session_id):
+def _log_file(session_id, room_id=None):
     _ensure_log_dir()
-    return os.path.join(LOG_DIR, f"session_{session_id}.log")
-
-def _is_process_running(pid):
-    if not pid:
-        return False
-    try:
-        # On Windows, this will raise if pid doesn’t exist; on POSIX, poll via os.kill(pid, 0)
-        if sys.platform.startswith("win"):
-            import psutil  # optional; if not installed, skip this branch
-            return psutil.pid_exists(pid)
-        else:
-            os.kill(pid, 0)
-            return True
-    except Exception:
-        return False
+    name = f"room_{room_id}" if room_id else f"session_{session_id}"
+    return os.path.join(LOG_DIR, f"{name}.log")
 
-def launch_face_worker(session_id, cam_source=None):
+def _spawn_worker(session_id, cam_source=None, room_id=None):
     """
-    Launches face_session_cam.py in the background for the given session.
-    - cam_source: optional (int or string); if None, the child defaults to 0.
-    Writes logs to MEDIA_ROOT/logs/session_<id>.log
+    Start the worker process for a session (or, with room_id, for every
+    running session of that room): hand it to a warm standby when one is
+    ready, else launch face_session_cam.py cold. Returns (Popen or None, warm).
+    Called in the supervisor process, which owns the returned process.
     """
-
-    # Avoid duplicate workers
-    key = f"sess:{session_id}:worker"
-    existing = cache.get(key)
-    if existing:
-        # existing may be {"pid": 1234, "ts": ...}
-        pid = existing.get("pid")
-        if _is_process_running(pid):
-            print(f"[WORKER] Session {session_id} already running with PID={pid}")
-            return
-        else:
-            # stale entry
-            cache.delete(key)
-
+    what = f"room {room_id}" if room_id else f"session {session_id}"
+    if room_id:
+        # several cameras in one worker: FACE_ROOM_CAMERAS = {room_id: [0, 1, ...]}
+        cameras = getattr(settings, "FACE_ROOM_CAMERAS", {}) or {}
+        sources = cameras.get(room_id) or cameras.get(str(room_id))
+        if sources:
+            cam_source = ",".join(str(c) for c in sources)
     script = _script_path()
     if not os.path.isfile(script):
         print(f"[WORKER] ERROR: face_session_cam.py not found at {script}")
-        return
-
-    # Optionally, derive a camera source from the Room (e.g., room.camera_source field)
-    # If you want to auto-pull: 
-    # Session = django_apps.get_model("academics", "Session")
-    # sess = Session.objects.get(id=session_id)
-    # if hasattr(sess.room, "camera_source") and sess.room.camera_source:
-    #     cam_source = sess.room.camera_source
+        return None, False
+
+    # the child measures time-to-first-recognition from this moment
+    from apps.biometrics.services.startup_metrics import START_ENV
+    start_ts = time.time()
+
+    # Warm pool: hand the session to a standby worker that already has the model loaded
+    from apps.biometrics.worker_pool import warm_pool
+    pool = warm_pool()
+    lf = _log_file(session_id, room_id)
+    proc = pool.take(session_id, cam_source, log_path=lf, start_ts=start_ts, room_id=room_id) if pool else None
+    if proc is not None:
+        print(f"[WORKER] {what.capitalize()} handed to warm worker PID={proc.pid} "
+              f"in {(time.time() - start_ts) * 1000:.0f} ms")
+        return proc, True
 
     # Build command
-    cmd = [sys.executable, script, str(session_id)]
+    cmd = [sys.executable, script] + (["--room", str(room_id)] if room_id else [str(session_id)])
     if cam_source is not None:
         cmd.append(str(cam_source))  # our face_session_cam.py can read argv[2] as camera source
 
     # Prepare logs
-    lf = _log_file(session_id)
     try:
         log_fh = open(lf, "a", buffering=1, encoding="utf-8", errors="replace")  # line-buffered
     except Exception as e:
@@ -91,6 +103,7 @@ def launch_face_worker(session_id, cam_source=None):
 
     # Environment
     env = _default_env()
+    env[START_ENV] = str(start_ts)
 
     # Launch
     print(f"[WORKER] Launching session worker: {cmd}  (logs: {lf})")
@@ -105,36 +118,30 @@ def launch_face_worker(session_id, cam_source=None):
         )
     except Exception as e:
         print(f"[WORKER] ERROR: failed to start worker: {e}")
+        return None, False
+    finally:
         if log_fh:
-            log_fh.close()
-        return
+            log_fh.close()  # the child holds its own handle
+    print(f"[WORKER] Started {what} worker with PID={proc.pid}")
+    return proc, False
 
-    # Cache pid so we can prevent duplicates / stop later
-    cache.set(key, {"pid": proc.pid, "ts": time.time()}, timeout=60 * 60)  # 1 hour
-    print(f"[WORKER] Started session {session_id} worker with PID={proc.pid}")
+def launch_face_worker(session_id, cam_source=None, wait_s=None):
+    """
+    Launches face_session_cam.py in the background for the given session.
+    - cam_source: optional (int or string); if None, the child defaults to 0.
+    Writes logs to MEDIA_ROOT/logs/session_<id>.log
+    The supervisor process (face_supervisor.py) starts and owns the worker:
+    it restarts it if it dies while the session runs, and queues/refuses the
+    session when the CPU/memory budget is full. With FACE_ROOM_WORKERS the
+    worker serves the whole room and later sessions there attach to it.
+    Returns "running", "attached", "started", "queued" or "refused", or
+    "requested" if the supervisor did not answer within wait_s.
+    """
+    from apps.biometrics.supervisor import request_start
+    return request_start(session_id, cam_source, wait_s=wait_s)
 
 def stop_face_worker(session_id):
-    """Optional: stop a running worker from Django."""
-    key = f"sess:{session_id}:worker"
-    info = cache.get(key)
-    if not info:
-        print(f"[WORKER] No worker found in cache for session {session_id}")
-        return
-
-    pid = info.get("pid")
-    if not pid:
-        cache.delete(key)
-        print(f"[WORKER] No PID stored for session {session_id}")
-        return
-
-    try:
-        if sys.platform.startswith("win"):
-            # Windows termination (best-effort)
-            subprocess.run(["taskkill", "/PID", str(pid), "/F"], check=False)
-        else:
-            os.kill(pid, 15)  # SIGTERM
-    except Exception as e:
-        print(f"[WORKER] WARN: could not terminate PID={pid}: {e}")
-
-    cache.delete(key)
-    print(f"[WORKER] Stopped worker for session {session_id} (PID={pid})")
+    """Optional: stop a running worker from Django (carried out by the supervisor process)."""
+    from apps.biometrics.supervisor import request_stop
+    request_stop(session_id)
+    print(f"[WORKER] Stop requested for session {session_id}")
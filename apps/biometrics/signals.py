@@ -1,25 +1,48 @@
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-import numpy as np
-from .models import UserFace, UserFaceEmbedding, UserEmbeddingTemplate
+import hashlib
+from .models import UserFace, UserFaceEmbedding
 from .services.face import embed_from_image_bytes
+from .services.vectors import pack_vector, unpack_vector, MODEL_VERSION
+from .services.embedding_queue import enqueue, drain_in_background
+from .services.templates import add_embedding, remove_embedding
 
 @receiver(post_save, sender=UserFace)
 def build_embedding(sender, instance, created, **kwargs):
     if not created: return
+    if getattr(settings, "FACE_EMBED_ASYNC", True):
+        # admin returns immediately; the job is drained after commit by a
+        # background thread here (and by any running embedding_worker.py)
+        enqueue(instance)
+        transaction.on_commit(drain_in_background)
+        return
     with instance.image.open("rb") as f:
-        emb = embed_from_image_bytes(f.read())
+        data = f.read()
+    emb = embed_from_image_bytes(data)
     if emb is None:
         return  # optionally delete instance.image if no face was found
-    UserFaceEmbedding.objects.create(face=instance, vector=emb.tolist())
-    # recompute centroid
-    all_vecs = list(UserFaceEmbedding.objects.filter(face__user=instance.user)
-                    .values_list("vector", flat=True))
-    if not all_vecs: return
-    arr = np.array(all_vecs, dtype=np.float32)
-    cent = arr.mean(axis=0, keepdims=True)
-    cent = cent / (np.linalg.norm(cent, axis=1, keepdims=True) + 1e-12)
-    UserEmbeddingTemplate.objects.update_or_create(
-        user=instance.user,
-        defaults={"centroid": cent[0].tolist(), "count": len(all_vecs)}
-    )
+    blob = pack_vector(emb)
+    # embedding row and O(1) running-mean update commit together
+    with transaction.atomic():
+        UserFaceEmbedding.objects.create(face=instance, vector=blob,
+                                         image_hash=hashlib.sha256(data).hexdigest(), model_version=MODEL_VERSION)
+        add_embedding(instance.user_id, unpack_vector(blob))
+
+def _deleting_user(origin):
+    User = get_user_model()
+    return isinstance(origin, User) or (isinstance(origin, QuerySet) and origin.model is User)
+
+
+@receiver(post_delete, sender=UserFaceEmbedding)
+def drop_from_template(sender, instance, origin=None, **kwargs):
+    # take the removed vector out of the running sum; a template without one is
+    # recomputed from the remaining vectors, except while the user row itself
+    # is being deleted (the template goes with it: never resurrect it)
+    user_id = UserFace.objects.filter(id=instance.face_id).values_list("user_id", flat=True).first()
+    if user_id is None or not instance.vector:
+        return
+    remove_embedding(user_id, unpack_vector(instance.vector), recompute_missing=not _deleting_user(origin))
@@ -0,0 +1,429 @@
+# apps/biometrics/supervisor.py
+"""
+Supervisor for session recognition workers.
+
+Owns every worker process it starts (the Popen handle, not a PID in the
+cache), so a worker is tracked for as long as its session runs:
+
+  heartbeats  workers write fps / last frame time / RSS to a file
+              (services/heartbeat.py); a worker whose heartbeat or last
+              frame is older than `stall_s` is killed and restarted
+  restarts    a worker that exits while its session is still running is
+              restarted after `backoff_s`, doubling up to `backoff_max_s`;
+              after `max_restarts` failures in a row the session is given up
+  admission   a new session starts only while the CPU and memory budget has
+              room; otherwise it waits in a FIFO queue (or is refused when
+              `queue` is False) and starts when a slot frees up
+  threads     every worker gets the same ONNX intra-op thread share,
+              cpu_cores // capacity, so workers never oversubscribe cores
+
+With FACE_ROOM_WORKERS a worker serves a room rather than one session
+(face_session_cam.py --room): the first running session of a room starts
+it, later sessions of that room attach to it.
+
+It runs as its own long-lived process, `python face_supervisor.py`, which
+owns the worker handles (and the warm pool) independently of the web
+server's processes and reloads. Views and the scheduler only ask it to
+start or stop a session: request_start() / request_stop() insert a
+WorkerRequest row, serve() carries requests out in order and ticks.
+"""
+import os
+import time
+import threading
+import subprocess
+from collections import deque
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.utils import timezone
+from apps.biometrics.services.heartbeat import read_heartbeat, heartbeat_path
+
+KILL_WAIT_S = 10.0         # how long to wait for a killed/terminated worker to exit
+
+DEFAULTS = {
+    "max_workers": 0,          # hard cap; 0 = whatever the CPU/memory budget allows
+    "cpu_cores": 0,            # cores for recognition; 0 = os.cpu_count()
+    "min_threads": 2,          # ONNX threads a worker needs to keep up (CPU budget)
+    "threads_per_worker": 0,   # 0 = fair share of cpu_cores
+    "mem_budget_mb": 0,        # memory for workers incl. warm standbys; 0 = unlimited
+    "worker_mem_mb": 700,      # per-worker estimate until heartbeats report RSS
+    "queue": True,             # False = refuse sessions when the budget is full
+    "stall_s": 60,             # no heartbeat / no frame for this long = stalled
+    "start_grace_s": 120,      # stall checks begin this long after a (re)start
+    "backoff_s": 2,
+    "backoff_max_s": 120,
+    "healthy_s": 300,          # a worker up this long resets the failure count
+    "max_restarts": 5,
+    "poll_s": 0.5,             # how often serve() looks for new WorkerRequests
+    "tick_s": 5,               # how often serve() ticks and refills the warm pool
+    "reply_wait_s": 3,         # request_start() waits this long for the outcome
+    "keep_requests_s": 86400,  # handled WorkerRequests are deleted after this long
+}
+
+
+def supervisor_config() -> dict:
+    return {**DEFAULTS, **(getattr(settings, "FACE_SUPERVISOR", {}) or {})}
+
+
+class _Worker:
+    def __init__(self, key, cam_source, room_id=None):
+        self.key = key           # session id, or "room:<id>" for a room-scoped worker
+        self.session_id = None if room_id else key
+        self.room_id = room_id
+        self.cam_source = cam_source
+        self.proc = None
+        self.started_at = 0.0
+        self.warm = False
+        self.restarts = 0        # total
+        self.failures = 0        # in a row
+        self.restart_at = None   # pending restart time while backing off
+        self.last_exit = None
+
+    def __str__(self):
+        return f"room {self.room_id}" if self.room_id else f"session {self.session_id}"
+
+
+class Supervisor:
+    def __init__(self, conf=None):
+        self.conf = conf or supervisor_config()
+        self._workers = {}       # key -> _Worker
+        self._sessions = {}      # session id -> key of the worker serving it
+        self._queue = deque()    # (key, cam_source, room_id) waiting for a slot
+        self._lock = threading.RLock()
+        self.refused = 0
+
+    # ---------------- budget ----------------
+    def cores(self):
+        return int(self.conf["cpu_cores"] or os.cpu_count() or 1)
+
+    def _cpu_slots(self):
+        slots = max(1, self.cores() // max(1, int(self.conf["min_threads"])))
+        if self.conf["max_workers"]:
+            slots = min(slots, int(self.conf["max_workers"]))
+        return slots
+
+    def threads_per_worker(self):
+        """Fair ONNX intra-op share; fixed by the budget so warm standbys match."""
+        if self.conf["threads_per_worker"]:
+            return int(self.conf["threads_per_worker"])
+        return max(1, self.cores() // self._cpu_slots())
+
+    def worker_mem_mb(self):
+        """Mean RSS reported by live workers, else the configured estimate."""
+        seen = [hb["rss_mb"] for hb in (read_heartbeat(k) for k in self._workers) if hb and hb.get("rss_mb")]
+        return max(sum(seen) / len(seen), 1.0) if seen else float(self.conf["worker_mem_mb"])
+
+    def capacity(self):
+        slots = self._cpu_slots()
+        budget = float(self.conf["mem_budget_mb"] or 0)
+        if budget:
+            from apps.biometrics.worker_pool import warm_pool
+            pool = warm_pool()
+            per_worker = self.worker_mem_mb()
+            standby = pool.size if pool else 0
+            slots = min(slots, max(0, int((budget - standby * per_worker) // per_worker)))
+        return slots
+
+    # ---------------- start / stop ----------------
+    def _key_for(self, session_id):
+        """(worker key, room_id): one worker per room when FACE_ROOM_WORKERS is on."""
+        if not getattr(settings, "FACE_ROOM_WORKERS", False):
+            return session_id, None
+        Session = django_apps.get_model("academics", "Session")
+        room_id = Session.objects.filter(id=session_id).values_list("room_id", flat=True).first()
+        return (f"room:{room_id}", room_id) if room_id else (session_id, None)
+
+    def start(self, session_id, cam_source=None):
+        """
+        Start (or queue) the worker for a session. Returns "running", "attached",
+        "started", "queued" or "refused". With room workers, a session whose room
+        already has one is "attached": that worker picks it up on its next sync.
+        """
+        with self._lock:
+            key, room_id = self._key_for(session_id)
+            w = self._workers.get(key)
+            if w is not None:
+                known = self._sessions.get(session_id) == key
+                self._sessions[session_id] = key
+                if w.room_id and not known:
+                    print(f"[SUPERVISOR] Session {session_id} attaches to the {w} worker "
+                          f"(PID={w.proc.pid if w.proc else None})")
+                    return "attached"
+                print(f"[SUPERVISOR] Session {session_id} already supervised (PID={w.proc.pid if w.proc else None})")
+                return "running"
+            if any(k == key for k, _, _ in self._queue):
+                self._sessions[session_id] = key
+                return "queued"
+            if len(self._workers) >= self.capacity():
+                if not self.conf["queue"]:
+                    self.refused += 1
+                    print(f"[SUPERVISOR] Refused session {session_id}: budget full "
+                          f"({len(self._workers)}/{self.capacity()} workers)")
+                    return "refused"
+                self._sessions[session_id] = key
+                self._queue.append((key, cam_source, room_id))
+                print(f"[SUPERVISOR] Queued session {session_id}: budget full "
+                      f"({len(self._workers)}/{self.capacity()} workers, {len(self._queue)} waiting)")
+                return "queued"
+            self._sessions[session_id] = key
+            w = self._workers[key] = _Worker(key, cam_source, room_id)
+            return "started" if self._launch(w) else "refused"
+
+    def _sessions_of(self, key):
+        return [s for s, k in self._sessions.items() if k == key]
+
+    def _launch(self, w):
+        from apps.biometrics.session_worker import _spawn_worker
+        proc, warm = _spawn_worker(w.session_id, w.cam_source, room_id=w.room_id)
+        if proc is None:
+            self._forget(w.key)
+            return False
+        w.proc, w.warm, w.started_at, w.restart_at = proc, warm, time.time(), None
+        try:
+            os.remove(heartbeat_path(w.key))  # never judge a new worker by an old heartbeat
+        except OSError:
+            pass
+        return True
+
+    def _forget(self, key):
+        self._workers.pop(key, None)
+        for s in self._sessions_of(key):
+            self._sessions.pop(s, None)
+
+    def stop(self, session_id):
+        """
+        Stop a session's worker for good (no restart). Returns its PID or None.
+        A room worker keeps running while another session in the room is live;
+        it detaches the stopped session by itself.
+        """
+        with self._lock:
+            key = self._sessions.pop(session_id, session_id)
+            w = self._workers.get(key)
+            if w is not None and w.room_id and self._running(key):
+                print(f"[SUPERVISOR] Session {session_id} detaches; the {w} worker keeps running")
+                return w.proc.pid if w.proc else None
+            if not self._sessions_of(key):
+                self._queue = deque(q for q in self._queue if q[0] != key)
+            if w is None:
+                return None
+            self._forget(key)
+        if w.proc is None:
+            return None
+        if w.proc.poll() is None:
+            try:
+                w.proc.terminate()
+            except Exception as e:
+                print(f"[SUPERVISOR] WARN: could not terminate PID={w.proc.pid}: {e}")
+            else:
+                # escalate off the caller's (request) thread if the worker ignores terminate
+                threading.Thread(target=_reap, args=(w.proc,), daemon=True, name=f"reap-{w.proc.pid}").start()
+        return w.proc.pid
+
+    # ---------------- supervision ----------------
+    def _running(self, key):
+        """Does the worker for `key` still have a running session to serve?"""
+        Session = django_apps.get_model("academics", "Session")
+        qs = Session.objects.filter(status=Session.STATUS_RUNNING, end_time__gt=timezone.now())
+        if isinstance(key, str) and key.startswith("room:"):
+            return qs.filter(room_id=int(key[len("room:"):])).exists()
+        return qs.filter(id=key).exists()
+
+    def _stalled(self, w, now):
+        if now - w.started_at < self.conf["start_grace_s"]:
+            return None
+        hb = read_heartbeat(w.key)
+        if hb is None or hb.get("pid") != w.proc.pid:
+            return "no heartbeat"
+        if now - hb["ts"] > self.conf["stall_s"]:
+            return f"heartbeat {now - hb['ts']:.0f}s old"
+        if now - (hb.get("last_frame_ts") or 0) > self.conf["stall_s"]:
+            return f"no frame for {now - (hb.get('last_frame_ts') or 0):.0f}s"
+        return None
+
+    def _schedule_restart(self, w, now, why):
+        if now - w.started_at >= self.conf["healthy_s"]:
+            w.failures = 0
+        w.failures += 1
+        if w.failures > self.conf["max_restarts"]:
+            print(f"[SUPERVISOR] {w}: giving up after {w.failures - 1} restarts ({why})")
+            self._forget(w.key)
+            return
+        delay = min(self.conf["backoff_max_s"], self.conf["backoff_s"] * 2 ** (w.failures - 1))
+        w.restart_at = now + delay
+        w.last_exit = why
+        print(f"[SUPERVISOR] {w} worker PID={w.proc.pid} {why}; restart in {delay:.0f}s")
+
+    def tick(self):
+        """Reap, detect stalls, restart with backoff, then admit queued sessions."""
+        now = time.time()
+        with self._lock:
+            for w in list(self._workers.values()):
+                if w.restart_at is not None:
+                    if now >= w.restart_at:
+                        if not self._running(w.key):
+                            self._forget(w.key)
+                            continue
+                        w.restarts += 1
+                        print(f"[SUPERVISOR] Restarting {w} (restart #{w.restarts})")
+                        self._launch(w)
+                    continue
+                rc = w.proc.poll()
+                if rc is None:
+                    why = self._stalled(w, now)
+                    if why:
+                        w.proc.kill()
+                        try:
+                            w.proc.wait(timeout=KILL_WAIT_S)
+                        except subprocess.TimeoutExpired:
+                            print(f"[SUPERVISOR] WARN: {w} worker PID={w.proc.pid} still alive "
+                                  f"{KILL_WAIT_S:.0f}s after kill")
+                        self._schedule_restart(w, now, f"stalled ({why})")
+                    continue
+                if not self._running(w.key):
+                    print(f"[SUPERVISOR] {w} worker PID={w.proc.pid} finished (code {rc})")
+                    self._forget(w.key)
+                    continue
+                self._schedule_restart(w, now, f"exited with code {rc}")
+
+            while self._queue and len(self._workers) < self.capacity():
+                key, cam_source, room_id = self._queue.popleft()
+                if self._running(key):
+                    w = self._workers[key] = _Worker(key, cam_source, room_id)
+                    print(f"[SUPERVISOR] Admitting queued {w}")
+                    self._launch(w)
+                else:
+                    self._forget(key)
+
+    def status(self):
+        """Per-worker state plus the latest heartbeat."""
+        with self._lock:
+            out = {}
+            for k, w in self._workers.items():
+                hb = read_heartbeat(k) or {}
+                out[k] = {"pid": w.proc.pid if w.proc else None, "warm": w.warm,
+                          "sessions": self._sessions_of(k),
+                          "up_s": round(time.time() - w.started_at, 1), "restarts": w.restarts,
+                          "restarting": w.restart_at is not None, "last_exit": w.last_exit,
+                          "fps": hb.get("fps"), "last_frame_ts": hb.get("last_frame_ts"),
+                          "rss_mb": hb.get("rss_mb")}
+            return {"workers": out, "queued": [k for k, _, _ in self._queue], "capacity": self.capacity(),
+                    "threads_per_worker": self.threads_per_worker(), "refused": self.refused}
+
+
+def _reap(proc, grace_s=KILL_WAIT_S):
+    """Wait for a terminated worker; kill() it if it is still running after grace_s."""
+    try:
+        proc.wait(timeout=grace_s)
+        return
+    except subprocess.TimeoutExpired:
+        print(f"[SUPERVISOR] WARN: PID={proc.pid} ignored terminate for {grace_s:.0f}s; killing")
+    proc.kill()
+    try:
+        proc.wait(timeout=grace_s)
+    except subprocess.TimeoutExpired:
+        print(f"[SUPERVISOR] WARN: PID={proc.pid} still alive {grace_s:.0f}s after kill")
+
+
+_SUPERVISOR = None
+_SUPERVISOR_LOCK = threading.Lock()
+
+
+def supervisor():
+    """The process-wide supervisor."""
+    global _SUPERVISOR
+    with _SUPERVISOR_LOCK:
+        if _SUPERVISOR is None:
+            _SUPERVISOR = Supervisor()
+    return _SUPERVISOR
+
+
+# ---------------- requests (web process -> supervisor process) ----------------
+REQUESTED = "requested"    # request_start() outcome when the supervisor did not answer in time
+
+
+def _await(req, wait_s):
+    WorkerRequest = django_apps.get_model("biometrics", "WorkerRequest")
+    deadline = time.time() + wait_s
+    while True:
+        result = WorkerRequest.objects.filter(id=req.id).values_list("result", flat=True).first()
+        if result:
+            return result
+        if time.time() >= deadline:
+            return REQUESTED
+        time.sleep(0.1)
+
+
+def request_start(session_id, cam_source=None, wait_s=None):
+    """
+    Ask the supervisor process to start a session's worker. Waits up to
+    wait_s (conf "reply_wait_s") for Supervisor.start()'s outcome; returns
+    "requested" if it has not answered by then (e.g. it is not running).
+    """
+    WorkerRequest = django_apps.get_model("biometrics", "WorkerRequest")
+    req = WorkerRequest.objects.create(action=WorkerRequest.START, session_id=session_id,
+                                       cam_source="" if cam_source is None else str(cam_source))
+    return _await(req, supervisor_config()["reply_wait_s"] if wait_s is None else wait_s)
+
+
+def request_stop(session_id):
+    """Ask the supervisor process to stop a session's worker; does not wait."""
+    WorkerRequest = django_apps.get_model("biometrics", "WorkerRequest")
+    WorkerRequest.objects.create(action=WorkerRequest.STOP, session_id=session_id)
+
+
+def handle_requests(sup=None):
+    """Carry out pending WorkerRequests in the order they were made. Returns how many."""
+    WorkerRequest = django_apps.get_model("biometrics", "WorkerRequest")
+    sup = sup or supervisor()
+    handled = 0
+    for req in WorkerRequest.objects.filter(handled_at__isnull=True).order_by("id"):
+        if req.action == WorkerRequest.STOP:
+            result = "stopped" if sup.stop(req.session_id) is not None else "none"
+        elif not sup._running(req.session_id):
+            # asked while the supervisor was down, and the session has ended since
+            result = "not running"
+        else:
+            result = sup.start(req.session_id, req.cam_source or None)
+        WorkerRequest.objects.filter(id=req.id).update(result=result, handled_at=timezone.now())
+        handled += 1
+    return handled
+
+
+def _prune_requests(keep_s):
+    WorkerRequest = django_apps.get_model("biometrics", "WorkerRequest")
+    cutoff = timezone.now() - timezone.timedelta(seconds=keep_s)
+    return WorkerRequest.objects.filter(handled_at__lt=cutoff).delete()[0]
+
+
+def serve():
+    """
+    The supervisor process's loop (face_supervisor.py). Only one runs per
+    host; on startup it takes over every running session, since the workers
+    of a previous supervisor died with it or are no longer tracked.
+    """
+    from django.db import close_old_connections
+    from apps.biometrics.session_worker import _claim_lock
+    from apps.biometrics.worker_pool import refill_pool
+    if not _claim_lock("supervisor.lock"):
+        print(f"[SUPERVISOR] another supervisor runs on this host; pid {os.getpid()} exits")
+        return
+    sup = supervisor()
+    conf = sup.conf
+    Session = django_apps.get_model("academics", "Session")
+    running = Session.objects.filter(status=Session.STATUS_RUNNING, end_time__gt=timezone.now())
+    for session_id in running.order_by("id").values_list("id", flat=True):
+        sup.start(session_id)
+    print(f"[SUPERVISOR] pid {os.getpid()} serving; capacity {sup.capacity()} workers, "
+          f"{sup.threads_per_worker()} threads each")
+    last_tick = 0.0
+    while True:
+        try:
+            handle_requests(sup)
+            if time.time() - last_tick >= conf["tick_s"]:
+                last_tick = time.time()
+                sup.tick()
+                refill_pool()
+                _prune_requests(conf["keep_requests_s"])
+        except Exception as e:
+            print(f"[SUPERVISOR] ERROR: {e}")
+            close_old_connections()     # a dropped DB connection is reopened on the next round
+        time.sleep(conf["poll_s"])
@@ -0,0 +1,1198 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import time
+import socket
+import threading
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import cv2
+from insightface.app.common import Face
+from django.core.cache import cache
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from apps.accounts.models import User
+from apps.biometrics.models import UserFace, UserFaceEmbedding, UserEmbeddingTemplate, EmbeddingJob, WorkerRequest
+from apps.biometrics.services.matching import (
+    normalize_rows, stack_embeddings, top_k, best_matches, TemplateGallery,
+)
+from apps.biometrics.services.tracking import FaceTracker, iou_matrix
+from apps.biometrics.services.quality import QualityGate, head_pose, blur_score
+from apps.biometrics.services import gallery_index
+from apps.biometrics.services import vectors
+from apps.biometrics.services.frame_rate import FrameRateScheduler, unmarked_count
+from apps.biometrics.services import training, train_pool, templates, embedding_queue
+from apps.biometrics import supervisor as supervisor_mod
+from apps.biometrics.services import inference_server, face as face_service
+
+
+def _unit(rng, n, d=16):
+    return normalize_rows(rng.standard_normal((n, d)).astype(np.float32))
+
+
+def _brute_top_k(embs, matrix, k):
+    sims = embs @ matrix.T
+    idx = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+    return idx, np.take_along_axis(sims, idx, axis=1)
+
+
+class TopKTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_matches_brute_force(self):
+        embs, gallery = _unit(self.rng, 7), _unit(self.rng, 50)
+        for k in (1, 3, 10):
+            idx, sims = top_k(embs, gallery, k=k)
+            ref_idx, ref_sims = _brute_top_k(embs, gallery, k)
+            np.testing.assert_array_equal(idx, ref_idx)
+            np.testing.assert_allclose(sims, ref_sims, rtol=1e-6)
+
+    def test_k_larger_than_gallery(self):
+        embs, gallery = _unit(self.rng, 3), _unit(self.rng, 4)
+        idx, sims = top_k(embs, gallery, k=10)
+        self.assertEqual(idx.shape, (3, 4))
+        ref_idx, _ = _brute_top_k(embs, gallery, 4)
+        np.testing.assert_array_equal(idx, ref_idx)
+        self.assertTrue(np.all(np.diff(sims, axis=1) <= 0))
+
+    def test_empty_gallery(self):
+        embs = _unit(self.rng, 2)
+        for gallery in (None, np.zeros((0, 16), dtype=np.float32)):
+            idx, sims = top_k(embs, gallery, k=3)
+            self.assertEqual(idx.shape, (2, 0))
+            self.assertEqual(sims.shape, (2, 0))
+        self.assertEqual(best_matches(embs, [], None), [(None, -1.0), (None, -1.0)])
+
+    def test_no_faces(self):
+        idx, sims = top_k(np.zeros((0, 16), dtype=np.float32), _unit(self.rng, 5), k=2)
+        self.assertEqual(idx.shape, (0, 0))
+        self.assertEqual(stack_embeddings([]).shape, (0, 0))
+
+    def test_ties_lowest_row_first(self):
+        v = _unit(self.rng, 2)
+        gallery = np.vstack([v[1], v[0], v[1], v[0], v[0]])   # rows 1, 3, 4 tie for best
+        idx, sims = top_k(v[:1], gallery, k=3)
+        self.assertEqual(idx[0].tolist(), [1, 3, 4])
+        np.testing.assert_allclose(sims[0], [1.0, 1.0, 1.0], rtol=1e-6)
+        idx, _ = top_k(v[:1], gallery, k=1)
+        self.assertEqual(idx[0].tolist(), [1])
+        self.assertEqual(best_matches(v[:1], list("abcde"), gallery)[0][0], "b")
+
+    def test_template_gallery_max_over_templates(self):
+        t = _unit(self.rng, 5)
+        gallery = TemplateGallery([t[:2], t[2:3], t[3:]])     # labels own rows 0-1, 2, 3-4
+        idx, sims = top_k(t[4:5], gallery, k=3)
+        self.assertEqual(int(idx[0, 0]), 2)
+        self.assertAlmostEqual(float(sims[0, 0]), 1.0, places=5)
+        ref = np.maximum.reduceat(t[4:5] @ t.T, [0, 2, 3], axis=1)
+        np.testing.assert_allclose(np.sort(sims[0])[::-1], np.sort(ref[0])[::-1], rtol=1e-6)
+
+
+class StackEmbeddingsTests(SimpleTestCase):
+    def test_prefers_normed_and_normalizes_raw(self):
+        raw = np.array([3.0, 4.0] + [0.0] * 14, dtype=np.float32)
+        faces = [SimpleNamespace(normed_embedding=None, embedding=raw),
+                 SimpleNamespace(normed_embedding=normalize_rows(raw)[0], embedding=raw * 10)]
+        out = stack_embeddings(faces)
+        self.assertEqual(out.shape, (2, 16))
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_allclose(out[0], out[1], rtol=1e-6)
+        np.testing.assert_allclose(np.linalg.norm(out, axis=1), 1.0, rtol=1e-5)
+
+
+def _face(x, y, w=100, h=100):
+    return SimpleNamespace(bbox=np.array([x, y, x + w, y + h], dtype=np.float32))
+
+
+class FaceTrackerTests(SimpleTestCase):
+    def test_iou_matrix(self):
+        a = np.array([[0, 0, 10, 10]], dtype=np.float32)
+        b = np.array([[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]], dtype=np.float32)
+        np.testing.assert_allclose(iou_matrix(a, b)[0], [1.0, 50 / 150, 0.0], rtol=1e-5)
+        self.assertEqual(iou_matrix(a, np.zeros((0, 4), dtype=np.float32)).shape, (1, 0))
+
+    def test_moving_faces_keep_their_tracks(self):
+        tr = FaceTracker()
+        a, b = tr.update([_face(0, 0), _face(300, 0)])
+        # next frame: both moved a little, detector returned them in the other order
+        b2, a2 = tr.update([_face(305, 5), _face(8, 4)])
+        self.assertIs(a2, a)
+        self.assertIs(b2, b)
+        self.assertEqual(a.hits, 2)
+        self.assertEqual(len(tr.tracks), 2)
+
+    def test_low_overlap_starts_new_track(self):
+        tr = FaceTracker(iou_min=0.3)
+        (a,) = tr.update([_face(0, 0)])
+        (b,) = tr.update([_face(80, 0)])     # IoU 20/180 < 0.3
+        self.assertIsNot(a, b)
+        self.assertEqual(a.misses, 1)
+
+    def test_resolved_track_is_not_reembedded_until_reverify(self):
+        tr = FaceTracker(reverify_s=60)
+        (t,) = tr.update([_face(0, 0)])
+        self.assertTrue(tr.needs_embedding(t, now=100.0))
+        tr.record(t, "alice", 0.8, threshold=0.5, now=100.0)
+        for _ in range(5):
+            (t2,) = tr.update([_face(2, 2)])
+            self.assertIs(t2, t)
+            self.assertFalse(tr.needs_embedding(t, now=130.0))
+        self.assertTrue(tr.needs_embedding(t, now=160.0))
+        self.assertEqual(t.label, "alice")
+        tr.record(t, "bob", 0.3, threshold=0.5, now=160.0)  # failed re-verification
+        self.assertFalse(t.resolved)
+        tr.update([_face(2, 2)])
+        self.assertTrue(tr.needs_embedding(t, now=161.0))
+
+    def test_track_expires_after_max_misses(self):
+        tr = FaceTracker(max_misses=3)
+        (t,) = tr.update([_face(0, 0)])
+        for _ in range(3):
+            tr.update([])
+        self.assertIn(t.track_id, tr.tracks)     # missed 3 frames: still kept
+        tr.update([])
+        self.assertNotIn(t.track_id, tr.tracks)
+
+    def test_face_back_within_max_misses_keeps_identity(self):
+        tr = FaceTracker(max_misses=3)
+        (t,) = tr.update([_face(0, 0)])
+        tr.record(t, "alice", 0.9, threshold=0.5, now=10.0)
+        tr.update([])
+        tr.update([])
+        (t2,) = tr.update([_face(4, 4)])
+        self.assertIs(t2, t)
+        self.assertEqual(t2.label, "alice")
+        self.assertFalse(tr.needs_embedding(t2, now=11.0))
+
+    def test_lost_face_is_reidentified_on_a_new_track(self):
+        tr = FaceTracker(max_misses=1)
+        (t,) = tr.update([_face(0, 0)])
+        tr.record(t, "alice", 0.9, threshold=0.5, now=10.0)
+        tr.update([])
+        tr.update([])                           # expired
+        (t2,) = tr.update([_face(0, 0)])
+        self.assertNotEqual(t2.track_id, t.track_id)
+        self.assertFalse(t2.resolved)
+        self.assertTrue(tr.needs_embedding(t2, now=11.0))
+        tr.record(t2, "alice", 0.9, threshold=0.5, now=11.0)
+        self.assertEqual(t2.label, "alice")
+        self.assertEqual(tr.stats()["embeds_run"], 2)
+
+
+class VectorFormatTests(SimpleTestCase):
+    def setUp(self):
+        self.v = normalize_rows(np.random.default_rng(1).standard_normal((1, 512)).astype(np.float32))[0]
+
+    def test_float32_round_trip_is_exact(self):
+        blob = vectors.pack_vector(self.v, dtype="float32")
+        self.assertTrue(blob.startswith(vectors.MAGIC))
+        out = vectors.unpack_vector(blob)
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_array_equal(out, self.v)
+        dt, dim, model, _ = vectors.read_header(blob)
+        self.assertEqual((dt, dim, model), (np.dtype("<f4"), 512, vectors.MODEL_VERSION))
+        self.assertEqual(vectors.model_of(blob), "buffalo_l")
+
+    def test_float16_round_trip_within_tolerance(self):
+        blob = vectors.pack_vector(self.v, dtype="float16")
+        self.assertLess(len(blob), len(vectors.pack_vector(self.v, dtype="float32")))
+        out = vectors.unpack_vector(blob)
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_allclose(out, self.v, atol=1e-3)
+        self.assertAlmostEqual(float(out @ self.v), 1.0, places=3)
+
+    def test_memoryview_and_legacy_json_list(self):
+        blob = vectors.pack_vector(self.v, dtype="float32")
+        np.testing.assert_array_equal(vectors.unpack_vector(memoryview(blob)), self.v)
+        np.testing.assert_allclose(vectors.unpack_vector([0.5, -1.0]), [0.5, -1.0])
+
+    def test_unpack_matrix_uniform_and_mixed_headers(self):
+        rows = normalize_rows(np.random.default_rng(2).standard_normal((4, 512)).astype(np.float32))
+        blobs = [vectors.pack_vector(r, dtype="float32") for r in rows]
+        np.testing.assert_array_equal(vectors.unpack_matrix(blobs), rows)
+        mixed = blobs[:2] + [vectors.pack_vector(r, dtype="float16") for r in rows[2:]]
+        np.testing.assert_allclose(vectors.unpack_matrix(mixed), rows, atol=1e-3)
+        self.assertEqual(vectors.unpack_matrix([]).shape, (0, 0))
+
+    def test_bad_magic_is_rejected(self):
+        blob = b"XXXX" + vectors.pack_vector(self.v, dtype="float32")[4:]
+        with self.assertRaises(ValueError):
+            vectors.unpack_vector(blob)
+
+    def test_truncated_blob_is_rejected(self):
+        blob = vectors.pack_vector(self.v, dtype="float32")
+        for cut in (3, 10, len(blob) - 4):     # inside header, inside model tag, inside payload
+            with self.assertRaises(ValueError):
+                vectors.unpack_vector(blob[:cut])
+
+    def test_unknown_dtype_code_is_rejected(self):
+        blob = bytearray(vectors.pack_vector(self.v, dtype="float32"))
+        blob[4] = 9
+        with self.assertRaises(ValueError):
+            vectors.unpack_vector(bytes(blob))
+
+
+class FakeClock:
+    def __init__(self, t=1000.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+_STATIC = np.zeros((72, 128, 3), dtype=np.uint8)
+_MOVED = np.full((72, 128, 3), 200, dtype=np.uint8)
+
+
+class FrameRateSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.rate = FrameRateScheduler(active_fps=10, idle_fps=1, probe_fps=5, warmup_s=5, hold_s=2,
+                                       motion_thresh=0.01, clock=self.clock)
+
+    def probe(self, frame=_STATIC, dt=0.0, unmarked=None):
+        self.clock.t += dt
+        return self.rate.should_process(frame, unmarked)
+
+    def test_warmup_then_idle_when_static(self):
+        self.assertTrue(self.probe())              # first probe counts as motion
+        self.assertEqual(self.rate.mode, "active")
+        self.probe(dt=4.0)
+        self.assertEqual(self.rate.mode, "active")  # still inside warmup_s
+        self.probe(dt=1.5)
+        self.assertEqual(self.rate.mode, "idle")
+        self.assertEqual(self.rate.target_fps(), 1.0)
+
+    def test_motion_goes_active_until_hold_expires(self):
+        self.probe()
+        self.probe(dt=6.0)
+        self.assertEqual(self.rate.mode, "idle")
+        self.assertTrue(self.probe(_MOVED, dt=1.0))
+        self.assertEqual(self.rate.mode, "active")
+        self.probe(_MOVED, dt=1.5)                  # same image again: no new motion
+        self.assertEqual(self.rate.mode, "active")  # 1.5s < hold_s since the change
+        self.probe(_MOVED, dt=0.6)
+        self.assertEqual(self.rate.mode, "idle")
+
+    def test_everyone_marked_goes_idle_even_in_warmup(self):
+        self.probe(unmarked=3)
+        self.assertEqual(self.rate.mode, "active")
+        self.probe(_MOVED, dt=0.2, unmarked=0)
+        self.assertEqual(self.rate.mode, "idle")
+        self.probe(_STATIC, dt=0.2, unmarked=1)     # a new enrollment: back to active
+        self.assertEqual(self.rate.mode, "active")
+
+    def test_kick_restarts_warmup(self):
+        self.probe()
+        self.probe(dt=6.0)
+        self.assertEqual(self.rate.mode, "idle")
+        self.rate.kick()
+        self.probe(dt=1.0)
+        self.assertEqual(self.rate.mode, "active")
+        self.probe(dt=5.0)
+        self.assertEqual(self.rate.mode, "idle")
+
+    def test_processes_at_the_target_rate(self):
+        # binary-exact steps so the interval comparisons are not at the mercy of rounding
+        self.rate = FrameRateScheduler(active_fps=4, idle_fps=1, probe_fps=8, warmup_s=5, hold_s=2,
+                                       clock=self.clock)
+        due = [self.probe(dt=0.125) for _ in range(16)]      # active: 4 fps of 8 fps probes
+        self.assertEqual(sum(due), 8)
+        self.probe(dt=10.0)
+        self.assertEqual(self.rate.mode, "idle")
+        due = [self.probe(dt=0.25) for _ in range(12)]       # idle: 1 fps of 4 fps probes
+        self.assertEqual(sum(due), 3)
+        self.assertEqual(self.rate.processed + self.rate.skipped, self.rate.probed)
+
+    def test_next_in_and_stats_use_the_clock(self):
+        self.assertTrue(self.probe())
+        self.assertAlmostEqual(self.rate.next_in(), 0.1)
+        self.clock.t += 0.04
+        self.rate.done()
+        self.assertAlmostEqual(self.rate.infer_s, 0.04)
+        self.clock.t += 9.96
+        stats = self.rate.stats()
+        self.assertEqual(stats["processed"], 1)
+        self.assertEqual(stats["saved_pct"], 99.0)          # 1 of the 100 frames a 10 fps loop runs
+        self.assertEqual(stats["idle_pct"], 0.0)            # mode only changes on a probe
+
+    def test_unmarked_count(self):
+        self.assertEqual(unmarked_count([5, 6, -1, 6, 7], {6}), 2)
+        self.assertEqual(unmarked_count([-1, -1], set()), 0)
+        self.assertEqual(unmarked_count([], {1}), 0)
+
+
+def _vec_for(data, d=512):
+    """Deterministic stand-in embedding for an image's bytes."""
+    seed = int(hashlib.sha256(data).hexdigest()[:8], 16)
+    return normalize_rows(np.random.default_rng(seed).standard_normal((1, d)).astype(np.float32))[0]
+
+
+class FaceDataTestCase(TestCase):
+    """UserFace rows with tiny fake images under a temporary MEDIA_ROOT; no model is ever loaded."""
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        overrides = override_settings(MEDIA_ROOT=media, FACE_EMBED_ASYNC=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.embed = mock.Mock(side_effect=_vec_for)
+        # the post_save signal would embed every new UserFace with the real model
+        for target, new in (("apps.biometrics.signals.embed_from_image_bytes", mock.Mock(return_value=None)),
+                            ("apps.biometrics.services.training.embed_from_image_bytes", self.embed),
+                            ("apps.biometrics.services.train_pool.face_service.embed_from_image_bytes", self.embed)):
+            patcher = mock.patch(target, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def add_face(self, user, content):
+        return UserFace.objects.create(user=user, image=SimpleUploadedFile("face.jpg", content))
+
+    def make_user(self, name, n_faces):
+        user = User.objects.create(username=name)
+        return user, [self.add_face(user, f"{name}-{i}".encode()) for i in range(n_faces)]
+
+    def assertTemplateMatches(self, user):
+        self.assertTrue(templates.check_template(user.id))
+        vecs = [_vec_for(f"{user.username}-{i}".encode()) for i in range(user.faces.count())]
+        tpl = UserEmbeddingTemplate.objects.get(user=user)
+        np.testing.assert_allclose(vectors.unpack_vector(tpl.centroid), normalize_rows(np.sum(vecs, axis=0))[0],
+                                   atol=2e-3)
+
+
+class _InProcessExecutor:
+    """ProcessPoolExecutor stand-in: runs the pool initializer and jobs in this process."""
+    instances = []
+
+    def __init__(self, max_workers=None, initializer=None, initargs=(), mp_context=None):
+        self.mp_context = mp_context
+        _InProcessExecutor.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, fn, jobs, chunksize=1):
+        return map(fn, jobs)
+
+
+class ParallelTrainingTests(FaceDataTestCase):
+    def test_flush_results_writes_embeddings_and_template_deltas_together(self):
+        alice, faces = self.make_user("alice", 3)
+        bob, (bob_face,) = self.make_user("bob", 1)
+        training.train_users([bob.id])
+        existing = {e.face_id: e for e in UserFaceEmbedding.objects.all()}
+        results = [(f.id, alice.id, "h", _vec_for(f"alice-{i}".encode()), "embedded") for i, f in enumerate(faces)]
+        results.append((bob_face.id, bob.id, "h", None, "no_face"))
+        touched = training._flush_results(results, existing)
+        self.assertEqual(touched, {alice.id, bob.id})
+        self.assertEqual(UserFaceEmbedding.objects.filter(face__user=alice).count(), 3)
+        self.assertTemplateMatches(alice)
+        self.assertFalse(UserEmbeddingTemplate.objects.filter(user=bob).exists())   # last vector dropped
+
+    def test_replaced_photo_is_a_delta_not_a_new_vector(self):
+        alice, faces = self.make_user("alice", 2)
+        training.train_users([alice.id])
+        existing = {e.face_id: e for e in UserFaceEmbedding.objects.all()}
+        new = _vec_for(b"alice-new")
+        training._flush_results([(faces[0].id, alice.id, "h2", new, "embedded")], existing)
+        tpl = UserEmbeddingTemplate.objects.get(user=alice)
+        self.assertEqual(tpl.count, 2)
+        self.assertTrue(templates.check_template(alice.id))
+        np.testing.assert_allclose(vectors.unpack_vector(tpl.vector_sum), new + _vec_for(b"alice-1"), atol=1e-5)
+
+    @mock.patch.object(training, "WRITE_BATCH", 2)
+    @mock.patch.object(training, "ProcessPoolExecutor", _InProcessExecutor)
+    def test_parallel_run_spawns_batches_and_publishes_progress(self):
+        users = [self.make_user(name, 2)[0] for name in ("alice", "bob", "carol")]
+        cache.delete(training.PROGRESS_KEY)
+        seen = []
+        with mock.patch.object(training, "_flush_results", wraps=training._flush_results) as flush:
+            out = training.train_users_parallel(workers=2, progress=seen.append)
+        self.assertEqual(_InProcessExecutor.instances[-1].mp_context.get_start_method(), "spawn")
+        self.assertEqual(flush.call_count, 3)                        # 6 photos, WRITE_BATCH=2
+        self.assertEqual(out, {"users": 3, "embeddings": 6, "reused": 0, "skipped": 0})
+        progress = cache.get(training.PROGRESS_KEY)
+        self.assertEqual((progress["total"], progress["done"], progress["embedded"]), (6, 6, 6))
+        self.assertEqual([p["done"] for p in seen], [0, 2, 4, 6, 6])
+        for user in users:
+            self.assertTemplateMatches(user)
+        out = training.train_users_parallel(workers=2)
+        self.assertEqual((out["embeddings"], out["reused"]), (0, 6))
+
+
+class IncrementalTrainingTests(FaceDataTestCase):
+    def test_second_run_with_unchanged_images_embeds_nothing(self):
+        alice, _ = self.make_user("alice", 2)
+        bob, _ = self.make_user("bob", 1)
+        out = training.train_users()
+        self.assertEqual(out, {"users": 2, "embeddings": 3, "reused": 0, "skipped": 0})
+        self.assertEqual(self.embed.call_count, 3)
+        out = training.train_users()
+        self.assertEqual(out, {"users": 0, "embeddings": 0, "reused": 3, "skipped": 0})
+        self.assertEqual(self.embed.call_count, 3)
+        self.assertTemplateMatches(alice)
+        self.assertTemplateMatches(bob)
+
+    def test_changed_image_is_the_only_one_reembedded(self):
+        alice, faces = self.make_user("alice", 2)
+        training.train_users()
+        with faces[1].image.open("wb") as f:
+            f.write(b"alice-1-retaken")
+        out = training.train_users()
+        self.assertEqual((out["embeddings"], out["reused"]), (1, 1))
+        tpl = UserEmbeddingTemplate.objects.get(user=alice)
+        self.assertEqual(tpl.count, 2)
+        np.testing.assert_allclose(vectors.unpack_vector(tpl.vector_sum),
+                                   _vec_for(b"alice-0") + _vec_for(b"alice-1-retaken"), atol=1e-5)
+
+    def test_model_version_bump_reembeds(self):
+        alice, _ = self.make_user("alice", 2)
+        training.train_users()
+        with mock.patch.object(training, "MODEL_VERSION", "buffalo_l@2"):
+            out = training.train_users()
+        self.assertEqual((out["embeddings"], out["reused"]), (2, 0))
+        self.assertEqual(self.embed.call_count, 4)
+        self.assertEqual(set(UserFaceEmbedding.objects.values_list("model_version", flat=True)), {"buffalo_l@2"})
+        self.assertEqual(UserEmbeddingTemplate.objects.get(user=alice).count, 2)   # replaced, not added
+        self.assertTrue(templates.check_template(alice.id))
+
+    def test_full_reembeds_everything(self):
+        self.make_user("alice", 2)
+        training.train_users()
+        self.assertEqual(training.train_users(full=True)["embeddings"], 2)
+
+    def test_stale_templates_are_found_and_rebuilt(self):
+        alice, _ = self.make_user("alice", 2)
+        bob, _ = self.make_user("bob", 1)
+        training.train_users()
+        self.assertEqual(training._stale_template_users(), set())
+        UserEmbeddingTemplate.objects.filter(user=alice).update(count=1)    # run died mid-update
+        UserEmbeddingTemplate.objects.filter(user=bob).delete()
+        self.assertEqual(training._stale_template_users(), {alice.id, bob.id})
+        self.assertEqual(training._stale_template_users([bob.id]), {bob.id})
+        out = training.train_users()
+        self.assertEqual(out["embeddings"], 0)
+        self.assertEqual(training._stale_template_users(), set())
+        self.assertTemplateMatches(alice)
+        self.assertTemplateMatches(bob)
+
+
+class RunningTemplateTests(FaceDataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.faces = self.make_user("alice", 4)
+        self.vecs = [_vec_for(f"alice-{i}".encode()) for i in range(4)]
+
+    def store(self, i, vec=None):
+        vec = self.vecs[i] if vec is None else vec
+        UserFaceEmbedding.objects.create(face=self.faces[i], vector=vectors.pack_vector(vec))
+        return templates.add_embedding(self.user.id, vec)
+
+    def assertSameAsRecompute(self):
+        tpl = UserEmbeddingTemplate.objects.get(user=self.user)
+        running = (tpl.count, vectors.unpack_vector(tpl.vector_sum), vectors.unpack_vector(tpl.centroid))
+        full = templates.recompute_template(self.user.id)
+        self.assertEqual(running[0], full.count)
+        np.testing.assert_allclose(running[1], vectors.unpack_vector(full.vector_sum), atol=1e-5)
+        np.testing.assert_allclose(running[2], vectors.unpack_vector(full.centroid), atol=1e-3)
+        self.assertTrue(templates.check_template(self.user.id))
+
+    def test_add_remove_replace_match_full_recompute(self):
+        for i in range(3):
+            tpl = self.store(i)
+        self.assertEqual(tpl.count, 3)
+        self.assertSameAsRecompute()
+
+        row = UserFaceEmbedding.objects.get(face=self.faces[1])
+        old, new = vectors.unpack_vector(row.vector), self.vecs[3]
+        row.vector = vectors.pack_vector(new)
+        row.save()
+        self.assertEqual(templates.replace_embedding(self.user.id, old, new).count, 3)
+        self.assertSameAsRecompute()
+
+        UserFaceEmbedding.objects.get(face=self.faces[0]).delete()     # post_delete -> remove_embedding
+        self.assertEqual(UserEmbeddingTemplate.objects.get(user=self.user).count, 2)
+        self.assertSameAsRecompute()
+
+    def test_check_template_detects_drift(self):
+        for i in range(2):
+            self.store(i)
+        UserEmbeddingTemplate.objects.filter(user=self.user).update(
+            vector_sum=vectors.pack_vector(self.vecs[0], dtype="float32"))
+        self.assertFalse(templates.check_template(self.user.id))
+        UserEmbeddingTemplate.objects.filter(user=self.user).update(count=5)
+        self.assertFalse(templates.check_template(self.user.id))
+
+    def test_template_deleted_when_count_drops_to_zero(self):
+        self.store(0)
+        self.store(1)
+        UserFaceEmbedding.objects.filter(face__user=self.user).delete()
+        self.assertFalse(UserEmbeddingTemplate.objects.filter(user=self.user).exists())
+        self.assertTrue(templates.check_template(self.user.id))        # nothing stored, no template
+        self.assertIsNone(templates.remove_embedding(self.user.id, self.vecs[0]))
+
+    def test_legacy_template_without_sum_is_recomputed_on_delete(self):
+        for i in range(3):
+            self.store(i)
+        stale = vectors.pack_vector(normalize_rows(np.sum(self.vecs[:3], axis=0))[0])
+        UserEmbeddingTemplate.objects.filter(user=self.user).update(vector_sum=None, centroid=stale)
+        UserFaceEmbedding.objects.get(face=self.faces[2]).delete()
+        tpl = UserEmbeddingTemplate.objects.get(user=self.user)
+        self.assertEqual(tpl.count, 2)
+        self.assertIsNotNone(tpl.vector_sum)
+        self.assertSameAsRecompute()
+
+    def test_deleting_the_user_does_not_resurrect_the_template(self):
+        for i in range(2):
+            self.store(i)
+        UserEmbeddingTemplate.objects.filter(user=self.user).update(vector_sum=None)   # legacy row
+        self.user.delete()
+        self.assertFalse(UserEmbeddingTemplate.objects.exists())
+        self.assertFalse(UserFaceEmbedding.objects.exists())
+
+    def test_failed_template_update_rolls_back_the_new_embedding(self):
+        other = User.objects.create(username="bob")
+        with mock.patch("apps.biometrics.signals.embed_from_image_bytes", return_value=self.vecs[0]), \
+             mock.patch("apps.biometrics.signals.add_embedding", side_effect=RuntimeError("db gone")):
+            with self.assertRaises(RuntimeError):
+                self.add_face(other, b"bob-0")
+        self.assertFalse(UserFaceEmbedding.objects.filter(face__user=other).exists())
+        with mock.patch("apps.biometrics.signals.embed_from_image_bytes", return_value=self.vecs[0]):
+            self.add_face(other, b"bob-1")
+        self.assertEqual(UserEmbeddingTemplate.objects.get(user=other).count, 1)
+        self.assertTrue(templates.check_template(other.id))
+
+
+class EmbeddingQueueTests(FaceDataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, (self.face,) = self.make_user("alice", 1)     # FACE_EMBED_ASYNC off: nothing queued yet
+        self.job = embedding_queue.enqueue(self.face)
+        patcher = mock.patch.object(embedding_queue, "embed_from_image_bytes", self.embed)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def job_row(self):
+        return EmbeddingJob.objects.get(id=self.job.id)
+
+    def test_concurrent_claim_goes_to_one_worker(self):
+        real_atomic = embedding_queue.transaction.atomic
+        claimed_by_a = None
+
+        def racing_atomic(*args, **kwargs):
+            nonlocal claimed_by_a
+            if claimed_by_a is None:     # worker A flips the job between B's read and B's update
+                claimed_by_a = []
+                claimed_by_a = embedding_queue.claim("A")
+            return real_atomic(*args, **kwargs)
+
+        with mock.patch.object(embedding_queue.transaction, "atomic", side_effect=racing_atomic):
+            claimed_by_b = embedding_queue.claim("B")
+        self.assertEqual([j.id for j in claimed_by_a], [self.job.id])
+        self.assertEqual(claimed_by_b, [])
+        self.assertEqual((self.job_row().claimed_by, self.job_row().attempts), ("A", 1))
+        self.assertEqual(embedding_queue.claim("C"), [])
+
+    def test_stale_running_job_is_requeued_and_old_owner_backs_off(self):
+        (job,) = embedding_queue.claim("A")
+        self.assertEqual(embedding_queue.requeue_stale(), 0)     # freshly claimed
+        EmbeddingJob.objects.filter(id=job.id).update(
+            updated_at=timezone.now() - timezone.timedelta(seconds=embedding_queue.STALE_AFTER_S + 1))
+        self.assertEqual(embedding_queue.requeue_stale(), 1)
+        self.assertEqual((self.job_row().status, self.job_row().claimed_by), (EmbeddingJob.PENDING, ""))
+        out = embedding_queue.process([job])                     # A wakes up after losing the claim
+        self.assertEqual(out["done"], 0)
+        self.assertFalse(UserFaceEmbedding.objects.exists())
+        (job,) = embedding_queue.claim("B")
+        self.assertEqual(embedding_queue.process([job])["done"], 1)
+        self.assertEqual(UserEmbeddingTemplate.objects.get(user=self.user).count, 1)
+
+    def test_failure_is_retried_then_marked_failed(self):
+        self.embed.side_effect = RuntimeError("onnx exploded")
+        for attempt in range(1, embedding_queue.MAX_ATTEMPTS + 1):
+            (job,) = embedding_queue.claim("A")
+            self.assertEqual(embedding_queue.process([job])["failed"], 1)
+            row = self.job_row()
+            self.assertEqual((row.attempts, row.error), (attempt, "onnx exploded"))
+        self.assertEqual(row.status, EmbeddingJob.FAILED)
+        self.assertEqual(embedding_queue.claim("A"), [])
+        self.assertEqual(embedding_queue.embedding_state(self.user.id), "failed")
+
+    def test_retry_succeeds_and_updates_the_template(self):
+        self.embed.side_effect = [RuntimeError("busy"), _vec_for(b"alice-0")]
+        (job,) = embedding_queue.claim("A")
+        embedding_queue.process([job])
+        self.assertEqual(self.job_row().status, EmbeddingJob.PENDING)
+        self.assertEqual(embedding_queue.embedding_state(self.user.id), "pending")
+        (job,) = embedding_queue.claim("A")
+        self.assertEqual(embedding_queue.process([job]), {"done": 1, "no_face": 0, "failed": 0, "users": 1})
+        self.assertEqual(self.job_row().status, EmbeddingJob.DONE)
+        self.assertEqual(embedding_queue.embedding_state(self.user.id), "ready")
+        self.assertTemplateMatches(self.user)
+
+    def test_async_save_enqueues_and_drains_after_commit(self):
+        bob = User.objects.create(username="bob")
+        with override_settings(FACE_EMBED_ASYNC=True), \
+             mock.patch("apps.biometrics.signals.drain_in_background") as drain, \
+             self.captureOnCommitCallbacks(execute=True):
+            face = self.add_face(bob, b"bob-0")
+        self.assertEqual(EmbeddingJob.objects.get(face=face).status, EmbeddingJob.PENDING)
+        drain.assert_called_once_with()
+
+    def test_admin_changelist_state_needs_no_per_row_queries(self):
+        admin_user = User.objects.create_superuser("root", "root@example.com", "pw")
+        self.client.force_login(admin_user)
+
+        def changelist_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertEqual(self.client.get("/admin/accounts/user/").status_code, 200)
+            return len(ctx.captured_queries)
+
+        few = changelist_queries()
+        for i in range(5):
+            user = User.objects.create(username=f"u{i}")
+            EmbeddingJob.objects.create(face=self.add_face(user, b"x"), user=user, status=EmbeddingJob.FAILED)
+        self.assertEqual(changelist_queries(), few)
+        users = {u.username: u for u in embedding_queue.annotate_embedding_state(User.objects.all())}
+        self.assertEqual(embedding_queue.embedding_state(users["alice"]), "pending")
+        self.assertEqual(embedding_queue.embedding_state(users["u0"]), "failed")
+        self.assertEqual(embedding_queue.embedding_state(users["root"]), "none")
+
+
+class BackgroundDrainTests(SimpleTestCase):
+    def test_one_drain_thread_and_a_rerun_for_late_jobs(self):
+        started, release, runs = threading.Event(), threading.Event(), []
+
+        def fake_run_worker(**kwargs):
+            runs.append(kwargs)
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(embedding_queue, "run_worker", fake_run_worker), \
+             mock.patch.object(embedding_queue, "close_old_connections"):
+            t = embedding_queue.drain_in_background()
+            started.wait(5)
+            self.assertIs(embedding_queue.drain_in_background(), t)    # job queued mid-drain
+            release.set()
+            t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(len(runs), 2)
+        self.assertIsNone(embedding_queue._DRAIN_THREAD)
+
+
+class SupervisorRequestTests(TestCase):
+    def setUp(self):
+        self.sup = mock.Mock()
+        self.sup._running.return_value = True
+        self.sup.start.return_value = "queued"
+        self.sup.stop.return_value = 4321
+
+    def test_start_waits_for_the_supervisor_process(self):
+        # the supervisor process answers while the web process polls
+        with mock.patch.object(supervisor_mod.time, "sleep",
+                               side_effect=lambda s: supervisor_mod.handle_requests(self.sup)):
+            self.assertEqual(supervisor_mod.request_start(7, cam_source=1, wait_s=5), "queued")
+        self.sup.start.assert_called_once_with(7, "1")
+        req = WorkerRequest.objects.get()
+        self.assertEqual((req.action, req.result), (WorkerRequest.START, "queued"))
+        self.assertIsNotNone(req.handled_at)
+
+    def test_unanswered_start_is_reported_and_handled_later(self):
+        self.assertEqual(supervisor_mod.request_start(7, wait_s=0), supervisor_mod.REQUESTED)
+        self.sup.start.assert_not_called()
+        self.assertEqual(supervisor_mod.handle_requests(self.sup), 1)
+        self.sup.start.assert_called_once_with(7, None)
+        self.assertEqual(supervisor_mod.handle_requests(self.sup), 0)
+
+    def test_requests_run_in_order_and_ended_sessions_are_not_started(self):
+        supervisor_mod.request_start(7, wait_s=0)
+        supervisor_mod.request_stop(7)
+        supervisor_mod.request_stop(8)
+        self.sup._running.side_effect = lambda session_id: session_id != 9
+        supervisor_mod.request_start(9, wait_s=0)
+        self.sup.stop.side_effect = [4321, None]
+        self.assertEqual(supervisor_mod.handle_requests(self.sup), 4)
+        self.assertEqual(list(WorkerRequest.objects.order_by("id").values_list("action", "session_id", "result")),
+                         [("start", 7, "queued"), ("stop", 7, "stopped"), ("stop", 8, "none"),
+                          ("start", 9, "not running")])
+        self.assertEqual([c.args for c in self.sup.method_calls if c[0] in ("start", "stop")],
+                         [(7, None), (7,), (8,)])
+
+    def test_old_handled_requests_are_pruned(self):
+        supervisor_mod.request_stop(7)
+        supervisor_mod.request_stop(8)
+        supervisor_mod.handle_requests(self.sup)
+        WorkerRequest.objects.filter(session_id=7).update(handled_at=timezone.now() - timezone.timedelta(days=2))
+        supervisor_mod.request_stop(9)
+        self.assertEqual(supervisor_mod._prune_requests(86400), 1)
+        self.assertEqual(sorted(WorkerRequest.objects.values_list("session_id", flat=True)), [8, 9])
+
+
+class StubDetector:
+    """det_model stand-in: one face per frame, its box derived from the frame's first pixel."""
+
+    def __init__(self, delay_s=0.0):
+        self.delay_s = delay_s
+        self.calls = 0
+
+    def detect(self, img, max_num=0, metric="default"):
+        self.calls += 1
+        time.sleep(self.delay_s)
+        v = float(img.flat[0])
+        kps = np.arange(10, dtype=np.float32).reshape(1, 5, 2) + v
+        return np.array([[v, v + 1, v + 20, v + 21, 0.9]], dtype=np.float32), kps
+
+
+class StubRecognizer:
+    input_size = (112, 112)
+
+    def __init__(self):
+        self.calls = []
+
+    def get_feat(self, crops):
+        self.calls.append(len(crops))
+        return np.array([[float(c.flat[0]), 1.0] for c in crops], dtype=np.float32)
+
+
+def _stub_app(delay_s=0.0):
+    return SimpleNamespace(det_model=StubDetector(delay_s), models={"recognition": StubRecognizer()})
+
+
+def _frame(v, shape=(48, 64, 3)):
+    return np.full(shape, v, dtype=np.uint8)
+
+
+class FramingTests(SimpleTestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+
+    def test_round_trip(self):
+        blob = np.arange(300000, dtype=np.float32).tobytes()    # more than one recv() worth
+
+        def send():
+            inference_server.send_msg(self.a, {"op": "detect", "shape": [1, 2, 3]}, blob)
+            inference_server.send_msg(self.a, {"op": "info"})
+
+        sender = threading.Thread(target=send, daemon=True)
+        sender.start()
+        self.addCleanup(sender.join, 5)
+        self.assertEqual(inference_server.recv_msg(self.b), ({"op": "detect", "shape": [1, 2, 3]}, blob))
+        self.assertEqual(inference_server.recv_msg(self.b), ({"op": "info"}, b""))
+
+    def test_peer_closing_mid_message_is_a_connection_error(self):
+        h = b'{"op": "embed"}'
+        self.a.sendall(inference_server._HDR.pack(len(h), 100) + h + b"x" * 10)
+        self.a.close()
+        with self.assertRaises(ConnectionError):
+            inference_server.recv_msg(self.b)
+
+
+class InferenceBatcherTests(SimpleTestCase):
+    def test_jobs_of_all_connections_share_one_detect_and_one_embed_call(self):
+        app = _stub_app()
+        batcher = inference_server.InferenceBatcher(app, batch_wait_ms=200)
+        detects = [inference_server._Job("detect", _frame(v)) for v in (10, 20, 30)]
+        embeds = [inference_server._Job("embed", [_frame(v, (112, 112, 3)) for v in vs]) for vs in ((1, 2), (3,))]
+        for j in detects + embeds:
+            batcher.q.put(j)
+        with mock.patch("apps.biometrics.services.face.detect_faces_batch",
+                        wraps=face_service.detect_faces_batch) as batch_detect:
+            batcher.start()
+            for j in detects + embeds:
+                self.assertTrue(j.done.wait(5))
+        batch_detect.assert_called_once()
+        self.assertEqual(len(batch_detect.call_args.args[1]), 3)
+        self.assertEqual(app.models["recognition"].calls, [3])
+        for j, v in zip(detects, (10, 20, 30)):
+            self.assertIsNone(j.error)
+            bboxes, kpss = j.result
+            np.testing.assert_array_equal(bboxes, app.det_model.detect(_frame(v))[0])
+            np.testing.assert_array_equal(kpss, app.det_model.detect(_frame(v))[1])
+        np.testing.assert_array_equal(embeds[0].result[:, 0], [1, 2])
+        np.testing.assert_array_equal(embeds[1].result[:, 0], [3])
+        self.assertEqual((batcher.batches, batcher.jobs, batcher.frames, batcher.crops), (1, 5, 3, 3))
+
+    def test_face_arrays_without_faces(self):
+        bboxes, kpss = inference_server._face_arrays([])
+        self.assertEqual(bboxes.shape, (0, 5))
+        self.assertIsNone(kpss)
+
+
+class InferenceClientTests(SimpleTestCase):
+    def serve(self, app):
+        srv = inference_server.InferenceServer(("127.0.0.1", 0), app)
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        self.addCleanup(self.stop, srv)
+        return srv
+
+    def stop(self, srv):
+        if srv.socket.fileno() != -1:      # shutdown() blocks unless serve_forever() still runs
+            srv.shutdown()
+            srv.server_close()
+
+    def connect(self, srv, **kw):
+        c = inference_server.InferenceClient(*srv.server_address, **kw)
+        self.addCleanup(c.close)
+        return c
+
+    def test_calls_go_through_the_service(self):
+        app = _stub_app()
+        client = self.connect(self.serve(app), fallback=mock.Mock())
+        bboxes, kpss = client.detect(_frame(40))
+        np.testing.assert_array_equal(bboxes, [[40, 41, 60, 61, np.float32(0.9)]])
+        self.assertEqual(kpss.shape, (1, 5, 2))
+        feats = client.get_feat([_frame(5, (112, 112, 3)), _frame(6, (112, 112, 3))])
+        np.testing.assert_array_equal(feats, [[5, 1], [6, 1]])
+        client.fallback.assert_not_called()
+
+    def test_dropped_service_falls_back_to_the_local_model(self):
+        srv = self.serve(_stub_app())
+        local = _stub_app()
+        client = self.connect(srv, fallback=lambda: local, retry_s=60)
+        client.detect(_frame(1))
+        self.stop(srv)
+        client.close()                               # the next call must reconnect: refused
+        bboxes, _ = client.detect(_frame(7))
+        self.assertEqual((client.fallbacks, local.det_model.calls), (1, 1))
+        self.assertEqual(bboxes[0, 0], 7)
+        client.get_feat([_frame(8, (112, 112, 3))])   # stays local until retry_s passes
+        self.assertEqual((client.fallbacks, local.models["recognition"].calls), (1, [1]))
+
+    def test_slow_reply_skips_the_frame_without_falling_back(self):
+        srv = self.serve(_stub_app(delay_s=0.5))
+        fallback = mock.Mock()
+        client = self.connect(srv, timeout=0.1, fallback=fallback)
+        with self.assertRaises(inference_server.InferenceTimeout):
+            client.detect(_frame(1))
+        fallback.assert_not_called()
+        self.assertEqual(client.fallbacks, 0)
+        self.assertIsNone(client._sock)              # a late reply must not be read as the next one
+
+    def test_refused_without_fallback_raises(self):
+        srv = self.serve(_stub_app())
+        client = self.connect(srv)
+        self.stop(srv)
+        client.close()
+        with self.assertRaises(ConnectionError):
+            client.detect(_frame(1))
+
+    def test_connect_or_none_reads_the_timeout_setting(self):
+        srv = self.serve(_stub_app())
+        host, port = srv.server_address
+        with override_settings(FACE_INFERENCE_TIMEOUT_S=0.75):
+            client = inference_server.connect_or_none(f"{host}:{port}")
+        self.addCleanup(client.close)
+        self.assertEqual(client.timeout, 0.75)
+        self.assertIsNone(inference_server.connect_or_none(""))
+
+
+class StubScrfdSession:
+    """
+    ONNX session shaped like SCRFD with keypoints (3 strides x score/bbox/kps,
+    2 anchors). Outputs depend only on each image's pixels, so a batched run
+    must decode to exactly what one detect() per frame gives.
+    """
+
+    def __init__(self, size=(64, 64), batched=True, max_batch=None):
+        self.size, self.batched, self.max_batch = size, batched, max_batch
+        self.batch_sizes = []
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="input.1", shape=["N", 3, self.size[1], self.size[0]])]
+
+    def get_outputs(self):
+        dims = ["N", "A"] if self.batched else ["A"]
+        return [SimpleNamespace(name=f"out{i}", shape=dims + [c]) for i, c in enumerate([1] * 3 + [4] * 3 + [10] * 3)]
+
+    def run(self, names, feeds):
+        x = feeds["input.1"]
+        n, _, h, w = x.shape
+        self.batch_sizes.append(n)
+        if self.max_batch and n > self.max_batch:
+            raise RuntimeError("Got invalid dimensions for input: input.1")
+        outs = {1: [], 4: [], 10: []}
+        for stride in (8, 16, 32):
+            pooled = x[:, 0].reshape(n, h // stride, stride, w // stride, stride).mean(axis=(2, 4)).reshape(n, -1)
+            pooled = np.repeat(pooled, 2, axis=1)[..., None]
+            outs[1].append((pooled + 1) / 2)
+            outs[4].append(np.concatenate([np.abs(pooled) + 1] * 4, axis=-1))
+            outs[10].append(np.concatenate([pooled] * 10, axis=-1))
+        res = [o.astype(np.float32) for c in (1, 4, 10) for o in outs[c]]
+        return res if self.batched else [o.reshape(-1, o.shape[-1]) for o in res]
+
+
+class DetectFacesBatchTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = [rng.integers(0, 256, (48, 64, 3), dtype=np.uint8) for _ in range(3)]
+        self.frames.append(np.full((64, 40, 3), 255, np.uint8))     # portrait: other letterbox scale
+
+    def app(self, **session_kw):
+        from insightface.model_zoo.scrfd import SCRFD
+        return SimpleNamespace(det_model=SCRFD(session=StubScrfdSession(**session_kw)))
+
+    def assertSameFaces(self, got, want):
+        self.assertEqual([len(f) for f in got], [len(f) for f in want])
+        for faces_a, faces_b in zip(got, want):
+            for a, b in zip(faces_a, faces_b):
+                np.testing.assert_allclose(a.bbox, b.bbox, rtol=1e-5)
+                np.testing.assert_allclose(a.kps, b.kps, rtol=1e-5)
+                self.assertAlmostEqual(float(a.det_score), float(b.det_score), places=6)
+
+    def check_matches_detect(self, app, max_num=0):
+        want = [face_service.detect_faces(app, f, max_num=max_num) for f in self.frames]
+        session = app.det_model.session
+        session.batch_sizes.clear()
+        got = face_service.detect_faces_batch(app, self.frames, max_num=max_num)
+        self.assertEqual(session.batch_sizes, [len(self.frames)])     # one detector call
+        self.assertTrue(any(want))
+        self.assertSameFaces(got, want)
+
+    def test_batched_outputs_decode_like_detect(self):
+        self.check_matches_detect(self.app())
+
+    def test_flat_outputs_decode_like_detect(self):
+        self.check_matches_detect(self.app(batched=False))
+
+    def test_max_num_keeps_the_same_faces(self):
+        self.check_matches_detect(self.app(), max_num=2)
+
+    def test_fixed_batch_model_falls_back_to_one_call_per_frame(self):
+        app = self.app(max_batch=1)
+        want = [face_service.detect_faces(app, f) for f in self.frames]
+        got = face_service.detect_faces_batch(app, self.frames)
+        self.assertSameFaces(got, want)
+        self.assertFalse(app.det_model._batch_ok)
+        app.det_model.session.batch_sizes.clear()
+        face_service.detect_faces_batch(app, self.frames)              # no second batched attempt
+        self.assertEqual(app.det_model.session.batch_sizes, [1] * len(self.frames))
+
+    def test_detector_without_scrfd_internals_detects_per_frame(self):
+        app = _stub_app()
+        got = face_service.detect_faces_batch(app, [_frame(10), _frame(20)])
+        self.assertEqual(app.det_model.calls, 2)
+        self.assertEqual([float(f[0].bbox[0]) for f in got], [10.0, 20.0])
+
+
+FRONTAL_KPS = np.array([[40, 50], [80, 50], [60, 72], [45, 90], [75, 90]], dtype=np.float32)
+
+
+def _rotated(kps, deg, center=(60, 70)):
+    t = np.radians(deg)
+    rot = np.array([[np.cos(t), -np.sin(t)], [np.sin(t), np.cos(t)]], dtype=np.float32)
+    return (kps - center) @ rot.T + center
+
+
+class QualityGateTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.sharp = rng.integers(0, 256, (160, 160, 3), dtype=np.uint8)
+        self.blurred = cv2.GaussianBlur(self.sharp, (31, 31), 8)
+        self.gate = QualityGate()
+
+    def face(self, kps=FRONTAL_KPS, bbox=(20, 20, 100, 120), score=0.9):
+        return Face(bbox=np.array(bbox, dtype=np.float32), kps=kps, det_score=score)
+
+    def yawed(self, frac):
+        kps = FRONTAL_KPS.copy()
+        kps[2, 0] += frac * 20     # nose towards an eye; 20 px = half the eye distance
+        return kps
+
+    def test_frontal_face_passes(self):
+        yaw, pitch = head_pose(FRONTAL_KPS)
+        self.assertAlmostEqual(yaw, 0.0, places=3)
+        self.assertLess(abs(pitch), 10)
+        self.assertIsNone(self.gate.reason(self.sharp, self.face()))
+
+    def test_yaw_from_nose_offset_ignores_roll(self):
+        self.assertAlmostEqual(head_pose(self.yawed(0.5))[0], 30.0, places=3)
+        self.assertAlmostEqual(head_pose(self.yawed(-0.5))[0], -30.0, places=3)
+        for roll in (-40, 25):
+            self.assertAlmostEqual(head_pose(_rotated(self.yawed(0.5), roll))[0], 30.0, places=2)
+            self.assertIsNone(self.gate.reason(self.sharp, self.face(_rotated(FRONTAL_KPS, roll))))
+
+    def test_large_yaw_and_pitch_are_rejected(self):
+        self.assertEqual(self.gate.reason(self.sharp, self.face(self.yawed(0.8))), "yaw")
+        up = FRONTAL_KPS.copy()
+        up[2, 1] = 52              # nose on the eye line: head tilted back
+        self.assertGreater(abs(head_pose(up)[1]), 30)
+        self.assertEqual(self.gate.reason(self.sharp, self.face(up)), "pitch")
+
+    def test_blurred_crop_is_rejected(self):
+        bbox = (20, 20, 100, 120)
+        self.assertGreater(blur_score(self.sharp, bbox), self.gate.min_blur)
+        self.assertLess(blur_score(self.blurred, bbox), self.gate.min_blur)
+        self.assertEqual(self.gate.reason(self.blurred, self.face()), "blur")
+        self.assertEqual(blur_score(self.sharp, (150, 150, 151, 151)), 0.0)     # degenerate crop
+
+    def test_filter_counts_every_reason(self):
+        faces = [self.face(),                                   # passes
+                 self.face(bbox=(0, 0, 30, 30)),                # small
+                 self.face(score=0.3),                          # low_score
+                 self.face(self.yawed(0.9)),                    # yaw
+                 self.face(bbox=(10, 10, 150, 150), kps=None),  # passes (no landmarks: pose skipped)
+                 ]
+        kept, idx = self.gate.filter(self.sharp, faces, idx=[7, 8, 9, 10, 11])
+        self.assertEqual(idx, [7, 11])
+        self.assertEqual(kept, [faces[0], faces[4]])
+        self.gate.filter(self.blurred, [self.face()])
+        self.assertEqual(self.gate.stats(), {"checked": 6, "passed": 2, "small": 1, "low_score": 1,
+                                             "yaw": 1, "pitch": 0, "blur": 1})
+
+    def test_from_settings(self):
+        with override_settings(FACE_QUALITY_GATE=None):
+            self.assertIsNone(QualityGate.from_settings())
+        with override_settings(FACE_QUALITY_GATE={"max_yaw": 60.0}):
+            gate = QualityGate.from_settings()
+        self.assertEqual((gate.max_yaw, gate.min_box), (60.0, 40))
+        self.assertIsNone(gate.reason(self.sharp, self.face(self.yawed(0.8))))
+
+
+def _brute_search(ids, mat, embs, k):
+    """Reference top-k by id over normalized rows; padded with -1 like the indexes."""
+    sims = normalize_rows(embs) @ normalize_rows(mat).T
+    order = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+    out_ids = np.full((embs.shape[0], k), -1, np.int64)
+    out_sims = np.full((embs.shape[0], k), -1.0, np.float32)
+    n = min(k, len(ids))
+    out_ids[:, :n] = np.asarray(ids)[order]
+    out_sims[:, :n] = np.take_along_axis(sims, order, axis=1)
+    return out_ids, out_sims
+
+
+class GalleryIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def assertSearchMatches(self, idx, ids, mat, k=3, **kw):
+        embs = _unit(self.rng, 6, d=idx.dim)
+        got_ids, got_sims = idx.search(embs, k=k, **kw)
+        want_ids, want_sims = _brute_search(ids, mat, embs, k)
+        np.testing.assert_array_equal(got_ids, want_ids)
+        np.testing.assert_allclose(got_sims, want_sims, atol=1e-5)
+
+    def test_exact_add_upsert_and_swap_remove(self):
+        idx = gallery_index.ExactIndex(dim=16)
+        vecs = {u: _unit(self.rng, 1)[0] for u in range(1, 101)}
+        idx.add(list(vecs), np.stack(list(vecs.values())))          # grows past the initial capacity
+        self.assertEqual(len(idx), 100)
+        vecs[7] = _unit(self.rng, 1)[0]
+        np.testing.assert_array_equal(idx.add([7], vecs[7][None]), [6])     # upsert keeps the row
+        self.assertEqual(len(idx), 100)
+
+        idx.remove([3, 999])                                        # 999 is unknown: ignored
+        self.assertEqual((len(idx), int(idx.ids[2])), (99, 100))    # the last row filled the hole
+        del vecs[3]
+        self.assertEqual(sorted(idx.ids.tolist()), sorted(vecs))
+        self.assertEqual(idx._pos, {int(u): i for i, u in enumerate(idx.ids)})
+        for u, i in idx._pos.items():
+            np.testing.assert_allclose(idx.matrix[i], vecs[u], atol=1e-6)
+        self.assertSearchMatches(idx, list(vecs), np.stack(list(vecs.values())))
+
+    def test_exact_search_pads_missing_slots(self):
+        idx = gallery_index.ExactIndex(dim=16)
+        ids, sims = idx.search(_unit(self.rng, 2), k=2)
+        self.assertTrue((ids == -1).all() and (sims == -1).all())
+        mat = _unit(self.rng, 2)
+        idx.add([5, 9], mat)
+        self.assertSearchMatches(idx, [5, 9], mat, k=4)
+
+    def test_ivf_trains_itself_at_the_threshold(self):
+        idx = gallery_index.IVFIndex(dim=16, nlist=4, nprobe=4)
+        threshold = 4 * gallery_index.TRAIN_PER_LIST
+        mat = _unit(self.rng, threshold)
+        idx.add(range(threshold - 1), mat[:-1])
+        self.assertFalse(idx.trained)
+        self.assertSearchMatches(idx, list(range(threshold - 1)), mat[:-1])     # exact until trained
+        idx.add([threshold - 1], mat[-1:])
+        self.assertEqual((idx.trained, idx.ncells), (True, 4))
+        self.assertSearchMatches(idx, list(range(threshold)), mat)              # nprobe = every cell
+        new = _unit(self.rng, 1)
+        idx.remove([0, 1])
+        idx.add([1000], new)                                   # only the new row is assigned a cell
+        self.assertSearchMatches(idx, list(range(2, threshold)) + [1000], np.vstack([mat[2:], new]))
+
+    def test_ivf_with_too_few_rows_stays_exact(self):
+        idx = gallery_index.IVFIndex(dim=16, nlist=64)
+        self.assertFalse(idx.train(_unit(self.rng, 50)))
+        self.assertFalse(idx.trained)
+
+    def test_save_load_round_trip(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        mat = _unit(self.rng, 200)
+        for idx in (gallery_index.ExactIndex(dim=16), gallery_index.IVFIndex(dim=16, nlist=4, nprobe=2)):
+            idx.add(range(200), mat)
+            idx.remove([5])
+            idx.synced_at = 1234.5
+            path = os.path.join(tmp, f"{idx.kind}.npz")
+            idx.save(path)
+            back = gallery_index.load_index(path)
+            self.assertIs(type(back), type(idx))
+            self.assertEqual((back.synced_at, len(back), back.dim), (1234.5, 199, 16))
+            np.testing.assert_array_equal(back.ids, idx.ids)
+            embs = _unit(self.rng, 4)
+            for a, b in zip(back.search(embs, k=3), idx.search(embs, k=3)):
+                np.testing.assert_array_equal(a, b)
+            if idx.kind == "ivf":
+                self.assertEqual((back.nlist, back.nprobe, back.ncells), (4, 2, 4))
+                np.testing.assert_array_equal(back.cell, idx.cell)
+            back.add([5], mat[5:6])                                # positions are rebuilt on load
+            back.remove([0])
+            self.assertEqual(back._pos, {int(u): i for i, u in enumerate(back.ids)})
+
+
+class SyncIndexTests(TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.vecs = {}
+        for i in range(4):
+            self.set_template(User.objects.create(username=f"u{i}").id, _unit(self.rng, 1)[0])
+
+    def set_template(self, user_id, vec):
+        self.vecs[user_id] = vec
+        UserEmbeddingTemplate.objects.update_or_create(user_id=user_id,
+                                                       defaults={"centroid": vectors.pack_vector(vec)})
+
+    def test_sync_picks_up_updated_new_and_deleted_templates(self):
+        idx = gallery_index.build_index("exact")
+        self.assertEqual(sorted(idx.ids.tolist()), sorted(self.vecs))
+        self.assertEqual(gallery_index.sync_index(idx), (0, 0))
+
+        changed, gone = sorted(self.vecs)[:2]
+        self.set_template(changed, _unit(self.rng, 1)[0])
+        self.set_template(User.objects.create(username="new").id, _unit(self.rng, 1)[0])
+        UserEmbeddingTemplate.objects.filter(user_id=gone).delete()
+        del self.vecs[gone]
+        self.assertEqual(gallery_index.sync_index(idx), (2, 1))
+        self.assertEqual(sorted(idx.ids.tolist()), sorted(self.vecs))
+        for u, vec in self.vecs.items():
+            np.testing.assert_allclose(idx.matrix[idx._pos[u]], vec, atol=1e-5)
+        ids, _ = idx.search(np.stack(list(self.vecs.values())), k=1)
+        self.assertEqual(ids[:, 0].tolist(), list(self.vecs))
+        self.assertEqual(gallery_index.sync_index(idx), (0, 0))
+
+    def test_load_or_build_saves_and_syncs(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        path = os.path.join(tmp, "campus.npz")
+        self.assertEqual(len(gallery_index.load_or_build_index(path, kind="exact")), 4)
+        self.assertEqual(len(gallery_index.load_index(path)), 4)
+        user_id = User.objects.create(username="new").id
+        self.set_template(user_id, _unit(self.rng, 1)[0])
+        self.assertEqual(len(gallery_index.load_or_build_index(path, kind="exact")), 5)
+        self.assertIn(user_id, gallery_index.load_index(path).ids.tolist())
+        self.assertEqual(gallery_index.load_or_build_index(path, kind="ivf").kind, "ivf")   # kind change: rebuild
+        self.assertEqual(gallery_index.load_index(path).kind, "ivf")
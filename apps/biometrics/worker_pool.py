@@ -0,0 +1,189 @@
+# apps/biometrics/worker_pool.py
+"""
+Warm pool of session workers.
+
+A cold `python face_session_cam.py <id>` spends seconds importing Django,
+cv2 and insightface and loading the model before its first frame. The pool
+keeps FACE_WORKER_POOL_SIZE standby processes (`face_session_cam.py
+--standby`) that have already done all of that and run one warm-up
+inference, then block on stdin. launch_face_worker() hands a session to a
+ready one with a single JSON line, so recognition starts as soon as the
+camera opens, and a replacement is spawned right away.
+
+Standby processes are spawned, not forked from a preloaded parent: the
+web process holds threads and DB connections that must not be forked, and
+spawn is the only start method on Windows, where the workers run
+(DirectShow cameras). A standby worker exits when the pool closes its
+stdin (web process exit or shutdown).
+
+Only one process per host keeps a pool: the supervisor process
+(face_supervisor.py) calls refill_pool(), and warm_pool() first takes an
+exclusive lock on LOG_DIR/worker_pool.lock, held until that process
+exits, so a second process on the host launches cold.
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import subprocess
+from django.conf import settings
+from .session_worker import LOG_DIR, _ensure_log_dir, _default_env, _script_path, _claim_lock
+
+READY_LINE = "[POOL] READY"      # printed by a standby worker once its model is warm
+
+
+class _Standby:
+    """One spawned standby process; a reader thread forwards its output until READY."""
+
+    def __init__(self, proc, log_fh):
+        self.proc = proc
+        self.log_fh = log_fh
+        self.spawned_at = time.time()
+        self.ready_at = None
+        self.ready = threading.Event()
+        threading.Thread(target=self._read, daemon=True, name=f"pool-{proc.pid}").start()
+
+    def _read(self):
+        # ends when the worker redirects its output to the session log (or exits)
+        for line in self.proc.stdout:
+            line = line.rstrip("\n")
+            if line == READY_LINE:
+                self.ready_at = time.time()
+                self.ready.set()
+                line = f"{READY_LINE} in {self.ready_at - self.spawned_at:.1f}s"
+            if self.log_fh:
+                self.log_fh.write(f"[{self.proc.pid}] {line}\n")
+
+    def alive(self):
+        return self.proc.poll() is None
+
+
+class WarmPool:
+    def __init__(self, size=1):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._log_fh = None
+        self.spawned = self.handed_off = self.died = 0
+
+    def _log(self):
+        if self._log_fh is None:
+            _ensure_log_dir()
+            path = os.path.join(LOG_DIR, "worker_pool.log")
+            try:
+                self._log_fh = open(path, "a", buffering=1, encoding="utf-8", errors="replace")
+            except Exception as e:
+                print(f"[POOL] WARN: cannot open log file {path}: {e}")
+        return self._log_fh
+
+    def _spawn(self):
+        env = _default_env()
+        log_fh = self._log()
+        proc = subprocess.Popen(
+            [sys.executable, _script_path(), "--standby"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=log_fh or subprocess.DEVNULL,
+            text=True, encoding="utf-8", errors="replace",
+            cwd=settings.BASE_DIR,
+            env=env,
+            creationflags=(subprocess.DETACHED_PROCESS if sys.platform.startswith("win") else 0),
+        )
+        self.spawned += 1
+        print(f"[POOL] Spawned standby worker PID={proc.pid}")
+        return _Standby(proc, log_fh)
+
+    def refill(self):
+        """Drop dead standby workers and spawn up to `size`. Returns how many were spawned."""
+        with self._lock:
+            dead = [w for w in self._idle if not w.alive()]
+            for w in dead:
+                print(f"[POOL] Standby worker PID={w.proc.pid} exited (code {w.proc.returncode})")
+            self.died += len(dead)
+            self._idle = [w for w in self._idle if w.alive()]
+            missing = self.size - len(self._idle)
+            for _ in range(missing):
+                try:
+                    self._idle.append(self._spawn())
+                except Exception as e:
+                    print(f"[POOL] ERROR: failed to spawn standby worker: {e}")
+                    break
+        return max(0, missing)
+
+    def take(self, session_id, cam_source=None, log_path=None, start_ts=None, room_id=None):
+        """Hand the session to a ready worker. Returns its Popen, or None when none is ready."""
+        with self._lock:
+            w = next((w for w in self._idle if w.ready.is_set() and w.alive()), None)
+            if w is None:
+                return None
+            self._idle.remove(w)
+        job = {"session_id": session_id, "room_id": room_id, "cam_source": cam_source, "log": log_path,
+               "start_ts": start_ts or time.time()}
+        try:
+            w.proc.stdin.write(json.dumps(job) + "\n")
+            w.proc.stdin.close()
+        except (OSError, ValueError) as e:
+            print(f"[POOL] WARN: standby worker PID={w.proc.pid} unusable: {e}")
+            return None
+        finally:
+            # spawn the replacement off the caller's thread; it warms up on its own
+            threading.Thread(target=self.refill, daemon=True, name="pool-refill").start()
+        self.handed_off += 1
+        return w.proc
+
+    def close(self):
+        """Closing stdin makes every idle standby worker exit."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for w in idle:
+            try:
+                w.proc.stdin.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._lock:
+            ready = sum(1 for w in self._idle if w.ready.is_set())
+            return {"size": self.size, "idle": len(self._idle), "ready": ready, "spawned": self.spawned,
+                    "handed_off": self.handed_off, "died": self.died}
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_NOT_OWNER_LOGGED = False
+
+
+def _claim_pool():
+    """True in the one process holding the pool lock file (released when it exits)."""
+    return _claim_lock("worker_pool.lock")
+
+
+def warm_pool():
+    """
+    The process-wide pool, or None when FACE_WORKER_POOL_SIZE is 0 or another
+    process on this host already keeps the pool.
+    """
+    global _POOL, _NOT_OWNER_LOGGED
+    size = int(getattr(settings, "FACE_WORKER_POOL_SIZE", 0) or 0)
+    if size <= 0:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            if not _claim_pool():
+                if not _NOT_OWNER_LOGGED:
+                    print(f"[POOL] pid {os.getpid()}: another process keeps the warm pool; launching cold")
+                    _NOT_OWNER_LOGGED = True
+                return None
+            _POOL = WarmPool(size)
+            atexit.register(_POOL.close)
+    return _POOL
+
+
+def refill_pool():
+    """Supervisor loop: keep the pool at its configured size."""
+    pool = warm_pool()
+    if pool is not None:
+        pool.refill()
+    return pool.stats() if pool else None
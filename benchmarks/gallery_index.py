@@ -0,0 +1,83 @@
+# benchmarks/gallery_index.py
+"""
+Recall-vs-latency for the campus gallery index (no database, no camera).
+
+Synthetic identities are random unit vectors (the worst case for IVF: no
+cluster structure) or, with --clusters C, spread around C random centres
+to mimic the demographic structure of real embeddings. Queries are an identity plus
+noise scaled so the true match sits around cosine 0.6, like a live probe
+against a buffalo_l centroid. Recall@k is measured against ExactIndex.
+
+    python benchmarks/gallery_index.py --n 50000 --clusters 64 --nlist 256 --nprobe 1 4 8 16 32
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from apps.biometrics.services.gallery_index import ExactIndex, IVFIndex  # noqa: E402
+from apps.biometrics.services.matching import normalize_rows  # noqa: E402
+
+
+def _timed(fn, *a, **kw):
+    t0 = time.perf_counter()
+    out = fn(*a, **kw)
+    return out, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=50000, help="identities in the gallery")
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--batch", type=int, default=20, help="faces per search call (one frame)")
+    ap.add_argument("--k", type=int, default=5)
+    ap.add_argument("--nlist", type=int, default=256)
+    ap.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    ap.add_argument("--clusters", type=int, default=0, help="0 = uniform identities")
+    ap.add_argument("--noise", type=float, default=1.3, help="probe noise relative to the identity")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(0)
+    ids = np.arange(1, args.n + 1)
+    gallery = rng.standard_normal((args.n, args.dim))
+    if args.clusters:
+        centres = normalize_rows(rng.standard_normal((args.clusters, args.dim))) * 1.5
+        gallery = normalize_rows(gallery) + centres[rng.integers(0, args.clusters, args.n)]
+    gallery = normalize_rows(gallery)
+    truth = rng.integers(0, args.n, args.queries)
+    noise = normalize_rows(rng.standard_normal((args.queries, args.dim))) * args.noise
+    probes = normalize_rows(gallery[truth] + noise)
+    print(f"gallery={args.n}x{args.dim} ({gallery.nbytes / 1e6:.0f} MB)  queries={args.queries}  "
+          f"batch={args.batch}  mean true cosine={float((probes * gallery[truth]).sum(1).mean()):.2f}")
+
+    exact = ExactIndex(args.dim)
+    _, t_build = _timed(exact.add, ids, gallery)
+
+    def run(index, **kw):
+        out_ids, total = [], 0.0
+        for s in range(0, args.queries, args.batch):
+            (got, _sims), dt = _timed(index.search, probes[s:s + args.batch], args.k, **kw)
+            out_ids.append(got)
+            total += dt
+        return np.vstack(out_ids), total * 1000 / args.queries
+
+    ref, ms = run(exact)
+    print(f"{'exact':<14} build {t_build:6.2f}s  {ms:7.3f} ms/face  recall@1 1.000  "
+          f"top1==truth {np.mean(ref[:, 0] == ids[truth]):.3f}")
+
+    ivf = IVFIndex(args.dim, nlist=args.nlist)
+    _, t_train = _timed(ivf.train, gallery)
+    _, t_add = _timed(ivf.add, ids, gallery)
+    for nprobe in args.nprobe:
+        got, ms = run(ivf, nprobe=nprobe)
+        r1 = np.mean(got[:, 0] == ref[:, 0])
+        rk = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(got, ref)])
+        print(f"ivf nprobe={nprobe:<4} build {t_train + t_add:6.2f}s  {ms:7.3f} ms/face  "
+              f"recall@1 {r1:.3f}  recall@{args.k} {rk:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# benchmarks/model_startup.py
+"""
+Startup time, memory and per-frame latency of the model configurations.
+
+Each configuration runs in a fresh process (so RSS and load time are not
+shared): load + prepare, then FaceAnalysis.get() on one image `--repeat`
+times (median reported). "full pack" is the old behaviour (every model in
+buffalo_l); the others go through services.model_factory.load_face_app().
+
+    python benchmarks/model_startup.py --image media/profiles/bobby.jpg
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing as mp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIGS = [
+    ("full pack 640", {"full": True}),
+    ("det+rec 640", {}),
+    ("det+rec 320", {"det_size": 320}),
+    ("det_500m+rec 320", {"det_pack": "buffalo_s", "det_size": 320}),
+]
+
+
+def _run(args):
+    conf, image, repeat = args
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    import cv2
+    t0 = time.perf_counter()
+    if conf.get("full"):
+        from insightface.app import FaceAnalysis
+        app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
+        app.prepare(ctx_id=0, det_size=(640, 640))
+    else:
+        from apps.biometrics.services.model_factory import load_face_app
+        app = load_face_app(**conf)
+    startup = time.perf_counter() - t0
+    img = cv2.imread(image) if image else None
+    if img is None:
+        img = np.zeros((720, 1280, 3), np.uint8)
+    app.get(img)  # warm-up
+    times, faces = [], 0
+    for _ in range(repeat):
+        t = time.perf_counter()
+        faces = len(app.get(img))
+        times.append(time.perf_counter() - t)
+    return {"startup_s": startup, "frame_ms": float(np.median(times)) * 1000, "faces": faces,
+            "models": sorted(app.models), "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--image", default=os.path.join(ROOT, "media", "profiles", "bobby.jpg"))
+    ap.add_argument("--repeat", type=int, default=20)
+    args = ap.parse_args()
+    ctx = mp.get_context("spawn")
+    for name, conf in CONFIGS:
+        with ctx.Pool(1) as pool:
+            try:
+                r = pool.apply(_run, ((conf, args.image, args.repeat),))
+            except Exception as e:
+                print(f"{name:<18} failed: {e}")
+                continue
+        print(f"{name:<18} startup {r['startup_s']:5.2f}s  rss {r['rss_mb']:6.0f} MB  "
+              f"{r['frame_ms']:7.1f} ms/frame ({r['faces']} faces)  models={r['models']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# benchmarks/whitelist.py
+"""
+Section gallery loader at 100 / 1,000 / 10,000 students.
+
+Runs against a throwaway test database (never the project db.sqlite3):
+bulk-creates one course section with N enrolled students and binary
+templates, then times load_assignment_whitelist() and counts its queries.
+--legacy also times the old per-template owner scan for comparison.
+
+    python benchmarks/whitelist.py --sizes 100 1000 10000 --legacy
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+import django  # noqa: E402
+django.setup()
+
+import numpy as np  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.runner import DiscoverRunner  # noqa: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # noqa: E402
+from django.apps import apps as django_apps  # noqa: E402
+from apps.biometrics.services.vectors import pack_vector, unpack_vector  # noqa: E402
+from apps.academics.whitelist import load_assignment_whitelist  # noqa: E402
+
+
+def _legacy(course_assignment_id):
+    """The previous implementation: O(N^2) owner scan per template row."""
+    Enrollment = django_apps.get_model("academics", "Enrollment")
+    Student = django_apps.get_model("academics", "Student")
+    UserEmb = django_apps.get_model("biometrics", "UserEmbeddingTemplate")
+    stu_ids = list(Enrollment.objects.filter(course_assignment_id=course_assignment_id)
+                   .values_list("student_id", flat=True))
+    rows = Student.objects.select_related("user").filter(id__in=stu_ids)
+    user_by_student = {s.id: s.user_id for s in rows}
+    vecs = []
+    for e in UserEmb.objects.filter(user_id__in=list(user_by_student.values())):
+        for sid, uid in user_by_student.items():
+            if uid == e.user_id:
+                v = unpack_vector(e.centroid)
+                vecs.append(v / (np.linalg.norm(v) + 1e-8))
+                break
+    return np.vstack(vecs)
+
+
+def _make_section(tag, n, rng):
+    M = {name: django_apps.get_model(app, name) for app, name in
+         [("accounts", "User"), ("academics", "Department"), ("academics", "Professor"),
+          ("academics", "Course"), ("academics", "CourseAssignment"), ("academics", "Student"),
+          ("academics", "Enrollment"), ("biometrics", "UserEmbeddingTemplate")]}
+    dept = M["Department"].objects.create(name=f"Bench {tag}", code=f"B{tag}")
+    prof = M["Professor"].objects.create(user=M["User"].objects.create(username=f"bench_prof_{tag}"), department=dept)
+    course = M["Course"].objects.create(code=f"BENCH-{tag}", title="bench", department=dept)
+    ca = M["CourseAssignment"].objects.create(course=course, professor=prof, term="bench", capacity=n)
+    users = M["User"].objects.bulk_create(
+        [M["User"](username=f"bench_{tag}_{i}", first_name=f"S{i}", last_name="Bench") for i in range(n)],
+        batch_size=2000)
+    users = list(M["User"].objects.filter(username__startswith=f"bench_{tag}_").order_by("id"))
+    M["Student"].objects.bulk_create([M["Student"](user=u) for u in users if not hasattr(u, "student_profile")],
+                                     batch_size=2000, ignore_conflicts=True)
+    students = list(M["Student"].objects.filter(user__in=users))
+    M["Enrollment"].objects.bulk_create(
+        [M["Enrollment"](student=s, course_assignment=ca, status="approved") for s in students], batch_size=2000)
+    M["UserEmbeddingTemplate"].objects.bulk_create(
+        [M["UserEmbeddingTemplate"](user=u, centroid=pack_vector(rng.standard_normal(512)), count=1) for u in users],
+        batch_size=2000)
+    return ca.id
+
+
+def _best_of(fn, *a, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*a)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    ap.add_argument("--legacy", action="store_true", help="also time the old O(N^2) loader")
+    args = ap.parse_args()
+
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        rng = np.random.default_rng(0)
+        for n in args.sizes:
+            ca_id = _make_section(n, n, rng)
+            connection.queries_log.clear()  # bulk inserts above may have filled the log
+            with CaptureQueriesContext(connection) as q:
+                _sids, _uids, mat, _display = load_assignment_whitelist(ca_id)
+            ms = _best_of(load_assignment_whitelist, ca_id)
+            line = f"N={n:<6} rows={mat.shape[0]:<6} queries={len(q)}  {ms:8.1f} ms"
+            if args.legacy:
+                line += f"   legacy {_best_of(_legacy, ca_id, repeat=1):8.1f} ms"
+            print(line)
+    finally:
+        runner.teardown_databases(old_config)
+
+
+if __name__ == "__main__":
+    main()
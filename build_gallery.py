@@ -1,10 +1,8 @@
 import os, glob, json, numpy as np
-from insightface.app import FaceAnalysis
+from apps.biometrics.services.model_factory import load_face_app
 
 def init_model():
-    app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    return app
+    return load_face_app()
 
 def face_embed(app, img_path):
     import cv2
@@ -1,16 +1,14 @@
 import json, time
 import numpy as np
 import cv2
-from insightface.app import FaceAnalysis
+from apps.biometrics.services.model_factory import load_face_app
 
 SIM_THRESH = 0.55   # adjust to 0.60 if you see false accepts
 COOLDOWN_S  = 60    # avoid repeating the same student spam
 HEADLESS  = False  # set to True if no GUI available
 
 def init_model():
-    app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    return app
+    return load_face_app()
 
 def load_gallery(path="gallery.json"):
     with open(path, "r") as f:
@@ -132,6 +132,81 @@ RUN_MAIN = os.environ.get("RUN_MAIN") == "true"
 QR_SERVER_SECRET = "replace-with-a-long-random-secret"
 
 
+# Shared face inference service ("host:port"); empty = each worker loads its own model.
+# Start it with: python -m apps.biometrics.services.inference_server --port 8765
+FACE_INFERENCE_ADDR = os.environ.get("FACE_INFERENCE_ADDR", "")
+# Seconds a worker waits for a reply from it; a slower reply skips that frame (a refused
+# or dropped connection switches the worker to a local model instead)
+FACE_INFERENCE_TIMEOUT_S = float(os.environ.get("FACE_INFERENCE_TIMEOUT_S", "2.0"))
+# Stored embedding precision: "float32" or "float16" (half the size, ~1e-3 error)
+FACE_EMBEDDING_DTYPE = "float32"
+# Training processes for the admin "train all" action (1 = in-process, sequential)
+FACE_TRAIN_WORKERS = int(os.environ.get("FACE_TRAIN_WORKERS", "1"))
+# Queue UserFace embeddings instead of computing them inside the admin save request.
+# The web process drains its own jobs on a background thread after commit; extra
+# `python embedding_worker.py` processes can run alongside. 0 = embed inline.
+FACE_EMBED_ASYNC = os.environ.get("FACE_EMBED_ASYNC", "1") == "1"
+# Templates per student in live galleries: 1 = mean centroid, K > 1 = up to K
+# clustered embeddings scored as max-over-templates (~2 KB per template)
+FACE_GALLERY_TEMPLATES = int(os.environ.get("FACE_GALLERY_TEMPLATES", "1"))
+# Campus-wide 1:N index (kiosk/hallway cameras): "exact", "ivf", or "auto" = ivf once
+# the gallery reaches FACE_INDEX_IVF_MIN_IDS (exact is faster below that; see
+# benchmarks/gallery_index.py); built/synced with
+# `python -m apps.biometrics.services.gallery_index`
+FACE_INDEX_BACKEND = os.environ.get("FACE_INDEX_BACKEND", "auto")
+FACE_INDEX_IVF_MIN_IDS = int(os.environ.get("FACE_INDEX_IVF_MIN_IDS", "10000"))
+FACE_INDEX_DIR = BASE_DIR / "var" / "face_index"
+# InsightFace model factory (services/model_factory.py): detector + recognizer only.
+# det_pack "buffalo_s" (det_500m) with det_size 320 suits small rooms; the recognizer
+# always comes from `pack` so stored embeddings stay valid.
+FACE_MODEL = {
+    "pack": "buffalo_l",
+    "det_pack": os.environ.get("FACE_DET_PACK") or None,
+    "det_size": int(os.environ.get("FACE_DET_SIZE", "640")),
+    "intra_threads": int(os.environ.get("FACE_ORT_THREADS", "0")),
+    "inter_threads": 1,
+    # ORT optimization level; optimized graphs are saved per model/ORT version under
+    # cache_dir and reused by later workers (machine-local: "all" may be CPU-specific)
+    "graph_opt": os.environ.get("FACE_ORT_OPT", "all"),
+    "cache_dir": BASE_DIR / "var" / "ort_cache",
+}
+# Warm session workers kept loaded (model + Django) for instant session start;
+# each holds its own model in memory. 0 = always launch cold. The supervisor process
+# (python face_supervisor.py, one per host) keeps the pool.
+FACE_WORKER_POOL_SIZE = int(os.environ.get("FACE_WORKER_POOL_SIZE", "0"))
+# Session worker supervisor (apps/biometrics/supervisor.py), run as its own process next
+# to the web server: python face_supervisor.py. Keys override its DEFAULTS.
+# Workers are admitted while cpu_cores // min_threads slots (and mem_budget_mb, if set)
+# allow, each with cpu_cores // slots ONNX threads; the rest queue.
+FACE_SUPERVISOR = {
+    "max_workers": int(os.environ.get("FACE_MAX_WORKERS", "0")),
+    "mem_budget_mb": int(os.environ.get("FACE_WORKER_MEM_BUDGET_MB", "0")),
+    "min_threads": 2,
+}
+FACE_HEARTBEAT_DIR = BASE_DIR / "var" / "heartbeats"
+# Per-session invalidation files (apps/academics/session_state.py): a stop in the
+# web process reaches the worker processes within a second
+FACE_STATE_DIR = BASE_DIR / "var" / "session_state"
+# One camera worker per Room (face_session_cam.py --room) serving every running session
+# there, instead of one worker and camera per Session (opt-in: FACE_ROOM_WORKERS=1)
+FACE_ROOM_WORKERS = os.environ.get("FACE_ROOM_WORKERS", "0") == "1"
+# Cameras of a room worker, {room_id: [source, ...]}; frames of all of them are
+# detected in one batched call. Rooms not listed use the session's cam_source.
+FACE_ROOM_CAMERAS = {}
+# Session worker startup milestones (time-to-first-recognition), one JSON line per session
+FACE_STARTUP_METRICS_FILE = MEDIA_ROOT / "logs" / "startup_metrics.jsonl"
+# Pre-recognition quality gate (services/quality.py); keys override its DEFAULTS,
+# None disables it
+FACE_QUALITY_GATE = {"min_box": 40, "min_score": 0.60, "max_yaw": 35.0, "max_pitch": 30.0, "min_blur": 40.0}
+# Adaptive inference rate of the camera loops (services/frame_rate.py): active_fps at
+# session start and on motion, idle_fps when the scene is static or everyone is marked;
+# keys override its DEFAULTS, None = run inference on every frame
+FACE_FRAME_RATE = {"active_fps": 10.0, "idle_fps": 1.0, "probe_fps": 5.0, "warmup_s": 300,
+                   "hold_s": 10, "motion_thresh": 0.01}
+# Compiled per-section gallery snapshots (memory-mapped by camera workers)
+FACE_GALLERY_DIR = BASE_DIR / "var" / "galleries"
+
+
 if RUN_MAIN:  # Prevent double scheduler in Django auto-reloader
     start_scheduler()
 
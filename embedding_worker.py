@@ -0,0 +1,20 @@
+# embedding_worker.py
+import os, sys, argparse
+
+# ---------------- Django bootstrap ----------------
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+import django
+django.setup()
+
+from apps.biometrics.services.embedding_queue import run_worker, CLAIM_BATCH
+
+
+# ---------------- CLI entry ----------------
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Drain queued UserFace embedding jobs")
+    ap.add_argument("--batch", type=int, default=CLAIM_BATCH, help="jobs claimed per round")
+    ap.add_argument("--poll", type=float, default=2.0, help="seconds to sleep when the queue is empty")
+    ap.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    args = ap.parse_args()
+    # run several copies of this script for a bigger pool; claims are atomic
+    run_worker(batch=args.batch, poll_s=args.poll, once=args.once)
@@ -1,5 +1,5 @@
 # face_session_cam.py
-import os, sys, time
+import os, sys, time, json
 import numpy as np
 import cv2
 from datetime import datetime
@@ -14,12 +14,31 @@ from django.utils import timezone
 from django.apps import apps as django_apps
 from django.db import transaction
 
+from apps.biometrics.services.matching import stack_embeddings, best_matches
+from apps.biometrics.services.face import detect_faces, embed_faces, detect_faces_batch, embed_faces_batch
+from apps.biometrics.services.tracking import FaceTracker
+from apps.biometrics.services.inference_server import InferenceTimeout
+from apps.biometrics.services.capture import LatestFrameGrabber, CameraStream
+from apps.biometrics.services.quality import QualityGate
+from apps.biometrics.services.startup_metrics import StartupClock, START_ENV
+from apps.biometrics.services.heartbeat import HeartbeatWriter
+from apps.biometrics.services.frame_rate import FrameRateScheduler, unmarked_count
+from apps.academics.session_state import SessionState
+from apps.academics.attendance_writer import AttendanceWriter
+from apps.academics.gallery_snapshot import open_snapshot
+from apps.academics.live_gallery import LiveGallery, _TOMBSTONE
+from apps.academics.room_sessions import RoomSessions
+
 # ---------------- Config ----------------
 SIM_THRESHOLD = 0.50        # start a bit permissive; raise to 0.55-0.60 later
 COOLDOWN_S    = 30          # do not re-mark the same student within this many seconds
 WARMUP_FRAMES = 10
 FRAME_SLEEP   = 0.02        # small sleep during warmup/read fail
 SHOW_PREVIEW  = os.environ.get("PREVIEW", "0") == "1"  # set PREVIEW=1 to see a window
+REVERIFY_S    = 60          # re-embed an already recognized face track this often
+STATS_EVERY_S = 60          # log tracker savings this often
+ROOM_IDLE_S   = 60          # a room worker exits after this long with no running session
+CAM_WAIT_S    = 0.03        # multi-camera: how long to wait for a camera's next frame
 
 # ---------------- Models (lazy via apps) ----------------
 # We'll use get_model inside helpers so the module import order never breaks.
@@ -72,91 +91,79 @@ def load_gallery_for_session(session_id):
     Return dict[user_id(str) -> normalized centroid vector] for students
     enrolled in the session's course_assignment.
     """
-    import numpy as np
-    Session = django_apps.get_model("academics", "Session")
-    Enrollment = django_apps.get_model("academics", "Enrollment")
-    UserEmbeddingTemplate = django_apps.get_model("biometrics", "UserEmbeddingTemplate")
-
-    sess = Session.objects.select_related("course_assignment").get(id=session_id)
-
-    # enrolled students → user_ids
-    user_ids = list(
-        Enrollment.objects.filter(course_assignment=sess.course_assignment)
-        .values_list("student__user_id", flat=True)
-    )
-    if not user_ids:
-        print(f"[WARN] No enrollments found for session {session_id}")
+    snap = load_session_snapshot(session_id)
+    if snap.matrix is None:
+        print(f"[WARN] No enrolled embeddings found for session {session_id}")
         return {}
-
-    qs = UserEmbeddingTemplate.objects.filter(user_id__in=user_ids)
-    gallery = {}
-    for row in qs:
-        v = np.array(row.centroid, dtype=np.float32)
-        v /= (np.linalg.norm(v) + 1e-8)
-        gallery[str(row.user_id)] = v
-
-    return gallery
+    return {str(uid): snap.matrix[i] for i, uid in enumerate(snap.user_ids)}
 
 
-# ---------------- Matching helper ----------------
-def best_match(emb, gallery):
-    """Return (best_user_id:str or None, best_sim:float). emb must be L2-normalized np.float32."""
-    best_id, best_sim = None, -1.0
-    for uid, vec in gallery.items():
-        s = float(np.dot(emb, vec))  # cosine since both normalized
-        if s > best_sim:
-            best_id, best_sim = uid, s
-    return best_id, best_sim
+def load_session_snapshot(session_id):
+    """Compiled (memory-mapped) gallery of the session's course_assignment."""
+    Session = django_apps.get_model("academics", "Session")
+    ca_id = Session.objects.filter(id=session_id).values_list("course_assignment_id", flat=True).get()
+    return open_snapshot(ca_id)
 
 
 # ---------------- Attendance writer ----------------
-def mark_attendance_for_match(session_id, matched_user_id, sim_score):
+def mark_attendance_for_match(session_id, matched_user_id, sim_score, state=None, writer=None, roster=None):
     """
     Create/update Attendance row for this student if session is running
     and student is enrolled. Logs reasons when skipping.
+    `state` is the worker's cached SessionState (avoids re-reading Session).
+    With `writer` (AttendanceWriter) the write is queued and flushed in batches.
+    With `roster` (SessionRoster) user -> student/enrollment is an in-memory lookup.
     """
-    Session     = django_apps.get_model("academics", "Session")
     Student     = django_apps.get_model("academics", "Student")
     Enrollment  = django_apps.get_model("academics", "Enrollment")
     Attendance  = django_apps.get_model("academics", "Attendance")
 
     now = timezone.now()
-    sess = Session.objects.select_related("course_assignment").get(id=session_id)
-
-    if sess.status != "running":
-        print(f"[SKIP] Session {session_id} not running (status={sess.status})")
-        return False
+    if state is None:
+        state = SessionState(session_id)
 
-    # End-time safety: stop if past end_time
-    if sess.end_time and now >= sess.end_time:
-        print(f"[STOP] Session {session_id} ended at {sess.end_time}.")
+    running, why = state.check(now)
+    if not running:
+        print(f"[SKIP] Session {session_id} not marking: {why}")
         return False
 
-    # Map user -> student
-    try:
-        student = Student.objects.get(user_id=matched_user_id)
-    except Student.DoesNotExist:
-        print(f"[SKIP] No Student found for user_id={matched_user_id}")
-        return False
-
-    # Must be enrolled in this course_assignment
-    enrolled = Enrollment.objects.filter(
-        student=student,
-        course_assignment=sess.course_assignment
-    ).exists()
-    if not enrolled:
-        print(f"[SKIP] Student {student.id} user_id={matched_user_id} not enrolled in this course.")
-        return False
+    if roster is not None:
+        # Map user -> student and enrollment check, both precomputed
+        entry = roster.for_user(matched_user_id)
+        if entry is None:
+            print(f"[SKIP] user_id={matched_user_id} not enrolled in this course.")
+            return False
+        student_id = entry.student_id
+    else:
+        # Map user -> student
+        try:
+            student_id = Student.objects.values_list("id", flat=True).get(user_id=matched_user_id)
+        except Student.DoesNotExist:
+            print(f"[SKIP] No Student found for user_id={matched_user_id}")
+            return False
+
+        # Must be enrolled in this course_assignment
+        enrolled = Enrollment.objects.filter(
+            student_id=student_id,
+            course_assignment_id=state.course_assignment_id
+        ).exists()
+        if not enrolled:
+            print(f"[SKIP] Student {student_id} user_id={matched_user_id} not enrolled in this course.")
+            return False
 
     # Present vs Late (10-min grace)
     LATE_GRACE_MIN = 10
-    status = "Present" if now <= (sess.start_time + timezone.timedelta(minutes=LATE_GRACE_MIN)) else "Late"
+    status = state.attendance_status(now, grace_min=LATE_GRACE_MIN)
+
+    if writer is not None:
+        writer.submit(student_id, sim_score, status)
+        return True
 
     try:
         with transaction.atomic():
             obj, created = Attendance.objects.get_or_create(
-                session=sess,
-                student=student,
+                session_id=session_id,
+                student_id=student_id,
                 defaults={
                     "method": "face",
                     "liveness_score": None,
@@ -166,7 +173,7 @@ def mark_attendance_for_match(session_id, matched_user_id, sim_score):
                 }
             )
             if created:
-                print(f"[ATTENDANCE] MARKED {status}: student_id={student.id} user_id={matched_user_id} "
+                print(f"[ATTENDANCE] MARKED {status}: student_id={student_id} user_id={matched_user_id} "
                       f"sim={sim_score:.3f} session={session_id}")
                 cache.incr(f"sess:{session_id}:face_seen", ignore_key_check=True)
 
@@ -190,32 +197,68 @@ def mark_attendance_for_match(session_id, matched_user_id, sim_score):
 
 # ---------------- InsightFace ----------------
 def init_insightface():
-    from insightface.app import FaceAnalysis
-    app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-    app.prepare(ctx_id=0, det_size=(640, 640))
-    return app
+    # reuse the shared inference service when one is configured and reachable
+    from django.conf import settings
+    from apps.biometrics.services.inference_server import connect_or_none
+    from apps.biometrics.services.model_factory import load_face_app
+    # a stalled/dropped service falls back to a local model instead of stopping the loop
+    client = connect_or_none(getattr(settings, "FACE_INFERENCE_ADDR", ""), fallback=load_face_app)
+    if client is not None:
+        return client
+    return load_face_app()
 
 
 # ---------------- Main loop ----------------
-def run_session_worker(session_id, cam_source=0):
+def run_session_worker(session_id, cam_source=0, app=None):
     print(f"[INFO] Starting worker for session_id={session_id}, cam_source={cam_source}")
+    # time-to-first-recognition, measured from session_start (see launch_face_worker)
+    clock = StartupClock(session_id)
 
     # Load embeddings only for enrolled students
-    gallery = load_gallery_for_session(session_id)
-    print(f"[INFO] Loaded {len(gallery)} student embeddings for session {session_id}")
-    if not gallery:
+    Session = django_apps.get_model("academics", "Session")
+    ca_id = Session.objects.filter(id=session_id).values_list("course_assignment_id", flat=True).get()
+    # memory-mapped (N, 512) snapshot, scored as one matmul per frame (K templates per
+    # student when FACE_GALLERY_TEMPLATES > 1); enroll/drop/retrain is applied live
+    gallery = LiveGallery(ca_id)
+    view = gallery.view
+    print(f"[INFO] Loaded {len(gallery)} student embeddings for session {session_id} (r{view.rev})")
+    if view.matrix is None:
         print("[WARN] No enrolled embeddings found; worker will run but won’t mark.")
-    app = init_insightface()
+    if app is None:  # warm pool workers arrive with the model loaded
+        app = init_insightface()
+    clock.mark("model_ready")
 
     # open camera
     cap = open_cam(cam_source, width=1280, height=720, force_mjpg=False)
     if not cap:
         print("[ERROR] Cannot open camera. Exiting.")
         return
-
-    Session = django_apps.get_model("academics", "Session")
+    clock.mark("camera_open")
+
+    # capture runs on its own thread; we always infer on the newest frame
+    grabber = LatestFrameGrabber(cap)
+    grabber.start()
+
+    # run-state is cached; the per-frame check does not hit the database
+    state = SessionState(session_id)
+    # marks are queued and written in batches off the recognition loop
+    writer = AttendanceWriter(session_id)
+    writer.start()
+    # gallery row -> (user_id, student_id, name, enrollment), reloaded with the gallery
+    gallery.start()
+    print(f"[INFO] Roster: {len(view.roster)} rows for course_assignment={state.course_assignment_id}")
     last_mark_by_user = {}  # cooldown: user_id -> last_ts
     last_seen_faces_ts = 0
+    # detect every frame, embed only new / unresolved / due-for-reverify tracks
+    tracker = FaceTracker(reverify_s=REVERIFY_S)
+    # tiny / blurred / turned-away faces are skipped before the recognizer runs
+    gate = QualityGate.from_settings()
+    last_stats_ts = time.time()
+    # fps / last frame / RSS for the supervisor (apps/biometrics/supervisor.py)
+    heartbeat = HeartbeatWriter(session_id)
+    heartbeat.beat(force=True)
+    # full rate at start and on motion, idle rate when static or everyone is marked
+    rate = FrameRateScheduler.from_settings()
 
     # preview window
     if SHOW_PREVIEW:
@@ -224,49 +267,59 @@ def run_session_worker(session_id, cam_source=0):
     try:
         while True:
             # stop when session ends or is stopped
-            sess = Session.objects.get(id=session_id)
-            now = timezone.now()
-            if sess.status != "running":
-                print(f"[STOP] Session status is {sess.status}, stopping worker.")
-                break
-            if sess.end_time and now >= sess.end_time:
-                print(f"[STOP] Reached end_time={sess.end_time}, stopping worker.")
+            running, why = state.check()
+            if not running:
+                print(f"[STOP] Session {why}, stopping worker.")
                 break
 
-            ok, frame = cap.read()
+            ok, frame, frame_ts, frame_age = grabber.read(timeout=1.0)
             if not ok or frame is None:
-                time.sleep(0.05)
+                heartbeat.beat()
+                continue
+            clock.mark("first_frame")
+            view = gallery.view  # one consistent gallery for this frame
+            if rate is not None and not rate.should_process(frame, unmarked_count(view.user_ids, last_mark_by_user)):
+                rate.wait()
                 continue
+            heartbeat.tick(frame_ts, marked=len(last_mark_by_user), rate=rate.stats() if rate else None)
 
-            faces = app.get(frame)
+            try:
+                faces = detect_faces(app, frame)
+            except InferenceTimeout as e:
+                print(f"[WARN] {e}; frame skipped")
+                continue
             # debug
             if faces:
+                clock.mark("first_face")
                 last_seen_faces_ts = time.time()
                 print(f"[INFO] {len(faces)} face(s) detected in frame.")
 
-            for f in faces:
-                emb = f.normed_embedding
-                if emb is None:
-                    e = f.embedding
-                    emb = e / (np.linalg.norm(e) + 1e-8)
-                emb = emb.astype(np.float32)
-
-                best_id, best_sim = best_match(emb, gallery)
-                x1, y1, x2, y2 = [int(x) for x in f.bbox]
-                color = (0, 255, 0) if (best_id and best_sim >= SIM_THRESHOLD) else (0, 0, 255)
-                label = f"{best_id or 'unknown'} {best_sim:.2f}"
+            tracks = tracker.update(faces)
+            now_ts = time.time()
+            pending = [i for i, t in enumerate(tracks) if tracker.needs_embedding(t, now_ts)]
+            if gate is not None and pending:
+                _, pending = gate.filter(frame, [faces[i] for i in pending], pending)
+            if pending:
+                try:
+                    todo = embed_faces(app, frame, [faces[i] for i in pending])
+                except InferenceTimeout as e:
+                    print(f"[WARN] {e}; frame skipped")
+                    continue
+                matches = best_matches(stack_embeddings(todo), view.user_ids, view.matcher)
+            else:
+                matches = []
 
-                # draw in preview
-                if SHOW_PREVIEW:
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-                    cv2.putText(frame, label, (x1, max(0, y1 - 8)),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+            for i, (best_id, best_sim) in zip(pending, matches):
+                if best_id == _TOMBSTONE:   # freed gallery row (dropped student): nobody
+                    best_id = None
+                tracker.record(tracks[i], best_id, best_sim, SIM_THRESHOLD, now_ts)
 
                 # marking
                 if best_id and best_sim >= SIM_THRESHOLD:
-                    now_ts = time.time()
+                    clock.mark("first_recognition")
                     if now_ts - last_mark_by_user.get(best_id, 0) >= COOLDOWN_S:
-                        ok = mark_attendance_for_match(session_id, int(best_id), best_sim)
+                        ok = mark_attendance_for_match(session_id, int(best_id), best_sim,
+                                                       state=state, writer=writer, roster=view.roster)
                         if ok:
                             last_mark_by_user[best_id] = now_ts
                     else:
@@ -274,6 +327,24 @@ def run_session_worker(session_id, cam_source=0):
                 else:
                     if best_id:
                         print(f"[LOW SIM] user_id={best_id} sim={best_sim:.2f} < {SIM_THRESHOLD}")
+            if rate is not None:
+                rate.done()
+
+            # draw in preview (resolved tracks keep their label without re-embedding)
+            if SHOW_PREVIEW:
+                for f, t in zip(faces, tracks):
+                    x1, y1, x2, y2 = [int(x) for x in f.bbox]
+                    color = (0, 255, 0) if t.resolved else (0, 0, 255)
+                    label = f"#{t.track_id} {t.label or 'unknown'} {t.sim:.2f}"
+                    cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+                    cv2.putText(frame, label, (x1, max(0, y1 - 8)),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2)
+
+            if now_ts - last_stats_ts >= STATS_EVERY_S:
+                print(f"[TRACK] {tracker.stats()} capture={grabber.stats()} frame_age={frame_age:.3f}s "
+                      f"gallery={gallery.stats()} quality={gate.stats() if gate else None} "
+                      f"rate={rate.stats() if rate else None}")
+                last_stats_ts = now_ts
 
             if SHOW_PREVIEW:
                 cv2.imshow("Session Camera", frame)
@@ -282,16 +353,250 @@ def run_session_worker(session_id, cam_source=0):
                     break
 
     finally:
+        heartbeat.clear()
+        gallery.stop()
+        grabber.stop()
         cap.release()
+        writer.stop()  # flush pending marks
+        print(f"[INFO] Attendance writer: {writer.stats()}")
         if SHOW_PREVIEW:
             cv2.destroyAllWindows()
         print("[INFO] Worker stopped/cleaned up.")
 
 
+# ---------------- Room worker ----------------
+def _camera_sources(cam_source):
+    """ "0,1,video=Cam B" -> [0, 1, "video=Cam B"]; a single source -> [source]."""
+    if isinstance(cam_source, str) and "," in cam_source:
+        return [int(c) if c.strip().isdigit() else c.strip() for c in cam_source.split(",") if c.strip()]
+    return [cam_source]
+
+
+def run_room_worker(room_id, cam_source=0, app=None):
+    """
+    One detection/recognition pipeline for every running session in the
+    room, fed by one or more cameras (cam_source "0,1,2"). Sessions
+    attach/detach while the cameras keep running. Each cycle takes the
+    newest frame of every camera, detects on all of them in one batched
+    call and embeds all pending faces in one recognizer call. Sightings of
+    the same student on several cameras are merged (best similarity) before
+    the mark goes to every attached session that enrolls the student.
+    """
+    sources = _camera_sources(cam_source)
+    print(f"[INFO] Starting room worker for room_id={room_id}, cameras={sources}")
+    clock = StartupClock(f"room:{room_id}")
+    rooms = RoomSessions(room_id)
+    rooms.sync(force=True)
+    if app is None:  # warm pool workers arrive with the model loaded
+        app = init_insightface()
+    clock.mark("model_ready")
+
+    cams = []
+    for src in sources:
+        cap = open_cam(src, width=1280, height=720, force_mjpg=False)
+        if cap:
+            cams.append(CameraStream(str(src), cap))
+        else:
+            print(f"[WARN] Camera {src} unavailable; continuing without it.")
+    if not cams:
+        print("[ERROR] Cannot open any camera. Exiting.")
+        rooms.close()
+        return
+    clock.mark("camera_open")
+    for cam in cams:
+        cam.start()
+
+    trackers = {cam.name: FaceTracker(reverify_s=REVERIFY_S) for cam in cams}  # tracks are per view
+    gate = QualityGate.from_settings()
+    heartbeat = HeartbeatWriter(f"room:{room_id}")
+    heartbeat.beat(force=True)
+    # per-camera rate: a quiet camera idles while a busy one runs at full rate
+    rates = {cam.name: FrameRateScheduler.from_settings() for cam in cams}
+    last_stats_ts = idle_since = time.time()
+    sightings = merged = 0
+    # with one camera wait like the single-session loop; with several, don't let one stall the rest
+    wait_s = 1.0 if len(cams) == 1 else CAM_WAIT_S
+
+    try:
+        while True:
+            attached, _ = rooms.sync()
+            if attached:  # a session started: back to full rate on every camera
+                for r in rates.values():
+                    if r is not None:
+                        r.kick()
+            now_ts = time.time()
+            if len(rooms):
+                idle_since = now_ts
+            elif now_ts - idle_since >= ROOM_IDLE_S:
+                print(f"[STOP] No running session in room {room_id} for {ROOM_IDLE_S}s, stopping worker.")
+                break
+
+            views = rooms.views()  # one consistent gallery per section for this cycle
+            unmarked = sum(unmarked_count(views[ctx.course_assignment_id].user_ids, ctx.last_mark_by_user)
+                           for ctx in rooms.sessions.values() if ctx.course_assignment_id in views)
+            # newest frame of every camera that has a new one and is due for inference
+            batch, probed, idle_ts = [], False, None
+            for cam in cams:
+                ok, frame, frame_ts, _ = cam.read(timeout=wait_s)
+                if not ok or frame is None:
+                    continue
+                probed = True
+                if not len(rooms):
+                    # nobody attached: keep the cameras alive, but don't let the rate
+                    # scheduler hand out a due frame that would never get its done()
+                    idle_ts = max(idle_ts or 0.0, frame_ts)
+                    continue
+                r = rates[cam.name]
+                if r is None or r.should_process(frame, unmarked):
+                    batch.append((cam, frame, frame_ts))
+            if idle_ts is not None:
+                heartbeat.tick(idle_ts, sessions=[])
+                continue
+            if not batch:
+                if probed:
+                    time.sleep(min([r.next_in() for r in rates.values() if r is not None] or [0.0]))
+                heartbeat.beat()
+                continue
+            clock.mark("first_frame")
+            heartbeat.tick(max(ts for _, _, ts in batch), sessions=sorted(rooms.sessions),
+                           cameras={cam.name: {**cam.stats(), "rate": rates[cam.name].stats() if rates[cam.name] else None}
+                                    for cam in cams})
+
+            try:
+                faces_per_cam = detect_faces_batch(app, [frame for _, frame, _ in batch])
+            except InferenceTimeout as e:
+                print(f"[WARN] {e}; frames skipped")
+                continue
+            now_ts = time.time()
+            work = []   # (cam, frame, faces, tracks, pending)
+            for (cam, frame, _), faces in zip(batch, faces_per_cam):
+                if faces:
+                    clock.mark("first_face")
+                tracker = trackers[cam.name]
+                tracks = tracker.update(faces)
+                pending = [i for i, t in enumerate(tracks) if tracker.needs_embedding(t, now_ts)]
+                if gate is not None and pending:
+                    _, pending = gate.filter(frame, [faces[i] for i in pending], pending)
+                work.append((cam, frame, faces, tracks, pending))
+
+            todo = [f for _, _, faces, _, pending in work for f in (faces[i] for i in pending)]
+            if todo:
+                try:
+                    embed_faces_batch(app, [(frame, [faces[i] for i in pending])
+                                            for _, frame, faces, _, pending in work])
+                except InferenceTimeout as e:
+                    print(f"[WARN] {e}; frames skipped")
+                    continue
+                matches = iter(rooms.match(stack_embeddings(todo), views))
+            else:
+                matches = iter(())
+
+            # merge: one best sighting per student across all cameras of this cycle
+            best_by_user, seen = {}, 0
+            for cam, _, _, tracks, pending in work:
+                for i in pending:
+                    best_id, best_sim = next(matches)
+                    if best_id == _TOMBSTONE:   # freed gallery row (dropped student): nobody
+                        best_id = None
+                    trackers[cam.name].record(tracks[i], best_id, best_sim, SIM_THRESHOLD, now_ts)
+                    if best_id and best_sim >= SIM_THRESHOLD:
+                        seen += 1
+                        if best_sim > best_by_user.get(best_id, (-1.0, None))[0]:
+                            best_by_user[best_id] = (best_sim, cam.name)
+                    elif best_id:
+                        print(f"[LOW SIM] cam={cam.name} user_id={best_id} sim={best_sim:.2f} < {SIM_THRESHOLD}")
+            sightings += seen
+            merged += seen - len(best_by_user)   # same student seen by more than one camera
+            done_ts = time.time()
+            for cam, _, frame_ts in batch:
+                cam.done(frame_ts, done_ts)
+                if rates[cam.name] is not None:
+                    rates[cam.name].done(done_ts)
+
+            for best_id, (best_sim, cam_name) in best_by_user.items():
+                clock.mark("first_recognition")
+                # route by enrollment: every attached session whose section has this student
+                for ctx, _ in rooms.route(best_id, views):
+                    if now_ts - ctx.last_mark_by_user.get(best_id, 0) < COOLDOWN_S:
+                        continue
+                    if mark_attendance_for_match(ctx.session_id, int(best_id), best_sim, state=ctx.state,
+                                                 writer=ctx.writer,
+                                                 roster=views[ctx.course_assignment_id].roster):
+                        ctx.last_mark_by_user[best_id] = now_ts
+
+            if now_ts - last_stats_ts >= STATS_EVERY_S:
+                for cam in cams:
+                    print(f"[CAM {cam.name}] {cam.stats()} track={trackers[cam.name].stats()} "
+                          f"rate={rates[cam.name].stats() if rates[cam.name] else None}")
+                print(f"[TRACK] room={rooms.stats()} sightings={sightings} merged={merged} "
+                      f"quality={gate.stats() if gate else None}")
+                last_stats_ts = now_ts
+    finally:
+        heartbeat.clear()
+        for cam in cams:
+            cam.stop()
+        rooms.close()  # flushes every attached session's marks
+        print("[INFO] Room worker stopped/cleaned up.")
+
+
+# ---------------- Warm pool standby ----------------
+def _redirect_output(path):
+    """Point this process's stdout/stderr (fd level) at the session log."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    sys.stdout.reconfigure(line_buffering=True)
+
+
+def run_standby():
+    """
+    Warm pool member (apps/biometrics/worker_pool.py): load the model, run
+    one warm-up inference, report READY, then wait for a session on stdin.
+    """
+    from django.db import close_old_connections
+    from apps.biometrics.worker_pool import READY_LINE
+    t0 = time.time()
+    app = init_insightface()
+    detect_faces(app, np.zeros((480, 640, 3), dtype=np.uint8))  # first-run allocations
+    print(f"[POOL] model warm in {time.time() - t0:.1f}s; waiting for a session")
+    print(READY_LINE, flush=True)
+
+    line = sys.stdin.readline()
+    if not line.strip():
+        print("[POOL] pool closed; exiting")
+        return
+    job = json.loads(line)
+    os.environ[START_ENV] = str(job["start_ts"])
+    if job.get("log"):
+        _redirect_output(job["log"])
+    close_old_connections()  # the connection may have idled out while on standby
+    cam_src = job.get("cam_source")
+    if cam_src is None:
+        cam_src = 0
+    if isinstance(cam_src, str) and cam_src.isdigit():
+        cam_src = int(cam_src)
+    if job.get("room_id"):
+        print(f"[POOL] standby worker PID={os.getpid()} took room {job['room_id']}")
+        run_room_worker(int(job["room_id"]), cam_src, app=app)
+        return
+    print(f"[POOL] standby worker PID={os.getpid()} took session {job['session_id']}")
+    run_session_worker(int(job["session_id"]), cam_src, app=app)
+
+
 # ---------------- CLI entry ----------------
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--standby":
+        run_standby()
+        sys.exit(0)
+    if len(sys.argv) >= 3 and sys.argv[1] == "--room":
+        cam_src = sys.argv[3] if len(sys.argv) >= 4 else 0
+        run_room_worker(int(sys.argv[2]), int(cam_src) if str(cam_src).isdigit() else cam_src)
+        sys.exit(0)
     if len(sys.argv) < 2:
-        print("Usage: python face_session_cam.py <SESSION_ID> [CAM_SOURCE]")
+        print("Usage: python face_session_cam.py <SESSION_ID> [CAM_SOURCE] | --room <ROOM_ID> [CAM_SOURCE] | --standby")
         sys.exit(1)
     sess_id = int(sys.argv[1])
     cam_src = sys.argv[2] if len(sys.argv) >= 3 else 0
@@ -0,0 +1,17 @@
+# face_supervisor.py
+import os, argparse
+
+# ---------------- Django bootstrap ----------------
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+import django
+django.setup()
+
+from apps.biometrics.supervisor import serve
+
+
+# ---------------- CLI entry ----------------
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Own and supervise the session recognition workers")
+    ap.parse_args()
+    # start next to the web server; views and the scheduler send it WorkerRequests
+    serve()